@@ -0,0 +1,185 @@
+import gc
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+from app.backend.memory_governor import total_ram_mb
+
+try:
+    import llama_cpp
+    from llama_cpp import Llama
+except ImportError:
+    llama_cpp = None
+    Llama = None
+
+# Short, fixed calibration workload
+CALIBRATION_TEXT = (
+    "The quick brown fox jumps over the lazy dog. Local language models trade memory for speed, "
+    "and the best thread count depends on the cores, caches and memory bandwidth of each machine. "
+) * 12
+PREFILL_TOKENS = 256
+DECODE_TOKENS = 32
+CALIBRATION_CTX = 1024
+
+# (use_mmap, use_mlock), least resident memory first: mmap pages can be dropped by the OS,
+# mlock pins them, and without mmap the weights are copied into process memory
+MEMORY_OPTIONS = [(True, False), (True, True), (False, False)]
+
+def machine_key():
+    """Identifies the hardware a profile was measured on."""
+    key = f"{platform.system()}-{platform.machine()}-{os.cpu_count()}cpu"
+    gpu = get_gpu()
+    if gpu:
+        key += f"-{gpu['name']}-{gpu['vram']}GB"
+    return key.replace(" ", "_")
+
+def get_gpu():
+    if llama_cpp is None or not getattr(llama_cpp, "llama_supports_gpu_offload", lambda: False)():
+        return None
+    try:
+        from app.backend.hardware import get_device_info
+        info = get_device_info()
+    except Exception:
+        return None
+    return info if info.get("device") == "cuda" else None
+
+def profile_key(model_name):
+    return f"{model_name}|{machine_key()}"
+
+def load_profile(config, model_name):
+    if not config:
+        return None
+    return config.get_nested(["text", "tuning", profile_key(model_name)])
+
+def save_profile(config, model_name, profile):
+    text = dict(config.get("text", {}) or {})
+    tuning = dict(text.get("tuning", {}))
+    tuning[profile_key(model_name)] = profile
+    text["tuning"] = tuning
+    config.update("text", text)
+
+def measure(model_path, params, log=print):
+    """Loads the model with params and returns prefill/decode tokens per second."""
+    t0 = time.time()
+    model = Llama(model_path=str(model_path), n_ctx=CALIBRATION_CTX, verbose=False, **params)
+    load_s = time.time() - t0
+    try:
+        tokens = model.tokenize(CALIBRATION_TEXT.encode("utf-8"))[:PREFILL_TOKENS]
+
+        model.reset()
+        t0 = time.time()
+        model.eval(tokens)
+        prefill_tps = len(tokens) / (time.time() - t0)
+
+        # Decode speed = one-token forward passes; sampling cost is the same for every config
+        t0 = time.time()
+        for _ in range(DECODE_TOKENS):
+            model.eval([tokens[-1]])
+        decode_tps = DECODE_TOKENS / (time.time() - t0)
+    finally:
+        close = getattr(model, "close", None)
+        if close:
+            close()
+        del model
+        gc.collect()
+
+    result = {"prefill_tps": round(prefill_tps, 1), "decode_tps": round(decode_tps, 2), "load_s": round(load_s, 2)}
+    log(f"  {params} -> {result}")
+    return result
+
+def _unique(values):
+    out = []
+    for v in values:
+        if v not in out:
+            out.append(v)
+    return out
+
+def gpu_layer_candidates(meta, file_size_mb):
+    gpu = get_gpu()
+    if not gpu:
+        return [0]
+    layers = meta.get("layers") or 32
+    # Leave ~1 GB for the KV cache and CUDA context
+    vram_mb = max(0, gpu["vram"] * 1024 - 1024)
+    if file_size_mb <= vram_mb:
+        return [-1]
+    # Partial offload: as many layers as fit, plus a more conservative split
+    fit = int(layers * vram_mb / file_size_mb)
+    return _unique([max(0, fit), max(0, int(fit * 0.75)), 0])
+
+def autotune(model_name, model_path, meta=None, max_threads=None, log=print):
+    """
+    Coordinate search over load/decode parameters. Each stage keeps the winner of the
+    previous ones, which needs far fewer model loads than a full grid:
+    n_gpu_layers -> n_threads (decode) -> n_threads_batch and n_batch (prefill) -> mmap/mlock.
+    """
+    if not Llama:
+        raise RuntimeError("llama-cpp-python not installed.")
+
+    meta = meta or {}
+    cpus = max_threads or os.cpu_count() or 1
+    file_size_mb = os.path.getsize(model_path) / 1024**2
+    best = {"n_gpu_layers": 0, "n_threads": max(1, cpus // 2), "n_threads_batch": cpus, "n_batch": 512,
+            "use_mmap": True, "use_mlock": False}
+    log(f"Autotuning {model_name} on {machine_key()}")
+
+    def pick(name, candidates, metric):
+        results = {}
+        for value in candidates:
+            params = dict(best, **{name: value})
+            try:
+                results[value] = measure(model_path, params, log)
+            except Exception as e:
+                log(f"  {name}={value} failed: {e}")
+        if results:
+            best[name] = max(results, key=lambda v: results[v][metric])
+        return results
+
+    pick("n_gpu_layers", gpu_layer_candidates(meta, file_size_mb), "decode_tps")
+    # Decode is memory-bound and usually peaks below the logical core count
+    pick("n_threads", _unique([max(1, cpus // 4), max(1, cpus // 2), max(1, cpus * 3 // 4), cpus]), "decode_tps")
+    # Prefill is compute-bound and usually wants every core
+    pick("n_threads_batch", _unique([best["n_threads"], cpus]), "prefill_tps")
+    pick("n_batch", [128, 256, 512], "prefill_tps")
+
+    # Pinning or copying the weights only makes sense with plenty of RAM to spare
+    ram = total_ram_mb()
+    options = MEMORY_OPTIONS if ram and file_size_mb <= ram * 0.5 else MEMORY_OPTIONS[:1]
+    results = {}
+    for mmap_, mlock in options:
+        params = dict(best, use_mmap=mmap_, use_mlock=mlock)
+        try:
+            results[(mmap_, mlock)] = measure(model_path, params, log)
+        except Exception as e:
+            log(f"  use_mmap={mmap_} use_mlock={mlock} failed: {e}")
+    if results:
+        # Decode speed decides; near-ties (within 3%) go to the option that holds the least memory.
+        # Load times are not compared: the first trial warms the page cache for the ones after it
+        top = max(r["decode_tps"] for r in results.values())
+        best["use_mmap"], best["use_mlock"] = next(
+            k for k in MEMORY_OPTIONS if k in results and results[k]["decode_tps"] >= top * 0.97
+        )
+        final = results[(best["use_mmap"], best["use_mlock"])]
+    else:
+        final = measure(model_path, best, log)
+
+    profile = dict(best, prefill_tps=final["prefill_tps"], decode_tps=final["decode_tps"], tuned_at=time.strftime("%Y-%m-%d %H:%M"))
+    log(f"Best profile for {model_name}: {profile}")
+    return profile
+
+if __name__ == "__main__":
+    # python -m app.backend.autotune <model file name>
+    sys.path.append(str(Path(__file__).parent.parent.parent))
+    from app.backend.config_manager import ConfigManager
+    from app.backend.text_engine import TextEngine
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m app.backend.autotune <model.gguf>")
+        sys.exit(1)
+
+    config = ConfigManager()
+    models_root = config.get_nested(["paths", "models_root"], "models")
+    engine = TextEngine(os.path.join(models_root, "llm"), config.get("custom_model_paths", []), config)
+    print(engine.autotune(sys.argv[1]))
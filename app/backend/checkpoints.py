@@ -0,0 +1,89 @@
+import hashlib
+import json
+import mmap
+import struct
+
+# Key prefixes of the parts of an original (LDM-format) Stable Diffusion checkpoint
+COMPONENT_PREFIXES = {
+    "unet": ("model.diffusion_model.",),
+    "vae": ("first_stage_model.",),
+    "text_encoder": ("cond_stage_model.", "conditioner.embedders."),
+}
+
+# Tensors only found in one family: SD 2.x uses OpenCLIP, SDXL has two text encoders
+_SD2_KEY = "cond_stage_model.model.transformer.resblocks.0.attn.in_proj_weight"
+_SD1_KEY = "cond_stage_model.transformer.text_model.embeddings.token_embedding.weight"
+_SDXL_KEY = "conditioner.embedders.1.model.transformer.resblocks.0.attn.in_proj_weight"
+
+def read_safetensors_header(mm):
+    """Returns (tensor header, offset of the data section) of a mapped safetensors file."""
+    n = struct.unpack_from("<Q", mm, 0)[0]
+    if n > len(mm) - 8:
+        raise ValueError("not a safetensors file")
+    header = json.loads(mm[8:8 + n])
+    header.pop("__metadata__", None)
+    return header, 8 + n
+
+def component_of(key):
+    for component, prefixes in COMPONENT_PREFIXES.items():
+        if key.startswith(prefixes):
+            return component
+    return None
+
+def read_checkpoint_info(path):
+    """
+    Classifies a .safetensors file from its header alone (no tensor data is read):
+    kind "checkpoint" for a full SD model, "lora" for an adapter, otherwise "other";
+    arch "sd1", "sd2" or "sdxl"; and the bytes per component.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header, _ = read_safetensors_header(mm)
+
+    sizes, dtypes = {}, {}
+    for key, info in header.items():
+        start, end = info["data_offsets"]
+        component = component_of(key)
+        if component:
+            sizes[component] = sizes.get(component, 0) + end - start
+        dtypes[info["dtype"]] = dtypes.get(info["dtype"], 0) + end - start
+
+    if all(c in sizes for c in COMPONENT_PREFIXES):
+        kind = "checkpoint"
+    elif any("lora" in k for k in header):
+        kind = "lora"
+    else:
+        kind = "other"
+    arch = None
+    if kind == "checkpoint":
+        arch = "sdxl" if _SDXL_KEY in header else "sd2" if _SD2_KEY in header else "sd1" if _SD1_KEY in header else None
+    return {
+        "kind": kind,
+        "arch": arch,
+        "dtype": max(dtypes, key=dtypes.get) if dtypes else None,
+        "component_bytes": sizes,
+        "tensors": len(header)
+    }
+
+def component_hashes(path, components=("vae", "text_encoder")):
+    """
+    SHA-256 per component over its tensor names, dtypes, shapes and bytes, read through a
+    memory map. Equal hashes mean the component is bit-identical between two files, even
+    when the tensors sit at different offsets.
+    """
+    hashes = {c: hashlib.sha256() for c in components}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header, data_start = read_safetensors_header(mm)
+        view = memoryview(mm)
+        try:
+            for key in sorted(header):
+                component = component_of(key)
+                if component not in hashes:
+                    continue
+                info = header[key]
+                start, end = info["data_offsets"]
+                h = hashes[component]
+                h.update(f"{key}|{info['dtype']}|{info['shape']}|".encode("utf-8"))
+                h.update(view[data_start + start:data_start + end])
+        finally:
+            view.release()
+    return {c: h.hexdigest() for c, h in hashes.items()}
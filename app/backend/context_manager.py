@@ -0,0 +1,116 @@
+SUMMARY_MAX_TOKENS = 200
+SUMMARY_MAX_INPUT_CHARS = 8000 # Keeps the summarization request itself inside the context
+
+class ContextManager:
+    """
+    Fits chat history into a token budget using the loaded model's tokenizer.
+
+    Per-turn token counts and summaries of dropped turns are cached in the session
+    record under "context", so each turn only tokenizes what is new and a summary
+    is only recomputed when more turns fall out of the window. With a scheduler,
+    summaries are generated as queued jobs like every other generation.
+    """
+    def __init__(self, text_engine, budget=None, summarize=True, low_water=0.75, scheduler=None):
+        self.text_engine = text_engine
+        self.scheduler = scheduler
+        self.budget = budget # Max prompt tokens; None = model context minus reply reserve
+        self.summarize = summarize
+        # When history overflows, trim down to this fraction of the budget. The cut point
+        # then stays put for several turns, which keeps the prompt prefix (and KV reuse) stable.
+        self.low_water = low_water
+
+    def count(self, text):
+        model = self.text_engine.model
+        return len(model.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def prompt_budget(self):
+        if self.budget:
+            return self.budget
+        return self.text_engine.model.n_ctx() - self.text_engine.max_tokens
+
+    def fit(self, session, history, prompt, system_prompt):
+        """
+        Returns (system_prompt, history) that fit the budget. system_prompt carries the
+        summary of dropped turns, if any. Updates session["context"] in place.
+        """
+        ctx = session.setdefault("context", {})
+        if ctx.get("model") != self.text_engine.model_name:
+            # Counts and summaries are only valid for the tokenizer/model that made them
+            ctx.clear()
+            ctx["model"] = self.text_engine.model_name
+
+        counts = self._turn_counts(ctx, history)
+        budget = self.prompt_budget()
+        fixed = self.count(self.text_engine._build_prompt(prompt, [], system_prompt))
+
+        cutoff = min(ctx.get("cutoff", 0), len(history))
+        summary = self._summary_for(ctx, history, cutoff, session.get("id"))
+        if fixed + self._summary_cost(summary) + sum(counts[cutoff:]) > budget:
+            # Overflow: advance the cut point until we are under the low-water mark,
+            # leaving room for the longest summary we would generate
+            target = budget * self.low_water
+            reserve = min(SUMMARY_MAX_TOKENS + 16, target // 2) if self.summarize else 0
+            while cutoff < len(history) and fixed + reserve + sum(counts[cutoff:]) > target:
+                cutoff += 1
+            summary = self._summary_for(ctx, history, cutoff, session.get("id"))
+        ctx["cutoff"] = cutoff
+
+        if summary:
+            system_prompt = f"{system_prompt}\n\nSummary of the earlier conversation: {summary}"
+        return system_prompt, history[cutoff:]
+
+    def _turn_counts(self, ctx, history):
+        # Cached as [tokens, chars] per turn; the char length catches edited turns
+        cached = ctx.get("counts", [])
+        counts = []
+        for i, (user_msg, ai_msg) in enumerate(history):
+            text = self.text_engine._format_turn(user_msg, ai_msg)
+            if i < len(cached) and cached[i][1] == len(text):
+                counts.append(cached[i])
+            else:
+                counts.append([self.count(text), len(text)])
+        ctx["counts"] = counts
+        return [c[0] for c in counts]
+
+    def _summary_cost(self, summary):
+        return self.count(summary) + 16 if summary else 0
+
+    def _summary_for(self, ctx, history, cutoff, session_id=None):
+        if not self.summarize or cutoff == 0:
+            return None
+
+        cached = ctx.get("summary")
+        if cached and cached["upto"] == cutoff:
+            return cached["text"]
+
+        # Extend the existing summary with the newly dropped turns instead of starting over
+        if cached and cached["upto"] < cutoff:
+            start, previous = cached["upto"], cached["text"]
+        else:
+            start, previous = 0, ""
+
+        transcript = "".join(
+            f"User: {u}\nAI: {a}\n" for u, a in history[start:cutoff]
+        )[-SUMMARY_MAX_INPUT_CHARS:]
+        request = f"Current summary: {previous or '(none)'}\n\nNew conversation turns:\n{transcript}\nUpdated summary:"
+        def run(replica=0):
+            yield self.text_engine.generate(
+                request, [],
+                "You summarize conversations. Output ONLY a concise summary (under 120 words) that keeps names, facts and decisions.",
+                max_tokens=SUMMARY_MAX_TOKENS, replica=replica
+            )
+
+        try:
+            if self.scheduler:
+                # Queued in this session's turn, so a long summary is fair to other sessions and shows in the stats
+                job = self.scheduler.submit(run, session_key=session_id)
+                if job is None:
+                    return previous or None # Queue full: keep the old summary for now
+                text = "".join(job.stream())
+            else:
+                text = "".join(run())
+        except Exception:
+            return previous or None
+
+        ctx["summary"] = {"upto": cutoff, "text": text}
+        return text
@@ -0,0 +1,115 @@
+import threading
+import time
+
+class ImageRequest:
+    def __init__(self, prompt, negative_prompt, key, n, seed=None, cancel_event=None, on_preview=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.key = key # Requests with equal keys can share one pipeline call
+        self.n = n # Images wanted for this prompt
+        self.seed = seed # Image i uses seed + i; None means random, drawn by run_batch and recorded here
+        self.cancel_event = cancel_event
+        self.on_preview = on_preview # Called with progress updates while the batch runs
+        self.images = None
+        self.error = None
+        self.submitted = time.time()
+        self.done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+class ImageBatcher:
+    """
+    Coalesces concurrent image requests into batched pipeline calls.
+
+    One worker thread takes the oldest pending request, waits up to max_wait seconds
+    (counted from when it was submitted) for compatible requests with the same key,
+    and runs them together with at most max_batch images per call. run_batch(key,
+    requests) returns one list of images per request. Requests with other keys wait
+    for a later round, oldest first. Requests cancelled before their batch starts are
+    dropped; stopping a running batch is up to run_batch.
+    """
+    def __init__(self, run_batch, max_batch=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.pending = []
+        self.batches = 0
+        self.batched_requests = 0
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def submit(self, prompt, negative_prompt, key, n=1, seed=None, cancel_event=None, on_preview=None):
+        req = ImageRequest(prompt, negative_prompt, key, n, seed, cancel_event, on_preview)
+        with self._cond:
+            self.pending.append(req)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True, name="image-batcher")
+                self._worker.start()
+            self._cond.notify_all()
+        return req
+
+    def generate(self, prompt, negative_prompt, key, n=1, seed=None, cancel_event=None):
+        """
+        Blocks until the request's batch has run; returns its images (None if it was
+        cancelled while queued) or raises its error.
+        """
+        req = self.submit(prompt, negative_prompt, key, n, seed, cancel_event)
+        req.done.wait()
+        if req.error:
+            raise req.error
+        return req.images
+
+    def _take_batch(self):
+        # Caller holds self._cond
+        first = self.pending[0]
+        batch, size = [], 0
+        for req in self.pending:
+            if req.key != first.key:
+                continue
+            # A request bigger than max_batch still runs, alone
+            if batch and size + req.n > self.max_batch:
+                break
+            batch.append(req)
+            size += req.n
+        return batch, size
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.pending:
+                    self._cond.wait()
+                # Hold the batch open until it is full or the oldest request has waited long enough
+                while True:
+                    batch, size = self._take_batch()
+                    wait = batch[0].submitted + self.max_wait - time.time()
+                    if size >= self.max_batch or wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                for req in batch:
+                    self.pending.remove(req)
+
+            # Requests cancelled while they waited never reach the pipeline
+            for req in [r for r in batch if r.cancelled]:
+                batch.remove(req)
+                req.done.set()
+            if not batch:
+                continue
+
+            try:
+                results = self.run_batch(batch[0].key, batch)
+                for req, images in zip(batch, results):
+                    req.images = images
+            except Exception as e:
+                for req in batch:
+                    req.error = e
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for req in batch:
+                req.done.set()
+
+    def stats(self):
+        with self._cond:
+            avg = self.batched_requests / self.batches if self.batches else 0.0
+            return {"pending": len(self.pending), "batches": self.batches, "avg_batch": round(avg, 2)}
@@ -0,0 +1,194 @@
+"""
+Benchmarks the image speed presets: seconds per image, and similarity (SSIM) to the
+reference preset on the same prompts and seeds. With --sizes, measures instead how time
+per megapixel and peak memory scale with the output size (high-resolution mode above
+the native size).
+
+    python -m app.backend.image_bench                      # tiny random pipeline, CPU
+    python -m app.backend.image_bench --model <id or folder> --device cuda --presets fast,draft,turbo
+    python -m app.backend.image_bench --sizes 1,2,3,4 --presets fast    # multiples of the native size
+
+Without --model, a tiny randomly initialised SD pipeline is built once under
+<models_root>/image/tiny-sd-test. It makes no meaningful pictures, but it runs the same
+engine code path on any machine in seconds.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+
+PROMPTS = [
+    "a lighthouse on a cliff at sunset, oil painting",
+    "portrait of an old fisherman, detailed, soft light",
+    "a red bicycle leaning against a brick wall",
+]
+SEEDS = [11, 23]
+
+def ssim(a, b, window=11, sigma=1.5):
+    """Mean structural similarity of two PIL images on luma, 1.0 for identical images."""
+    if b.size != a.size:
+        b = b.resize(a.size, resample=3) # bicubic
+    x = _luma(a)
+    y = _luma(b)
+    coords = torch.arange(window, dtype=torch.float64) - window // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    kernel = (g[:, None] * g[None, :])[None, None]
+
+    def blur(t):
+        return F.conv2d(t, kernel)
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mx, my = blur(x), blur(y)
+    vx = blur(x * x) - mx * mx
+    vy = blur(y * y) - my * my
+    cov = blur(x * y) - mx * my
+    score = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return float(score.mean())
+
+def _luma(image):
+    data = torch.tensor(list(image.convert("L").getdata()), dtype=torch.float64)
+    return data.view(1, 1, image.height, image.width)
+
+def build_tiny_pipeline(path):
+    """Writes a tiny random-weight SD pipeline (64x64 output) to path, in diffusers format."""
+    from diffusers import AutoencoderKL, DPMSolverMultistepScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=1, pad_token_id=1, hidden_size=32, intermediate_size=37,
+        num_attention_heads=4, num_hidden_layers=5, vocab_size=1000
+    ))
+    # Character-level vocab: no merges, every byte is its own token
+    chars = list(bytes_to_unicode().values())
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for c in chars + [c + "</w>" for c in chars]:
+        vocab[c] = len(vocab)
+    (path / "vocab.json").write_text(json.dumps(vocab), encoding="utf-8")
+    (path / "merges.txt").write_text("#version: 0.2\n", encoding="utf-8")
+    tokenizer = CLIPTokenizer(str(path / "vocab.json"), str(path / "merges.txt"), model_max_length=77)
+    scheduler = DPMSolverMultistepScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+
+    pipe = StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False
+    )
+    pipe.save_pretrained(path, safe_serialization=True)
+    (path / "vocab.json").unlink()
+    (path / "merges.txt").unlink()
+    return path
+
+def run(engine, presets, reference, prompts=PROMPTS, seeds=SEEDS, log=print):
+    """Returns one result per preset: resolved settings, seconds per image and SSIM to reference."""
+    names = [reference] + [p for p in presets if p != reference]
+    images, results = {}, []
+    for name in names:
+        # One untimed image: scheduler construction, adapter loading and kernel warm-up
+        engine.generate_images(prompts[0], seed=seeds[0], preset=name)
+        outputs, t0 = [], time.time()
+        for prompt in prompts:
+            for seed in seeds:
+                out, status = engine.generate_images(prompt, seed=seed, preset=name)
+                if not out:
+                    raise RuntimeError(f"{name}: {status}")
+                outputs.append(out[0])
+        seconds = (time.time() - t0) / len(outputs)
+        images[name] = outputs
+        settings = engine.resolve_preset(name)
+        scores = [ssim(ref, img) for ref, img in zip(images[reference], outputs)]
+        result = {
+            "preset": name,
+            "runs_as": settings["name"],
+            "scheduler": settings["scheduler"],
+            "steps": settings["steps"],
+            "size": f"{settings['width']}x{settings['height']}",
+            "guidance": settings["guidance"],
+            "sec_per_image": round(seconds, 3),
+            "ssim": round(sum(scores) / len(scores), 4)
+        }
+        results.append(result)
+        log(f"{name:>10}  {seconds:7.3f} s/img  SSIM {result['ssim']:.4f}  ({result['runs_as']}, {result['scheduler']}, "
+            f"{result['steps']} steps, {result['size']}, cfg {result['guidance']})")
+    return results
+
+def run_sizes(engine, multiples, preset, hires=None, prompt=PROMPTS[0], seed=SEEDS[0], log=print):
+    """One image per size (multiples of the native size); returns the engine's run stats for each."""
+    native = engine.native_size()
+    engine.generate_images(prompt, seed=seed, preset=preset) # Warm-up at native size
+    results = []
+    for k in multiples:
+        size = int(native * k)
+        images, status = engine.generate_images(prompt, width=size, height=size, seed=seed, preset=preset, hires=hires)
+        if not images:
+            raise RuntimeError(f"{size}x{size}: {status}")
+        run = dict(engine.last_run)
+        results.append(run)
+        peak = f"peak {run['peak_mb']} MB" if run["peak_mb"] is not None else "peak n/a"
+        if run["extra_mb"] is not None:
+            peak += f" (+{run['extra_mb']} MB)"
+        log(f"{run['width']:>5}x{run['height']:<5} {run['seconds']:8.2f} s  {run['sec_per_mp']:7.2f} s/MP  {peak}"
+            f"{'  hi-res, %d tiles' % run['tiles'] if run['hires'] else ''}")
+    return results
+
+if __name__ == "__main__":
+    sys.path.append(str(Path(__file__).parent.parent.parent))
+    from app.backend.config_manager import ConfigManager
+    from app.backend.image_engine import ImageEngine
+    from app.backend.image_presets import REFERENCE_PRESET
+
+    config = ConfigManager()
+    models_root = config.get_nested(["paths", "models_root"], "models")
+    parser = argparse.ArgumentParser(description="Benchmark image speed presets.")
+    parser.add_argument("--model", help="HF id or diffusers folder (default: a tiny random test pipeline)")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--presets", help="Comma-separated preset names (default: all)")
+    parser.add_argument("--reference", default=REFERENCE_PRESET)
+    parser.add_argument("--sizes", help="Comma-separated multiples of the native size, e.g. 1,2,4")
+    parser.add_argument("--no-hires", action="store_true", help="With --sizes: one full-size pass instead of tiles")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    # Measure the pipeline, not the result cache; in memory only, config.json is not written
+    config.config.setdefault("image", {})["result_cache"] = False
+    engine = ImageEngine(os.path.join(models_root, "image"), device=args.device, config=config)
+
+    model = args.model
+    if not model:
+        model = Path(models_root) / "image" / "tiny-sd-test"
+        if not (model / "model_index.json").exists():
+            print(f"Building tiny test pipeline in {model}...")
+            build_tiny_pipeline(model)
+        model = str(model)
+    res = engine.load_model(model)
+    print(res)
+    if "Error" in res:
+        sys.exit(1)
+
+    presets = args.presets.split(",") if args.presets else list(engine.presets)
+    if args.sizes:
+        print(f"Native size {engine.native_size()}px, preset '{presets[0]}'")
+        results = run_sizes(engine, [float(k) for k in args.sizes.split(",")], presets[0],
+                            hires=False if args.no_hires else None)
+    else:
+        print(f"{len(PROMPTS) * len(SEEDS)} images per preset, SSIM against '{args.reference}'")
+        results = run(engine, presets, args.reference)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+class ResultCache:
+    """
+    On-disk cache of generated images for fully deterministic requests (a seed is set).
+    Keys hash everything that decides the pixels; image i of a request is stored as
+    {key}_{i}.png. Only the newest max_files images are kept.
+    """
+    def __init__(self, root_dir, max_files=500):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_id, prompt, negative_prompt, steps, guidance, seed, width, height, sampler=None):
+        # sampler: scheduler and adapter, which change the pixels as much as the steps do
+        ident = json.dumps([model_id, prompt, negative_prompt, steps, guidance, seed, width, height, sampler])
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+    def _path(self, key, i):
+        return self.root_dir / f"{key}_{i}.png"
+
+    def get(self, key, n):
+        """Paths of all n images, or None if any is missing."""
+        paths = [self._path(key, i) for i in range(n)]
+        hit = all(p.exists() for p in paths)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return None
+        for p in paths:
+            os.utime(p) # Mark as recently used for pruning
+        return paths
+
+    def put(self, key, images):
+        for i, img in enumerate(images):
+            path = self._path(key, i)
+            tmp = path.with_suffix(".tmp")
+            try:
+                img.save(tmp, format="PNG")
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"Could not cache image: {e}")
+                return
+        self._prune()
+
+    def _prune(self):
+        files = sorted(self.root_dir.glob("*.png"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for old in files[self.max_files:]:
+            old.unlink(missing_ok=True)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
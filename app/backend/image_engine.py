@@ -1,57 +1,750 @@
+import gc
+import os
+import queue
+import random
+import threading
+import time
+import numpy as np
 import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+import diffusers
+from collections import OrderedDict
+from diffusers import StableDiffusionPipeline
 from pathlib import Path
+from PIL import Image
+from app.backend.image_batcher import ImageBatcher
+from app.backend.image_cache import ResultCache
+from app.backend import image_presets
+from app.backend.checkpoints import component_hashes, component_of, read_checkpoint_info
+from app.backend.image_tiling import base_size, feather, tile_boxes
+from app.backend.memory_governor import PeakMemory
+from app.backend.model_catalog import ModelCatalog
+from app.backend.state_cache import StateCache
+from contextlib import nullcontext
+
+DEFAULT_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+
+# Diffusers-format repos (or local folders) whose configs and tokenizer single-file
+# checkpoints of each family are built with; override with image.single_file_configs
+SINGLE_FILE_BASES = {
+    "sd1": "runwayml/stable-diffusion-v1-5",
+    "sd2": "stabilityai/stable-diffusion-2-1",
+}
+
+# Linear map from the 4 SD 1.x latent channels to RGB: a rough stand-in for the VAE decoder
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+def latents_to_preview(latents, scale=4):
+    """Approximate RGB image of one latent (1, 4, h, w), at scale x the latent size (final size / 8 * scale)."""
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = latents[0].float().permute(1, 2, 0) @ factors
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().cpu().numpy()
+    img = Image.fromarray(rgb)
+    return img.resize((img.width * scale, img.height * scale), Image.BILINEAR)
+
+def cpu_supports_bf16():
+    # Native bf16 matmuls (AVX512-BF16 / AMX); elsewhere bf16 is emulated and slower than fp32
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+class WarmPipeline:
+    """A loaded pipeline and the state that must survive switching to another model and back."""
+    def __init__(self, pipe, scheduler_config, text_key, shared=None):
+        self.pipe = pipe
+        self.scheduler_config = scheduler_config # The model's own; every preset's scheduler derives from it
+        self.text_key = text_key # Embedding cache key: pipelines sharing a text encoder share embeddings
+        self.shared = shared or {} # Components other checkpoints may reuse, by content key
+        self.schedulers = {}
+        self.adapters = set()
+        self.img2img = None # Same modules as pipe, built on the first high-resolution request
 
 class ImageEngine:
-    def __init__(self, models_dir, device="cuda"):
+    def __init__(self, models_dir, device="cuda", config=None, governor=None):
         self.models_dir = Path(models_dir)
         self.device = device if torch.cuda.is_available() else "cpu"
+        self.config = config
+        self.governor = governor # Shared RAM/VRAM budget; may unload or offload pipelines when idle
         self.pipeline = None
         self.current_model_id = None
 
-    def load_model(self, model_id="runwayml/stable-diffusion-v1-5"):
+        # The active pipeline is the most recent of the warm ones; switching back to a warm model is instant.
+        # VAEs, text encoders and tokenizers identical between checkpoints are loaded once and reused.
+        self.max_warm = max(1, self._setting("warm_pipelines", 2))
+        self._warm = OrderedDict()
+        self._active = None
+        self.extra_dirs = [] # Checkpoint dirs added at runtime
+        self.checkpoints = ModelCatalog(self.models_dir / ".cache" / "checkpoints.json", extension=".safetensors",
+                                        reader=read_checkpoint_info)
+
+        # Speed presets; schedulers are built per pipeline on first use, adapters loaded into it on first use
+        self.presets = image_presets.load_presets(self._setting("presets", None))
+        self.default_preset = self._setting("default_preset", image_presets.DEFAULT_PRESET)
+        self.adapters = image_presets.find_adapters(self.models_dir / "adapters", self._setting("adapters", None))
+
+        # Load state, so a background warm-up and the first request never load twice
+        self.status = "idle" # idle -> loading -> warming -> ready | error
+        self.status_detail = ""
+        self.ready = threading.Event()
+        self._load_lock = threading.Lock()
+        self.load_seconds = None
+        self.step_seconds = None # Seconds per denoising step of the last run
+        self.last_run = None # Size, time per megapixel and peak memory of the last batch
+        self.perf_mode = []
+
+        # One pipeline, many callers: requests are queued and compatible ones run as one batch
+        self._pipe_lock = threading.Lock()
+        self.batcher = ImageBatcher(
+            self._run_batch,
+            max_batch=self._setting("max_batch", 4),
+            max_wait=self._setting("batch_wait_ms", 50) / 1000
+        )
+
+        # Text-encoder outputs keyed by (text encoder, text); the empty negative prompt alone saves a pass per image
+        self.embed_cache = StateCache(
+            max_entries=self._setting("embed_cache_entries", 256),
+            ram_budget_mb=self._setting("embed_cache_mb", 256),
+            sizeof=lambda t: t.element_size() * t.nelement()
+        )
+        # Finished images of seeded requests, so repeating one is free
+        self.result_cache = None
+        if self._setting("result_cache", True):
+            self.result_cache = ResultCache(self.models_dir / ".result_cache", max_files=self._setting("result_cache_files", 500))
+
+    def _setting(self, key, default):
+        if not self.config:
+            return default
+        return self.config.get_nested(["image", key], default)
+
+    def _dtype(self):
+        # Use float16 for GPU to save VRAM
+        if self.device == "cuda":
+            return torch.float16
+        bf16 = self._setting("cpu_bf16", "auto")
+        if bf16 is True or (bf16 == "auto" and cpu_supports_bf16()):
+            return torch.bfloat16
+        return torch.float32
+
+    def checkpoint_dirs(self):
+        dirs = [self.models_dir]
+        if self.config:
+            dirs += [Path(d) for d in self.config.get("custom_model_paths", [])]
+        return dirs + [Path(d) for d in self._setting("checkpoint_dirs", [])] + self.extra_dirs
+
+    def list_checkpoints(self, force=False):
+        """Single-file SD checkpoints this engine can load, {file name: catalog entry}."""
+        entries = self.checkpoints.refresh(self.checkpoint_dirs(), force=force)
+        return {
+            name: e for name, e in entries.items()
+            if e["meta"].get("kind") == "checkpoint" and e["meta"].get("arch") in SINGLE_FILE_BASES
+        }
+
+    def list_models(self, force=False):
+        return [self._setting("model_id", DEFAULT_MODEL_ID)] + list(self.list_checkpoints(force))
+
+    def _find_checkpoint(self, model_id):
+        """(path, catalog entry or None) if model_id is a single-file checkpoint, else None."""
+        if not str(model_id).lower().endswith(".safetensors"):
+            return None
+        entries = self.list_checkpoints()
+        entry = entries.get(model_id) or next((e for e in entries.values() if Path(e["path"]) == Path(model_id)), None)
+        if entry:
+            return Path(entry["path"]), entry
+        if Path(model_id).is_file():
+            return Path(model_id), None
+        return None
+
+    def load_model(self, model_id=None, warm_up=False):
         """
-        Loads a model. 
-        model_id can be a HuggingFace ID or a local path.
+        Loads a model and makes it the active one.
+        model_id can be a HuggingFace ID, a local diffusers folder, or a single-file
+        .safetensors checkpoint (a path, or a file name from list_checkpoints()).
+        The last image.warm_pipelines models stay loaded, so switching back is instant.
+        warm_up runs one step after a fresh load, before the model is reported ready.
         """
-        try:
-            # Use float16 for GPU to save VRAM
-            dtype = torch.float16 if self.device == "cuda" else torch.float32
-            
-            self.pipeline = StableDiffusionPipeline.from_pretrained(
-                model_id, 
-                torch_dtype=dtype,
-                use_safetensors=True
+        model_id = model_id or self._setting("model_id", DEFAULT_MODEL_ID)
+        with self._load_lock:
+            if self.pipeline is not None and self.current_model_id == model_id:
+                return f"Loaded {model_id}"
+            warm = self._warm.get(model_id)
+            if warm:
+                self._activate(model_id, warm)
+                if self.governor:
+                    self.governor.touch(self._alloc_name(model_id))
+                self.status = "ready"
+                self.ready.set()
+                return f"Loaded {model_id}"
+
+            self.status = "loading"
+            self.ready.clear()
+            t0 = time.time()
+            try:
+                dtype = self._dtype()
+                if self.governor:
+                    # SD 1.x is ~1.07B parameters plus activations
+                    estimate = self._setting("estimate_mb", None) or (2600 if dtype != torch.float32 else 5000)
+                    self.governor.reserve(
+                        self._alloc_name(model_id), "image", "vram" if self.device == "cuda" else "ram", estimate,
+                        release=lambda: self.unload(model_id),
+                        offload=(lambda: self.offload(model_id)) if self.device == "cuda" else None
+                    )
+
+                checkpoint = self._find_checkpoint(model_id)
+                if checkpoint:
+                    warm = self._load_single_file(*checkpoint, dtype)
+                else:
+                    pipe = StableDiffusionPipeline.from_pretrained(
+                        model_id,
+                        torch_dtype=dtype,
+                        use_safetensors=True
+                    )
+                    warm = WarmPipeline(pipe, pipe.scheduler.config, model_id)
+                pipe = warm.pipe
+                pipe.scheduler = self._make_scheduler(warm.scheduler_config, self.resolve_preset()["scheduler"])
+                pipe.to(self.device)
+
+                # Enable memory efficient attention if on CUDA
+                if self.device == "cuda":
+                    try:
+                        pipe.enable_xformers_memory_efficient_attention()
+                    except Exception:
+                        pipe.enable_attention_slicing()
+                else:
+                    self._optimize_for_cpu(pipe, dtype)
+                if self._setting("vae_tiling", True):
+                    # Large latents are decoded (and encoded) in overlapping, blended tiles, and a batch one
+                    # image at a time, so VAE memory stays flat in the output size
+                    pipe.enable_vae_tiling()
+                    pipe.enable_vae_slicing()
+
+                # Components other warm pipelines already hold cost nothing extra
+                held = {id(m) for w in self._warm.values() for m in w.pipe.components.values()}
+                self._activate(model_id, warm)
+                self._trim_warm()
+                if self.governor:
+                    self.governor.measured(self._alloc_name(model_id), self._weights_mb(pipe, skip=held))
+                self.load_seconds = time.time() - t0
+                if warm_up:
+                    self._warm_up_run()
+                self.status = "ready"
+                self.ready.set()
+                return f"Loaded {model_id}"
+            except Exception as e:
+                if self.governor:
+                    self.governor.release(self._alloc_name(model_id))
+                self.status = "error"
+                self.status_detail = str(e)
+                self.ready.set() # Waiters get the error instead of hanging
+                return f"Error loading model: {e}"
+
+    def _load_single_file(self, path, entry, dtype):
+        """
+        Builds a pipeline from an original-format SD checkpoint. Tensors are read through
+        a memory map, and only for components no warm pipeline already holds: fine-tunes
+        usually keep their base model's VAE and text encoder, so switching between them
+        mostly costs the UNet.
+        """
+        from safetensors import safe_open
+        from diffusers import AutoencoderKL, PNDMScheduler, UNet2DConditionModel
+        from transformers import CLIPTokenizer
+
+        info = entry["meta"] if entry else read_checkpoint_info(path)
+        arch = info.get("arch")
+        if arch not in SINGLE_FILE_BASES:
+            raise ValueError(f"{path.name} is not a supported checkpoint ({arch or 'unknown type'})")
+        base = (self._setting("single_file_configs", {}) or {}).get(arch) or SINGLE_FILE_BASES[arch]
+        hashes = info.get("hashes")
+        if not hashes:
+            # Computed once per file version; the catalog keeps them
+            hashes = component_hashes(path)
+            if entry:
+                self.checkpoints.update_meta(entry["path"], {"hashes": hashes})
+        keys = {
+            "vae": f"vae:{hashes['vae']}",
+            "text_encoder": f"text_encoder:{hashes['text_encoder']}",
+            "tokenizer": f"tokenizer:{base}"
+        }
+
+        shared = {key: self._pooled(key) for key in keys.values()}
+
+        with safe_open(str(path), framework="pt") as f:
+            names = list(f.keys())
+            def state(component):
+                return {k: f.get_tensor(k) for k in names if component_of(k) == component}
+
+            unet = UNet2DConditionModel.from_single_file(state("unet"), config=base, subfolder="unet", torch_dtype=dtype)
+            if shared[keys["vae"]] is None:
+                shared[keys["vae"]] = AutoencoderKL.from_single_file(state("vae"), config=base, subfolder="vae", torch_dtype=dtype)
+            if shared[keys["text_encoder"]] is None and arch == "sd1":
+                shared[keys["text_encoder"]] = self._clip_text_encoder(state("text_encoder"), base, dtype)
+        if shared[keys["tokenizer"]] is None:
+            shared[keys["tokenizer"]] = CLIPTokenizer.from_pretrained(base, subfolder="tokenizer")
+
+        components = dict(
+            unet=unet, vae=shared[keys["vae"]], tokenizer=shared[keys["tokenizer"]],
+            safety_checker=None, feature_extractor=None, requires_safety_checker=False
+        )
+        if shared[keys["text_encoder"]] is not None:
+            pipe = StableDiffusionPipeline(
+                text_encoder=shared[keys["text_encoder"]],
+                scheduler=PNDMScheduler.from_pretrained(base, subfolder="scheduler"),
+                **components
             )
-            self.pipeline.scheduler = DPMSolverMultistepScheduler.from_config(self.pipeline.scheduler.config)
-            self.pipeline.to(self.device)
-            
-            # Enable memory efficient attention if on CUDA
+        else:
+            # OpenCLIP text encoders (SD 2.x) need diffusers' own conversion, which reads the whole file once
+            pipe = StableDiffusionPipeline.from_single_file(str(path), config=base, torch_dtype=dtype, **components)
+            shared[keys["text_encoder"]] = pipe.text_encoder
+        return WarmPipeline(pipe, pipe.scheduler.config, keys["text_encoder"], shared)
+
+    def _pooled(self, key):
+        # A component some warm pipeline already holds, or None
+        for warm in list(self._warm.values()):
+            if key in warm.shared:
+                return warm.shared[key]
+        return None
+
+    @staticmethod
+    def _clip_text_encoder(state, base, dtype):
+        from transformers import CLIPTextConfig, CLIPTextModel
+
+        model = CLIPTextModel(CLIPTextConfig.from_pretrained(base, subfolder="text_encoder"))
+        prefix = "cond_stage_model.transformer."
+        weights = {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+        if not any(k.startswith("text_model.") for k in weights):
+            # Some older checkpoints store the text model one level up
+            weights = {"text_model." + k: v for k, v in weights.items()}
+        missing, _ = model.load_state_dict(weights, strict=False)
+        missing = [k for k in missing if not k.endswith("position_ids")]
+        if missing:
+            raise ValueError(f"Text encoder weights missing from checkpoint: {', '.join(missing[:3])}")
+        return model.to(dtype)
+
+    def _activate(self, model_id, warm):
+        # Swap only between batches
+        with self._pipe_lock:
+            self._warm[model_id] = warm
+            self._warm.move_to_end(model_id)
+            self.pipeline, self.current_model_id, self._active = warm.pipe, model_id, warm
+
+    def _trim_warm(self):
+        # Oldest first; the active pipeline always stays
+        while len(self._warm) > self.max_warm:
+            oldest = next(iter(self._warm))
+            if oldest == self.current_model_id or not self.unload(oldest):
+                break
+
+    def _discard_embeddings(self):
+        # Keeps the prompt embeddings of text encoders that are still loaded
+        text_keys = {w.text_key for w in self._warm.values()}
+        self.embed_cache.discard_matching(lambda k: k[0] not in text_keys)
+
+    @staticmethod
+    def _make_scheduler(base_config, name):
+        cls_name, extra = image_presets.SCHEDULERS[name]
+        return getattr(diffusers, cls_name).from_config(base_config, **extra)
+
+    def _set_sampler(self, scheduler, adapter):
+        # Caller holds self._pipe_lock
+        pipe, active = self.pipeline, self._active
+        if scheduler not in active.schedulers:
+            active.schedulers[scheduler] = self._make_scheduler(active.scheduler_config, scheduler)
+        pipe.scheduler = active.schedulers[scheduler]
+
+        if adapter:
+            if adapter not in active.adapters:
+                path = self.adapters[adapter]
+                pipe.load_lora_weights(str(path.parent), weight_name=path.name, adapter_name=adapter)
+                active.adapters.add(adapter)
+            pipe.set_adapters([adapter])
+            pipe.enable_lora()
+        elif active.adapters:
+            pipe.disable_lora()
+
+    def native_size(self):
+        """Width (= height) the loaded model was trained at, e.g. 512 for SD 1.x."""
+        if not self.pipeline:
+            return None
+        return self.pipeline.unet.config.sample_size * self.pipeline.vae_scale_factor
+
+    def resolve_preset(self, preset=None, steps=None, guidance=None, width=None, height=None):
+        return image_presets.resolve(preset or self.default_preset, self.presets, self.adapters,
+                                     self.native_size(), steps, guidance, width, height)
+
+    @staticmethod
+    def _alloc_name(model_id):
+        return f"image:{model_id}"
+
+    @staticmethod
+    def _weights_mb(pipe, skip=()):
+        total = 0
+        for component in pipe.components.values():
+            if isinstance(component, torch.nn.Module) and id(component) not in skip:
+                total += sum(p.numel() * p.element_size() for p in component.parameters())
+        return total // 1024**2
+
+    def unload(self, model_id=None):
+        """
+        Frees a loaded pipeline, the active one by default; it is reloaded on its next
+        request. False while a batch is running.
+        """
+        if not self._pipe_lock.acquire(blocking=False):
+            return False
+        try:
+            model_id = model_id or self.current_model_id
+            warm = self._warm.pop(model_id, None)
+            if model_id == self.current_model_id:
+                self.pipeline, self._active = None, None
+                self.status = "idle"
+            self._discard_embeddings()
+            gc.collect()
             if self.device == "cuda":
-                try:
-                    self.pipeline.enable_xformers_memory_efficient_attention()
-                except Exception:
-                    self.pipeline.enable_attention_slicing()
+                torch.cuda.empty_cache()
+        finally:
+            self._pipe_lock.release()
+        if self.governor and warm:
+            self.governor.release(self._alloc_name(model_id))
+        return True
 
-            self.current_model_id = model_id
-            return f"Loaded {model_id}"
+    def offload(self, model_id=None):
+        """Moves a pipeline to system RAM; each component visits the GPU only while it runs."""
+        if len(self._warm) > 1:
+            # The offload hooks would also move components other warm pipelines share; unload instead
+            return False
+        if not self._pipe_lock.acquire(blocking=False):
+            return False
+        try:
+            warm = self._warm.get(model_id or self.current_model_id)
+            if not warm:
+                return False
+            warm.pipe.enable_model_cpu_offload()
+            torch.cuda.empty_cache()
+            self.perf_mode.append("cpu offload")
+            return True
         except Exception as e:
-            return f"Error loading model: {e}"
+            print(f"Could not offload image pipeline: {e}")
+            return False
+        finally:
+            self._pipe_lock.release()
 
-    def generate(self, prompt, negative_prompt="", steps=25, guidance=7.5):
-        if not self.pipeline:
+    def _optimize_for_cpu(self, pipe, dtype):
+        """CPU perf mode: thread count, memory format, attention kernel and an optional compiled UNet."""
+        self.perf_mode = [str(dtype).replace("torch.", "")]
+
+        threads = self._setting("cpu_threads", None) or os.cpu_count() or 1
+        torch.set_num_threads(threads)
+        self.perf_mode.append(f"{threads} threads")
+
+        if self._setting("channels_last", True):
+            # NHWC convolutions are what oneDNN is fastest at
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+            self.perf_mode.append("channels_last")
+
+        attention = self._setting("attention", "auto") # auto | sdpa | slicing
+        if attention == "auto":
+            attention = "sdpa" if hasattr(torch.nn.functional, "scaled_dot_product_attention") else "slicing"
+        if attention == "sdpa":
+            from diffusers.models.attention_processor import AttnProcessor2_0
+            pipe.unet.set_attn_processor(AttnProcessor2_0())
+        else:
+            pipe.enable_attention_slicing()
+        self.perf_mode.append(attention)
+
+        if self._setting("compile_unet", False) and hasattr(torch, "compile"):
+            # Compiles lazily on the first call, which is what the warm-up run is for
+            pipe.unet = torch.compile(pipe.unet)
+            self.perf_mode.append("compiled unet")
+
+    def warm_up_async(self, run=None):
+        """Loads the pipeline in a background thread and optionally runs one step, so the first image is fast."""
+        if run is None:
+            run = self._setting("warmup_run", True)
+        threading.Thread(target=self.load_model, kwargs={"warm_up": run}, daemon=True, name="image-warmup").start()
+
+    def _warm_up_run(self):
+        # Caller holds self._load_lock, with self.ready still clear: nobody sees "ready" before this is done
+        self.status = "warming"
+        try:
+            # One step at the default size initializes kernels (and compiles the UNet if enabled)
+            with self._pipe_lock:
+                self.pipeline(prompt="warm-up", num_inference_steps=1, guidance_scale=7.5, output_type="latent")
+        except Exception as e:
+            print(f"Image warm-up run failed: {e}")
+
+    def status_text(self):
+        if self.status == "idle":
+            return "Image model loads on first use."
+        if self.status == "loading":
+            return "⏳ Loading image model..."
+        if self.status == "warming":
+            return "⏳ Warming up image model..."
+        if self.status == "error":
+            return f"Image model failed to load: {self.status_detail}"
+        text = f"Image model ready ({self.load_seconds:.1f}s load"
+        if self.perf_mode:
+            text += ", " + ", ".join(self.perf_mode)
+        text += ")"
+        if self.step_seconds:
+            text += f", {self.step_seconds:.2f} s/step"
+        return text
+
+    def generate(self, prompt, negative_prompt="", steps=None, guidance=None, width=None, height=None, seed=None,
+                 cancel_event=None, preset=None, model=None, hires=None):
+        images, status = self.generate_images(prompt, negative_prompt, steps, guidance, width, height, seed=seed,
+                                              cancel_event=cancel_event, preset=preset, model=model, hires=hires)
+        return (images[0] if images else None), status
+
+    def generate_images(self, prompt, negative_prompt="", steps=None, guidance=None, width=None, height=None,
+                        num_images=1, seed=None, cancel_event=None, preset=None, model=None, hires=None):
+        """
+        Returns ([images], status). Concurrent calls with the same settings share a
+        pipeline pass; with a seed the result is deterministic and cached on disk.
+        preset picks scheduler, steps, guidance and size (image.default_preset if None);
+        explicit arguments override it. model switches the active model first (instant
+        if it is still warm); None keeps the current one. See generate_stream for hires.
+        """
+        for event in self.generate_stream(prompt, negative_prompt, steps, guidance, width, height,
+                                          num_images, seed, cancel_event, previews=False, preset=preset, model=model,
+                                          hires=hires):
+            pass
+        return event["images"], event["status"]
+
+    def generate_stream(self, prompt, negative_prompt="", steps=None, guidance=None, width=None, height=None,
+                        num_images=1, seed=None, cancel_event=None, previews=True, preset=None, model=None, hires=None):
+        """
+        Like generate_images, as a generator: yields {"step", "total", "preview"} every
+        image.preview_every steps (a cheap latent approximation, no VAE decode), then
+        {"images", "status", "preset"} where preset holds the settings actually used.
+        Setting cancel_event stops the denoising loop early.
+
+        Sizes above the model's native resolution use the high-resolution mode unless
+        hires is False (default: image.hires): the image is generated at native size,
+        upscaled, and refined tile by tile, so memory does not grow with the output size.
+        """
+        if self.status in ("loading", "warming"):
+            # A warm-up is in flight; wait for it instead of loading a second copy
+            self.ready.wait()
+        model_id = model or self.current_model_id or self._setting("model_id", DEFAULT_MODEL_ID)
+        if not self.pipeline or self.current_model_id != model_id:
             # Auto load default if not loaded
-            res = self.load_model()
+            res = self.load_model(model_id)
             if "Error" in res:
-                return None, res
-        
+                yield {"images": None, "status": res, "preset": None}
+                return
+
         try:
-            image = self.pipeline(
-                prompt=prompt, 
-                negative_prompt=negative_prompt, 
-                num_inference_steps=steps, 
-                guidance_scale=guidance
+            settings = self.resolve_preset(preset, steps, guidance, width, height)
+        except ValueError as e:
+            yield {"images": None, "status": str(e), "preset": None}
+            return
+        sampler = (settings["scheduler"], settings["adapter"])
+        steps, guidance = settings["steps"], settings["guidance"]
+        width, height = settings["width"], settings["height"]
+        native = self.native_size()
+        if hires is None:
+            hires = self._setting("hires", True)
+        hires = bool(hires and width and height and width * height > native * native)
+        settings["hires"] = hires
+        settings["seed"] = seed # Image i uses seed + i; unseeded requests get theirs when their batch runs
+
+        cache_key = None
+        if seed is not None and self.result_cache:
+            cache_key = ResultCache.key(model_id, prompt, negative_prompt, steps, guidance, seed, width, height,
+                                        "+".join(filter(None, sampler + ("hires" if hires else None,))))
+            paths = self.result_cache.get(cache_key, num_images)
+            if paths:
+                images = []
+                for p in paths:
+                    img = Image.open(p)
+                    img.load()
+                    images.append(img)
+                yield {"images": images, "status": "Success", "preset": settings}
+                return
+
+        key = (model_id, sampler, steps, width, height, guidance, hires)
+        updates = queue.Queue()
+        req = self.batcher.submit(prompt, negative_prompt, key, num_images, seed, cancel_event,
+                                  on_preview=updates.put if previews else None)
+        while not req.done.is_set():
+            try:
+                yield updates.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        if req.error:
+            yield {"images": None, "status": f"Generation failed: {req.error}", "preset": settings}
+        elif req.cancelled or not req.images:
+            yield {"images": None, "status": "Cancelled", "preset": settings}
+        else:
+            if cache_key:
+                self.result_cache.put(cache_key, req.images)
+            settings["seed"] = req.seed
+            yield {"images": req.images, "status": "Success", "preset": settings}
+
+    def _embed(self, text, adapter=None):
+        # Caller holds self._pipe_lock; adapters may patch the text encoder too
+        key = (self._active.text_key, text, adapter)
+        embeds = self.embed_cache.get(key)
+        if embeds is None:
+            with torch.no_grad():
+                # _execution_device follows CPU offload, self.device would not
+                embeds, _ = self.pipeline.encode_prompt(text, self.pipeline._execution_device, 1, False)
+            self.embed_cache.put(key, embeds)
+        return embeds
+
+    def _run_batch(self, key, requests):
+        model_id, (scheduler, adapter), steps, width, height, guidance, hires = key
+        if self.pipeline is None or self.current_model_id != model_id:
+            # The governor unloaded it, or another model became active, while this batch was queued
+            res = self.load_model(model_id)
+            if "Error" in res:
+                raise RuntimeError(res)
+        # Pinned, so the governor picks other victims; unload() also never runs while we hold the lock
+        pinned = self.governor.use(self._alloc_name(model_id)) if self.governor else nullcontext()
+        with pinned, self._pipe_lock:
+            if self.pipeline is None or self.current_model_id != model_id:
+                raise RuntimeError("The image model was switched or unloaded to free memory, please try again.")
+            self._set_sampler(scheduler, adapter)
+            # One embedding row per image, each text encoded at most once
+            prompt_embeds = torch.cat([self._embed(r.prompt, adapter) for r in requests for _ in range(r.n)])
+            negative_embeds = None
+            if guidance > 1:
+                # At guidance <= 1 (distilled presets) the pipeline skips the unconditional pass
+                negative_embeds = torch.cat([self._embed(r.negative_prompt or "", adapter) for r in requests for _ in range(r.n)])
+            for r in requests:
+                if r.seed is None:
+                    # Drawn apart from torch's global RNG, and kept on the request so the image can be made again
+                    r.seed = random.getrandbits(63)
+            generators = [torch.Generator("cpu").manual_seed(r.seed + i) for r in requests for i in range(r.n)]
+
+            every = max(1, self._setting("preview_every", 5))
+            def on_step_end(pipe, step, timestep, tensors):
+                done = step + 1
+                if all(r.cancelled for r in requests):
+                    # Nobody is waiting for this batch any more: skip the remaining steps
+                    pipe._interrupt = True
+                elif done % every == 0 and done < steps:
+                    latents = tensors["latents"]
+                    i = 0
+                    for r in requests:
+                        if r.on_preview and not r.cancelled:
+                            r.on_preview({"step": done, "total": steps, "preview": latents_to_preview(latents[i:i + 1])})
+                        i += r.n
+                return tensors
+
+            first_w, first_h = base_size(width, height, self.native_size()) if hires else (width, height)
+            if self.device == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+            t0 = time.time()
+            with PeakMemory() as peak:
+                images = self.pipeline(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_embeds,
+                    num_inference_steps=steps,
+                    guidance_scale=guidance,
+                    width=first_w,
+                    height=first_h,
+                    generator=generators,
+                    callback_on_step_end=on_step_end
+                ).images
+                self.step_seconds = (time.time() - t0) / max(1, steps)
+                tiles = 0
+                if hires:
+                    owners = [r for r in requests for _ in range(r.n)]
+                    refined = []
+                    for i, image in enumerate(images):
+                        image, tiles = self._refine_tiled(
+                            image, prompt_embeds[i:i + 1], negative_embeds[i:i + 1] if negative_embeds is not None else None,
+                            width, height, steps, guidance, generators[i] if generators else None, requests, owners[i]
+                        )
+                        refined.append(image)
+                    images = refined
+            self._record_run(width, height, len(images), time.time() - t0, peak, hires, tiles)
+
+        # Fan the batch back out to the callers
+        results, i = [], 0
+        for r in requests:
+            results.append(images[i:i + r.n])
+            i += r.n
+        return results
+
+    def _refine_tiled(self, image, prompt_embeds, negative_embeds, width, height, steps, guidance, generator, requests, owner):
+        """
+        Upscales image to width x height and re-denoises it lightly (image.hires_strength)
+        in native-size tiles that overlap by image.hires_overlap pixels. Tiles are blended
+        with feathered weights, so no seams show. owner gets each finished tile as a
+        {"stage": "tile"} progress update. Returns (image, tiles).
+        """
+        # Caller holds self._pipe_lock
+        from diffusers import StableDiffusionImg2ImgPipeline
+
+        active = self._active
+        if active.img2img is None:
+            active.img2img = StableDiffusionImg2ImgPipeline.from_pipe(self.pipeline)
+        active.img2img.scheduler = self.pipeline.scheduler
+        tile = self.native_size()
+        overlap = min(self._setting("hires_overlap", 64), tile // 2)
+        strength = self._setting("hires_strength", 0.35)
+        # img2img runs int(steps * strength) steps; at least one
+        tile_steps = max(steps, int(1 / strength + 0.999))
+
+        upscaled = image.resize((width, height), Image.LANCZOS)
+        canvas = torch.zeros(height, width, 3)
+        weight = torch.zeros(height, width, 1)
+        boxes = tile_boxes(width, height, tile, overlap)
+        for box in boxes:
+            if all(r.cancelled for r in requests):
+                return upscaled, len(boxes)
+            left, top, right, bottom = box
+            out = active.img2img(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                image=upscaled.crop(box),
+                strength=strength,
+                num_inference_steps=tile_steps,
+                guidance_scale=guidance,
+                generator=generator
             ).images[0]
-            return image, "Success"
-        except Exception as e:
-            return None, f"Generation failed: {e}"
+            if owner.on_preview and not owner.cancelled:
+                owner.on_preview({"step": boxes.index(box) + 1, "total": len(boxes), "preview": out, "stage": "tile"})
+            w = torch.outer(
+                torch.tensor(feather(bottom - top, overlap, top > 0, bottom < height)),
+                torch.tensor(feather(right - left, overlap, left > 0, right < width))
+            )[..., None]
+            canvas[top:bottom, left:right] += torch.from_numpy(np.asarray(out, dtype=np.float32)) * w
+            weight[top:bottom, left:right] += w
+        pixels = (canvas / weight).round().clamp(0, 255).byte().numpy()
+        return Image.fromarray(pixels), len(boxes)
+
+    def _record_run(self, width, height, n, seconds, peak, hires, tiles):
+        megapixels = width * height * n / 1e6
+        if self.device == "cuda":
+            peak_mb, extra_mb = torch.cuda.max_memory_allocated() / 1024**2, None
+        else:
+            peak_mb = peak.peak_mb
+            extra_mb = peak.peak_mb - peak.start_mb if peak.peak_mb is not None else None
+        self.last_run = {
+            "width": width,
+            "height": height,
+            "images": n,
+            "hires": hires,
+            "tiles": tiles,
+            "seconds": round(seconds, 2),
+            "sec_per_mp": round(seconds / megapixels, 2) if megapixels else None,
+            "peak_mb": round(peak_mb) if peak_mb is not None else None,
+            "extra_mb": round(extra_mb) if extra_mb is not None else None # Growth over the loaded model (CPU)
+        }
+
+    def cache_stats(self):
+        stats = {"embeddings": self.embed_cache.stats()}
+        if self.result_cache:
+            stats["results"] = self.result_cache.stats()
+        return stats
+
+    def batch_stats(self):
+        return self.batcher.stats()
@@ -0,0 +1,123 @@
+import re
+from pathlib import Path
+
+# Scheduler name -> (diffusers class, extra config)
+SCHEDULERS = {
+    "dpm++": ("DPMSolverMultistepScheduler", {}),
+    "dpm++_karras": ("DPMSolverMultistepScheduler", {"use_karras_sigmas": True}),
+    "unipc": ("UniPCMultistepScheduler", {}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "lcm": ("LCMScheduler", {}),
+}
+
+# Named speed/quality trade-offs. scale is the resolution relative to the model's native
+# size; adapter names a distilled LoRA that must be present locally (see find_adapters),
+# otherwise the preset falls back to fallback.
+PRESETS = {
+    "quality": {"scheduler": "dpm++_karras", "steps": 30, "guidance": 7.5, "scale": 1.0},
+    "balanced": {"scheduler": "dpm++", "steps": 25, "guidance": 7.5, "scale": 1.0},
+    "fast": {"scheduler": "dpm++_karras", "steps": 12, "guidance": 7.0, "scale": 1.0},
+    "draft": {"scheduler": "unipc", "steps": 8, "guidance": 6.0, "scale": 0.75},
+    "turbo": {"scheduler": "lcm", "steps": 4, "guidance": 1.5, "scale": 1.0, "adapter": "lcm", "fallback": "draft"},
+}
+DEFAULT_PRESET = "balanced"
+REFERENCE_PRESET = "quality"
+
+ADAPTER_EXTENSIONS = (".safetensors", ".bin")
+
+def load_presets(overrides=None):
+    """Built-in presets with config overrides merged in; an override may change some fields or add a preset."""
+    presets = {name: dict(p) for name, p in PRESETS.items()}
+    for name, fields in (overrides or {}).items():
+        merged = dict(presets.get(name, presets[DEFAULT_PRESET]))
+        merged.update(fields)
+        presets[name] = merged
+    return presets
+
+def find_adapters(adapters_dir, configured=None):
+    """
+    Distilled adapters available locally, {name: weights file}. A file or a folder in
+    adapters_dir named after the adapter (e.g. adapters/lcm.safetensors or
+    adapters/lcm/pytorch_lora_weights.safetensors) counts, as do {name: path} pairs from
+    the config. Nothing is downloaded.
+    """
+    found = {}
+    adapters_dir = Path(adapters_dir)
+    if adapters_dir.is_dir():
+        for entry in sorted(adapters_dir.iterdir()):
+            name = entry.stem if entry.is_file() else entry.name
+            weights = _weights_file(entry)
+            if weights:
+                found[name.lower()] = weights
+    for name, path in (configured or {}).items():
+        weights = _weights_file(Path(path))
+        if weights:
+            found[name.lower()] = weights
+    return found
+
+def _weights_file(path):
+    if path.is_file():
+        return path if path.suffix in ADAPTER_EXTENSIONS else None
+    if path.is_dir():
+        for ext in ADAPTER_EXTENSIONS:
+            files = sorted(path.glob(f"*{ext}"))
+            if files:
+                return files[0]
+    return None
+
+def snap(size):
+    # Pipelines need multiples of 8 (one latent pixel)
+    return max(64, int(round(size / 8)) * 8)
+
+def resolve(name, presets, adapters, native_size, steps=None, guidance=None, width=None, height=None):
+    """
+    Settings for one request: the preset's values, with explicit arguments taking
+    precedence. A preset whose adapter is missing resolves to its fallback, and the
+    result records that in "fallback_from". Raises ValueError for unknown names.
+    """
+    name = name or DEFAULT_PRESET
+    requested, seen = name, set()
+    while True:
+        if name not in presets:
+            raise ValueError(f"Unknown image preset '{name}'. Available: {', '.join(presets)}")
+        preset = presets[name]
+        adapter = preset.get("adapter")
+        if not adapter or adapter in adapters:
+            break
+        seen.add(name)
+        fallback = preset.get("fallback") or DEFAULT_PRESET
+        if fallback in seen:
+            raise ValueError(f"Image preset '{requested}' needs the '{adapter}' adapter, which is not installed.")
+        name = fallback
+
+    scheduler = preset.get("scheduler", "dpm++")
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"Image preset '{name}' uses unknown scheduler '{scheduler}'.")
+    scale = preset.get("scale", 1.0)
+    return {
+        "name": name,
+        "fallback_from": requested if name != requested else None,
+        "scheduler": scheduler,
+        "adapter": preset.get("adapter"),
+        "steps": steps or preset.get("steps", 25),
+        "guidance": guidance if guidance is not None else preset.get("guidance", 7.5),
+        "width": snap(width) if width else (snap(native_size * scale) if native_size else None),
+        "height": snap(height) if height else (snap(native_size * scale) if native_size else None),
+    }
+
+def parse_size(message):
+    """Finds a "--WIDTHxHEIGHT" flag in a chat message. Returns (width, height) or None, and the message without it."""
+    match = re.search(r"(?:^|\s)--(\d{2,5})x(\d{2,5})\b", message)
+    if not match:
+        return None, message
+    cleaned = (message[:match.start()] + message[match.end():]).strip()
+    return (int(match.group(1)), int(match.group(2))), re.sub(r"\s{2,}", " ", cleaned)
+
+def parse_preset(message, names):
+    """Finds a "--name" flag for one of names in a chat message. Returns (name or None, message without it)."""
+    for match in re.finditer(r"(?:^|\s)--([\w-]+)\b", message):
+        name = match.group(1).lower()
+        if name in names:
+            cleaned = (message[:match.start()] + message[match.end():]).strip()
+            return name, re.sub(r"\s{2,}", " ", cleaned)
+    return None, message
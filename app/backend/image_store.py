@@ -0,0 +1,123 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+class ImageStore:
+    """
+    Content-addressed store for generated images.
+
+    Images are keyed by a hash of their pixels, so the same image is stored once however
+    often it is saved. Each is written once in a fast encoding (WebP, or PNG at a low
+    compression level) next to a thumbnail, which is what the chat shows; the full
+    image is only read when asked for. A reference count per (image, session) lets
+    release_session() delete images no remaining session points to. Images stored
+    without a session are kept for a while, then sweep_unowned() deletes them unless a
+    session has referenced them since.
+    """
+    def __init__(self, root_dir, fmt="webp", thumb_size=384):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt.lower()
+        self.ext = "webp" if self.fmt == "webp" else "png"
+        self.thumb_size = thumb_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.root_dir / "refs.db", check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS refs (digest TEXT, session_id TEXT, count INTEGER, PRIMARY KEY (digest, session_id))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS refs_session ON refs (session_id)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS unowned (digest TEXT PRIMARY KEY, added REAL)")
+
+    @staticmethod
+    def digest(image):
+        h = hashlib.sha256(f"{image.mode}|{image.size}|".encode("ascii"))
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def _dir(self, digest):
+        # Fan out by hash prefix so no directory gets huge
+        return self.root_dir / digest[:2]
+
+    def full_path(self, digest):
+        return self._dir(digest) / f"{digest}.{self.ext}"
+
+    def thumbnail_path(self, digest):
+        return self._dir(digest) / f"{digest}_thumb.{self.ext}"
+
+    @staticmethod
+    def digest_from_path(path):
+        """Digest of a stored file from its name (also works on copies that kept the file name)."""
+        name = Path(str(path)).name.split(".")[0]
+        digest = name[:-len("_thumb")] if name.endswith("_thumb") else name
+        return digest if len(digest) == 64 else None
+
+    def _save(self, image, path):
+        tmp = path.with_name(path.name + ".tmp")
+        if self.fmt == "webp":
+            image.save(tmp, format="WEBP", quality=90, method=2) # method 2: fast encode, near-default size
+        else:
+            image.save(tmp, format="PNG", compress_level=1)
+        tmp.replace(path)
+
+    def put(self, image, session_id=None):
+        """Stores image (if new) and counts a reference from session_id. Returns its digest."""
+        digest = self.digest(image)
+        full, thumb = self.full_path(digest), self.thumbnail_path(digest)
+        # Under the lock, so a concurrent release_session cannot delete files we just referenced
+        with self._lock, self._db:
+            if not full.exists():
+                full.parent.mkdir(exist_ok=True)
+                self._save(image, full)
+            if not thumb.exists():
+                small = image.copy()
+                small.thumbnail((self.thumb_size, self.thumb_size))
+                self._save(small, thumb)
+            if session_id:
+                self._db.execute(
+                    "INSERT INTO refs VALUES (?, ?, 1) ON CONFLICT (digest, session_id) DO UPDATE SET count = count + 1",
+                    (digest, session_id)
+                )
+            else:
+                self._db.execute("INSERT OR REPLACE INTO unowned VALUES (?, ?)", (digest, time.time()))
+        return digest
+
+    def _unreferenced(self, digests):
+        # Caller holds self._lock
+        return [
+            d for d in digests
+            if not self._db.execute("SELECT 1 FROM refs WHERE digest = ? LIMIT 1", (d,)).fetchone()
+            and not self._db.execute("SELECT 1 FROM unowned WHERE digest = ?", (d,)).fetchone()
+        ]
+
+    def _delete(self, digests):
+        for d in digests:
+            self.full_path(d).unlink(missing_ok=True)
+            self.thumbnail_path(d).unlink(missing_ok=True)
+
+    def release_session(self, session_id):
+        """Drops all references held by session_id and deletes images left unreferenced. Returns how many."""
+        with self._lock, self._db:
+            digests = [r[0] for r in self._db.execute("SELECT digest FROM refs WHERE session_id = ?", (session_id,))]
+            self._db.execute("DELETE FROM refs WHERE session_id = ?", (session_id,))
+            orphans = self._unreferenced(digests)
+            self._delete(orphans)
+        return len(orphans)
+
+    def sweep_unowned(self, max_age=86400):
+        """Deletes images stored without a session more than max_age seconds ago that no session references. Returns how many."""
+        with self._lock, self._db:
+            cutoff = time.time() - max_age
+            digests = [r[0] for r in self._db.execute("SELECT digest FROM unowned WHERE added <= ?", (cutoff,))]
+            self._db.execute("DELETE FROM unowned WHERE added <= ?", (cutoff,))
+            orphans = self._unreferenced(digests)
+            self._delete(orphans)
+        return len(orphans)
+
+    def stats(self):
+        with self._lock:
+            images, refs = self._db.execute("SELECT COUNT(DISTINCT digest), COALESCE(SUM(count), 0) FROM refs").fetchone()
+        return {"images": images, "references": refs}
@@ -0,0 +1,40 @@
+import math
+
+def tile_starts(size, tile, overlap):
+    """Offsets of tiles of length tile covering size, spread evenly so neighbours overlap by at least overlap."""
+    if size <= tile:
+        return [0]
+    n = math.ceil((size - overlap) / (tile - overlap))
+    return [round(i * (size - tile) / (n - 1)) for i in range(n)]
+
+def tile_boxes(width, height, tile, overlap):
+    """(left, top, right, bottom) boxes of at most tile x tile covering a width x height image, row by row."""
+    return [
+        (x, y, min(x + tile, width), min(y + tile, height))
+        for y in tile_starts(height, tile, overlap)
+        for x in tile_starts(width, tile, overlap)
+    ]
+
+def feather(length, overlap, fade_start, fade_end):
+    """
+    Blend weights along one side of a tile: linear ramps over the first/last overlap
+    pixels on sides shared with a neighbour, 1 elsewhere. Never 0, so dividing the
+    weighted sum of all tiles by the summed weights is always defined, and the result
+    is continuous across tile borders (no seams).
+    """
+    weights = []
+    for i in range(length):
+        w = 1.0
+        if fade_start:
+            w = min(w, (i + 0.5) / overlap)
+        if fade_end:
+            w = min(w, (length - i - 0.5) / overlap)
+        weights.append(w)
+    return weights
+
+def base_size(width, height, native):
+    """Size of the first pass for a width x height image: same aspect ratio, at most native x native pixels."""
+    if width * height <= native * native:
+        return width, height
+    scale = native / math.sqrt(width * height)
+    return max(64, int(width * scale) // 8 * 8), max(64, int(height * scale) // 8 * 8)
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+def total_ram_mb():
+    """Physical RAM in MB, or None if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().total // 1024**2
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def process_rss_mb():
+    """Resident memory of this process in MB, or None if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024**2
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class PeakMemory:
+    """
+    Context manager that samples the process's resident memory in a background thread,
+    for peaks the allocator does not report (CPU inference). start_mb and peak_mb are
+    None where RSS cannot be read.
+    """
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = process_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_mb = process_rss_mb()
+        self.peak_mb = self.start_mb
+        self._thread = threading.Thread(target=self._run, daemon=True, name="peak-memory")
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+class Allocation:
+    def __init__(self, name, owner, device, estimate_mb, release, offload=None):
+        self.name = name
+        self.owner = owner # Engine that holds it: "text", "image", "stt"
+        self.device = device # "ram" or "vram"
+        self.estimate_mb = estimate_mb
+        self.measured_mb = None
+        self.release = release # () -> bool, frees the model; False if it is busy
+        self.offload = offload # () -> bool, moves it from VRAM to RAM; None if unsupported
+        self.offloaded = False
+        self.users = 0
+        self.last_used = time.time()
+
+    @property
+    def size_mb(self):
+        return self.measured_mb if self.measured_mb is not None else self.estimate_mb
+
+class MemoryGovernor:
+    """
+    One RAM/VRAM budget shared by every engine. Engines reserve() before loading a
+    model, passing callbacks that free (or offload) it; to make room the governor
+    asks the least recently used idle models of any engine to give memory back.
+    On VRAM, models that can be offloaded to system RAM are offloaded before anything
+    is unloaded. Pinned models (use()) are never touched.
+    """
+    def __init__(self, ram_budget_mb=None, vram_budget_mb=None, offload_first=True):
+        self.budgets = {"ram": ram_budget_mb, "vram": vram_budget_mb}
+        self.offload_first = offload_first
+        self.evictions = 0
+        self.offloads = 0
+        self._allocs = {}
+        self._lock = threading.Lock()
+
+    def used(self, device):
+        with self._lock:
+            return sum(a.size_mb for a in self._allocs.values() if a.device == device)
+
+    def reserve(self, name, owner, device, estimate_mb, release, offload=None):
+        """
+        Registers a model that is about to be loaded and frees idle models until it fits.
+        Returns False if it could not be made to fit (the caller may still load it).
+        """
+        with self._lock:
+            self._allocs.pop(name, None)
+        fits = self._make_room(device, estimate_mb or 0, exclude=name)
+        with self._lock:
+            self._allocs[name] = Allocation(name, owner, device, estimate_mb or 0, release, offload)
+        if not fits:
+            print(f"Memory governor: {name} ({estimate_mb} MB) exceeds the {device} budget, loading anyway.")
+        return fits
+
+    def measured(self, name, size_mb):
+        """Replaces the estimate with the size the engine measured after loading."""
+        with self._lock:
+            alloc = self._allocs.get(name)
+            if alloc:
+                alloc.measured_mb = size_mb
+
+    def release(self, name):
+        """The engine freed the model itself (or the load failed)."""
+        with self._lock:
+            self._allocs.pop(name, None)
+
+    @contextmanager
+    def use(self, name):
+        """Pins name against eviction for the duration of the block."""
+        with self._lock:
+            alloc = self._allocs.get(name)
+            if alloc:
+                alloc.users += 1
+                alloc.last_used = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if alloc:
+                    alloc.users -= 1
+                    alloc.last_used = time.time()
+
+    def touch(self, name):
+        with self._lock:
+            alloc = self._allocs.get(name)
+            if alloc:
+                alloc.last_used = time.time()
+
+    def _make_room(self, device, needed_mb, exclude=None):
+        budget = self.budgets.get(device)
+        if not budget:
+            return True
+        tried = set()
+        while True:
+            with self._lock:
+                used = sum(a.size_mb for a in self._allocs.values() if a.device == device)
+                if used + needed_mb <= budget:
+                    return True
+                idle = sorted(
+                    (a for a in self._allocs.values()
+                     if a.device == device and a.users == 0 and a.name != exclude and a.name not in tried),
+                    key=lambda a: a.last_used
+                )
+                if not idle:
+                    return False
+                victim = idle[0]
+                tried.add(victim.name)
+
+            # Callbacks run without the lock: engines call back into release()
+            if device == "vram" and self.offload_first and victim.offload and not victim.offloaded:
+                if victim.offload():
+                    with self._lock:
+                        victim.device = "ram"
+                        victim.offloaded = True
+                    self.offloads += 1
+                    print(f"Memory governor: offloaded {victim.name} to system RAM.")
+                    continue
+            if victim.release():
+                self.release(victim.name)
+                self.evictions += 1
+                print(f"Memory governor: unloaded {victim.name}.")
+
+    def status(self):
+        with self._lock:
+            allocs = [
+                {
+                    "name": a.name,
+                    "owner": a.owner,
+                    "device": a.device,
+                    "size_mb": round(a.size_mb),
+                    "measured": a.measured_mb is not None,
+                    "offloaded": a.offloaded,
+                    "in_use": a.users > 0
+                }
+                for a in sorted(self._allocs.values(), key=lambda a: -a.last_used)
+            ]
+            used = {d: round(sum(a["size_mb"] for a in allocs if a["device"] == d)) for d in ("ram", "vram")}
+        return {"budgets": dict(self.budgets), "used": used, "models": allocs,
+                "evictions": self.evictions, "offloads": self.offloads}
@@ -0,0 +1,235 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+# GGUF metadata value types
+_FIXED = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_STRING, _ARRAY = 8, 9
+
+# Bump when read_gguf_metadata returns new fields, so old catalogs get re-parsed
+CATALOG_VERSION = 2
+
+# llama_ftype values stored in general.file_type
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16"
+}
+
+def read_gguf_metadata(path):
+    """
+    Reads the metadata section of a GGUF file through a memory map. Only the header
+    pages are touched; tensor data is never read. Arrays (e.g. the tokenizer vocab)
+    are skipped and recorded by length only.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:4] != b"GGUF":
+            raise ValueError("not a GGUF file")
+        version = struct.unpack_from("<I", mm, 4)[0]
+        # GGUF v1 used 32-bit counts and lengths, v2+ use 64-bit
+        count_fmt = "<I" if version == 1 else "<Q"
+        count_size = struct.calcsize(count_fmt)
+        n_tensors, n_kv = struct.unpack_from("<" + count_fmt[1] * 2, mm, 8)
+        pos = 8 + 2 * count_size
+
+        def read_str(pos):
+            n = struct.unpack_from(count_fmt, mm, pos)[0]
+            pos += count_size
+            return mm[pos:pos + n].decode("utf-8", errors="replace"), pos + n
+
+        def skip_value(vtype, pos):
+            if vtype in _FIXED:
+                return pos + struct.calcsize(_FIXED[vtype])
+            if vtype == _STRING:
+                return pos + count_size + struct.unpack_from(count_fmt, mm, pos)[0]
+            raise ValueError(f"unknown GGUF value type {vtype}")
+
+        kv = {}
+        for _ in range(n_kv):
+            key, pos = read_str(pos)
+            vtype = struct.unpack_from("<I", mm, pos)[0]
+            pos += 4
+            if vtype == _ARRAY:
+                item_type = struct.unpack_from("<I", mm, pos)[0]
+                n = struct.unpack_from(count_fmt, mm, pos + 4)[0]
+                pos += 4 + count_size
+                if item_type in _FIXED:
+                    pos += n * struct.calcsize(_FIXED[item_type])
+                else:
+                    for _ in range(n):
+                        pos = skip_value(item_type, pos)
+                kv[key] = {"array_length": n}
+            elif vtype == _STRING:
+                kv[key], pos = read_str(pos)
+            else:
+                kv[key] = struct.unpack_from(_FIXED[vtype], mm, pos)[0]
+                pos = skip_value(vtype, pos)
+
+        # Tensor infos follow the metadata; summing their shapes gives the exact parameter count
+        n_params = 0
+        for _ in range(n_tensors):
+            _, pos = read_str(pos)
+            n_dims = struct.unpack_from("<I", mm, pos)[0]
+            pos += 4
+            dims = struct.unpack_from(f"<{n_dims}{count_fmt[1]}", mm, pos)
+            pos += n_dims * count_size + 4 + 8 # dims, type, offset
+            count = 1
+            for d in dims:
+                count *= d
+            n_params += count
+
+    arch = kv.get("general.architecture", "unknown")
+    tokens = kv.get("tokenizer.ggml.tokens")
+    return {
+        "architecture": arch,
+        "name": kv.get("general.name"),
+        "parameters": n_params,
+        "quantization": FILE_TYPES.get(kv.get("general.file_type"), "unknown"),
+        "context_length": kv.get(f"{arch}.context_length"),
+        "layers": kv.get(f"{arch}.block_count"),
+        "chat_template": kv.get("tokenizer.chat_template"),
+        "tokenizer": kv.get("tokenizer.ggml.model"),
+        "vocab_size": tokens["array_length"] if isinstance(tokens, dict) else None,
+        "bos_token_id": kv.get("tokenizer.ggml.bos_token_id"),
+        "eos_token_id": kv.get("tokenizer.ggml.eos_token_id"),
+        "gguf_version": version
+    }
+
+class ModelCatalog:
+    """
+    On-disk index of model files and their header metadata (GGUF by default; pass
+    extension and reader for other formats).
+
+    A directory is only re-listed when its own mtime or one of its model files changes,
+    and a file's header is only re-parsed when its (path, size, mtime) changes, so
+    refreshing a slow network share costs one stat per directory and model file.
+
+    Keep catalog_path outside the scanned directories (e.g. in a hidden subfolder):
+    each save replaces the file, which changes the mtime of the directory holding it.
+    """
+    def __init__(self, catalog_path, min_interval=2.0, extension=".gguf", reader=read_gguf_metadata):
+        self.catalog_path = Path(catalog_path)
+        self.min_interval = min_interval # Refresh calls closer together than this reuse the last scan
+        self.extension = extension
+        self.reader = reader
+        self._lock = threading.Lock()
+        self._last_refresh = 0
+        self._last_dirs = None
+        self._data = self._load()
+        try:
+            # Created up front: a folder appearing later would change the parent's mtime after its scan
+            self.catalog_path.parent.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            pass
+
+    def _load(self):
+        try:
+            with open(self.catalog_path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == CATALOG_VERSION:
+                return data
+        except Exception:
+            pass
+        return {"version": CATALOG_VERSION, "dirs": {}, "models": {}}
+
+    def _save(self):
+        tmp = self.catalog_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._data, f)
+        os.replace(tmp, self.catalog_path)
+
+    def refresh(self, dirs, force=False):
+        """Returns {file name: entry} for all model files in dirs, in dir order."""
+        dirs = [str(d) for d in dirs]
+        with self._lock:
+            now = time.time()
+            if not force and dirs == self._last_dirs and now - self._last_refresh < self.min_interval:
+                return self._entries(dirs)
+
+            changed = False
+            for d in dirs:
+                changed |= self._refresh_dir(d, force)
+            if changed:
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"Could not save model catalog: {e}")
+
+            self._last_refresh = now
+            self._last_dirs = dirs
+            return self._entries(dirs)
+
+    def _refresh_dir(self, d, force):
+        try:
+            dir_mtime = os.stat(d).st_mtime
+        except OSError:
+            # Unreachable share or removed dir: keep nothing from it this round
+            return self._data["dirs"].pop(d, None) is not None
+
+        cached = self._data["dirs"].get(d)
+        if cached and cached["mtime"] == dir_mtime and not force and not self._files_changed(cached["files"]):
+            return False
+
+        files = []
+        with os.scandir(d) as it:
+            for e in it:
+                if not e.name.lower().endswith(self.extension) or not e.is_file():
+                    continue
+                st = e.stat() # Comes with the listing on Windows, no extra round trip
+                path = os.path.join(d, e.name)
+                files.append(path)
+                entry = self._data["models"].get(path)
+                if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                    continue
+                try:
+                    meta = self.reader(path)
+                except Exception as ex:
+                    meta = {"error": str(ex)}
+                self._data["models"][path] = {"size": st.st_size, "mtime": st.st_mtime, "meta": meta}
+
+        # Forget files that disappeared from this dir
+        old_files = set(cached["files"]) if cached else set()
+        for path in old_files - set(files):
+            self._data["models"].pop(path, None)
+
+        self._data["dirs"][d] = {"mtime": dir_mtime, "files": sorted(files)}
+        return True
+
+    def _files_changed(self, paths):
+        # A file rewritten or still growing in place (e.g. a download) leaves the dir mtime alone
+        for path in paths:
+            entry = self._data["models"].get(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                return True
+            if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+                return True
+        return False
+
+    def update_meta(self, path, updates):
+        """Adds fields computed later (e.g. content hashes) to a file's metadata; dropped when the file changes."""
+        with self._lock:
+            entry = self._data["models"].get(str(path))
+            if not entry:
+                return
+            entry["meta"].update(updates)
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Could not save model catalog: {e}")
+
+    def _entries(self, dirs):
+        result = {}
+        for d in dirs:
+            for path in self._data["dirs"].get(d, {}).get("files", []):
+                entry = self._data["models"].get(path)
+                if entry:
+                    result[os.path.basename(path)] = dict(entry, path=path)
+        return result
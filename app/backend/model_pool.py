@@ -0,0 +1,193 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class PoolEntry:
+    def __init__(self, name, size_mb, device):
+        self.name = name
+        self.size_mb = size_mb
+        self.device = device # "ram" or "vram", the budget this model counts against
+        self.model = None
+        self.status = "loading" # loading -> ready | error
+        self.error = None
+        self.warning = None # e.g. loaded over budget because nothing idle could be evicted
+        self.users = 0 # Active generations; in-use models are never evicted
+        self.started = time.time()
+        self.load_seconds = None
+        self.ready = threading.Event()
+
+class ModelPool:
+    """
+    Keeps several loaded models resident, keyed by name, within RAM/VRAM budgets.
+    Loads run on background threads; callers wait on the entry they need.
+    Least recently used idle models are evicted (and explicitly freed) to make room.
+    With a MemoryGovernor, loads are also reserved against the budget shared with
+    the other engines, which may evict pool models that sit idle.
+    """
+    def __init__(self, max_models=2, ram_budget_mb=None, vram_budget_mb=None, on_evict=None, governor=None):
+        self.max_models = max_models
+        self.budgets = {"ram": ram_budget_mb, "vram": vram_budget_mb}
+        self.on_evict = on_evict
+        self.governor = governor
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_async(self, name, loader, size_mb=0, device="ram"):
+        """Starts loading name with loader() unless it is already resident or loading."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry.status != "error":
+                self._entries.move_to_end(name)
+                return entry
+            entry = PoolEntry(name, size_mb, device)
+            self._entries[name] = entry
+
+        def worker():
+            self._make_room(entry)
+            if self.governor:
+                self.governor.reserve(self._alloc_name(name), "text", device, size_mb, release=lambda: self.evict(name))
+            try:
+                model = loader()
+                entry.model = model
+                entry.status = "ready"
+            except Exception as e:
+                entry.error = str(e)
+                entry.status = "error"
+                if self.governor:
+                    self.governor.release(self._alloc_name(name))
+            entry.load_seconds = time.time() - entry.started
+            entry.ready.set()
+
+        threading.Thread(target=worker, name=f"load-{name}", daemon=True).start()
+        return entry
+
+    def put(self, name, model, size_mb=0, device="ram"):
+        """Registers an already loaded model."""
+        entry = PoolEntry(name, size_mb, device)
+        entry.model = model
+        entry.status = "ready"
+        entry.load_seconds = 0
+        entry.ready.set()
+        with self._lock:
+            old = self._entries.pop(name, None)
+            self._entries[name] = entry
+        if old and old.model is not model:
+            self._free(old)
+        if self.governor:
+            self.governor.reserve(self._alloc_name(name), "text", device, size_mb, release=lambda: self.evict(name))
+        return entry
+
+    @staticmethod
+    def _alloc_name(name):
+        return f"text:{name}"
+
+    def get(self, name, timeout=None):
+        """Returns the model, waiting while it loads. None if unknown, failed or timed out."""
+        entry = self._entries.get(name)
+        if not entry or not entry.ready.wait(timeout):
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return entry.model
+
+    def peek(self, name):
+        """Returns the model only if it is ready, without waiting."""
+        entry = self._entries.get(name)
+        return entry.model if entry and entry.status == "ready" else None
+
+    @contextmanager
+    def use(self, name, timeout=None):
+        """Waits for name and pins it against eviction for the duration of the block."""
+        entry = self._entries.get(name)
+        if not entry or not entry.ready.wait(timeout):
+            yield None
+            return
+        with self._lock:
+            # Look up and pin in one step: an eviction in between would free the model under us
+            entry = self._entries.get(name)
+            model = entry.model if entry and entry.status == "ready" else None
+            if model is None:
+                entry = None
+            else:
+                entry.users += 1
+                self._entries.move_to_end(name)
+        if entry is None:
+            yield None
+            return
+        if self.governor:
+            self.governor.touch(self._alloc_name(name))
+        try:
+            yield model
+        finally:
+            with self._lock:
+                entry.users -= 1
+
+    def entry(self, name):
+        return self._entries.get(name)
+
+    def evict(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if not entry or entry.users > 0 or entry.status == "loading":
+                return False
+            del self._entries[name]
+        self._free(entry)
+        return True
+
+    def _used(self, device, exclude):
+        return sum(e.size_mb for e in self._entries.values() if e.device == device and e is not exclude)
+
+    def _make_room(self, new_entry):
+        budget = self.budgets.get(new_entry.device)
+        while True:
+            with self._lock:
+                others = [e for e in self._entries.values() if e is not new_entry]
+                over_count = self.max_models and len(others) >= self.max_models
+                over_budget = budget and self._used(new_entry.device, new_entry) + new_entry.size_mb > budget
+                if not (over_count or over_budget):
+                    return
+                # Oldest idle model first; for a budget overflow it must share the device
+                victim = next((e for e in others if e.users == 0 and e.status != "loading"
+                               and (over_count or e.device == new_entry.device)), None)
+                if victim is None:
+                    new_entry.warning = "loaded over budget, no idle model to evict"
+                    return
+                del self._entries[victim.name]
+            self._free(victim)
+
+    def _free(self, entry):
+        model, entry.model = entry.model, None
+        entry.status = "evicted"
+        if model is not None:
+            # Release llama.cpp buffers now instead of whenever the GC gets to them
+            close = getattr(model, "close", None)
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass
+            del model
+            gc.collect()
+        if self.governor:
+            self.governor.release(self._alloc_name(entry.name))
+        if self.on_evict:
+            self.on_evict(entry.name)
+
+    def status(self):
+        with self._lock:
+            return [
+                {
+                    "name": e.name,
+                    "status": e.status,
+                    "device": e.device,
+                    "size_mb": e.size_mb,
+                    "users": e.users,
+                    "seconds": round(e.load_seconds if e.load_seconds is not None else time.time() - e.started, 1),
+                    "error": e.error,
+                    "warning": e.warning
+                }
+                for e in self._entries.values()
+            ]
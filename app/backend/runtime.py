@@ -0,0 +1,80 @@
+import importlib
+import os
+
+from app.backend.text_engine import TextEngine
+from app.backend.session_manager import SessionManager
+from app.backend.image_store import ImageStore
+from app.backend.memory_governor import MemoryGovernor, total_ram_mb
+from app.backend.context_manager import ContextManager
+from app.backend.scheduler import GenerationScheduler
+
+def _load(module, name, optional):
+    """Imports app.backend.<module>.<name>; None instead of ImportError when optional."""
+    try:
+        return getattr(importlib.import_module("app.backend." + module), name)
+    except ImportError:
+        if not optional:
+            raise
+        return None
+
+def _vram_mb():
+    """Total VRAM in MB of the first CUDA device, or None without one (or without torch)."""
+    try:
+        from app.backend.hardware import get_device_info
+    except ImportError:
+        return None
+    hw = get_device_info()
+    return hw["vram"] * 1024 if hw["device"] == "cuda" else None
+
+class Runtime:
+    """
+    The engines and shared services the Gradio UI (main.py) and the API server (server.py)
+    both run on, built from one config so the two entry points cannot drift apart.
+
+    With optional_engines=True a missing image or STT stack leaves image_engine or
+    stt_engine None instead of failing, which is what a text-only server wants.
+    """
+    def __init__(self, config, optional_engines=False):
+        self.config = config
+        self.models_root = config.get_nested(["paths", "models_root"], "models")
+        custom_paths = config.get("custom_model_paths", [])
+
+        # One RAM/VRAM budget for all engines: idle models of one modality make room for another
+        ram = total_ram_mb()
+        vram = _vram_mb()
+        self.governor = MemoryGovernor(
+            ram_budget_mb=config.get_nested(["memory", "ram_budget_mb"]) or (int(ram * 0.75) if ram else None),
+            vram_budget_mb=config.get_nested(["memory", "vram_budget_mb"]) or (int(vram * 0.9) if vram else None),
+            offload_first=config.get_nested(["memory", "offload_first"], True)
+        )
+
+        self.text_engine = TextEngine(os.path.join(self.models_root, "llm"), custom_paths, config, governor=self.governor)
+        ImageEngine = _load("image_engine", "ImageEngine", optional_engines)
+        self.image_engine = ImageEngine(os.path.join(self.models_root, "image"), config=config, governor=self.governor) if ImageEngine else None
+        if self.image_engine and config.get_nested(["image", "warmup"], False):
+            # Opt-in: load (and pre-run) the image pipeline now, so the first "draw" request does not pay for it
+            self.image_engine.warm_up_async()
+        STTEngine = _load("stt_engine", "STTEngine", optional_engines)
+        self.stt_engine = STTEngine(os.path.join(self.models_root, "stt"), governor=self.governor) if STTEngine else None
+
+        # Generated images: stored once by content hash, shown as thumbnails, freed with their last session
+        self.image_store = ImageStore(
+            config.get_nested(["paths", "image_store"], "app/image_store"),
+            fmt=config.get_nested(["image", "store_format"], "webp")
+        )
+        self.session_manager = SessionManager(
+            cache_size=config.get_nested(["sessions", "cache_size"], 32),
+            flush_delay=config.get_nested(["sessions", "flush_delay"], 2.0), # Seconds a finished turn may sit in memory
+            image_store=self.image_store
+        )
+        # All LLM generations go through the scheduler: bounded queue, fair across sessions, one worker per replica
+        self.scheduler = GenerationScheduler(
+            replicas=self.text_engine.replicas,
+            max_queue=config.get_nested(["text", "max_queue"], 32)
+        )
+        self.context_manager = ContextManager(
+            self.text_engine,
+            budget=config.get_nested(["text", "context_budget"]),
+            summarize=config.get_nested(["text", "summarize_history"], True),
+            scheduler=self.scheduler
+        )
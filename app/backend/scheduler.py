@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+_DONE = object()
+
+class Job:
+    def __init__(self, fn, session_key):
+        self.fn = fn # fn(replica) -> iterator of results
+        self.session_key = session_key
+        self.submitted = time.time()
+        self.started = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.results = queue.Queue()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def stream(self, cancel_event=None):
+        """Yields the job's results as the worker produces them."""
+        try:
+            while True:
+                try:
+                    item = self.results.get(timeout=0.1)
+                except queue.Empty:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Whoever stops listening also stops the work
+            self.cancel()
+
+class GenerationScheduler:
+    """
+    Runs generation jobs on a fixed set of workers, one per model replica.
+    Pending jobs are kept per session and served round-robin, so one busy session
+    cannot starve the others. The queue is bounded; submit() returns None when full.
+    Low-priority jobs (e.g. chat titles) have their own small queue and only run
+    when no normal job is waiting.
+    """
+    def __init__(self, replicas=1, max_queue=32, max_low_queue=8):
+        self.replicas = replicas
+        self.max_queue = max_queue
+        self.max_low_queue = max_low_queue
+        self._pending = OrderedDict() # session key -> deque of jobs
+        self._low = deque()
+        self._cond = threading.Condition()
+        self.running = 0
+        self.served = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=200) # Recent queue wait times in seconds
+
+        for replica in range(replicas):
+            threading.Thread(target=self._worker, args=(replica,), name=f"gen-worker-{replica}", daemon=True).start()
+
+    def depth(self):
+        return sum(len(q) for q in self._pending.values())
+
+    def submit(self, fn, session_key=None, priority="normal"):
+        job = Job(fn, session_key)
+        with self._cond:
+            if priority == "low":
+                if len(self._low) >= self.max_low_queue:
+                    self.rejected += 1
+                    return None
+                self._low.append(job)
+            else:
+                if self.depth() >= self.max_queue:
+                    self.rejected += 1
+                    return None
+                self._pending.setdefault(session_key, deque()).append(job)
+            self._cond.notify()
+        return job
+
+    def _next_job(self):
+        # Round-robin: take the oldest job of the first session, then send that session to the back
+        while self._pending:
+            key, jobs = next(iter(self._pending.items()))
+            job = jobs.popleft()
+            del self._pending[key]
+            if jobs:
+                self._pending[key] = jobs
+            if not job.cancelled.is_set():
+                return job
+        while self._low:
+            job = self._low.popleft()
+            if not job.cancelled.is_set():
+                return job
+        return None
+
+    def _worker(self, replica):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self.running += 1
+
+            job.started = time.time()
+            self.waits.append(job.started - job.submitted)
+            results = None
+            try:
+                results = job.fn(replica)
+                for item in results:
+                    if job.cancelled.is_set():
+                        break
+                    job.results.put(item)
+            except Exception as e:
+                job.results.put(e)
+            finally:
+                close = getattr(results, "close", None)
+                if close:
+                    close()
+                job.results.put(_DONE)
+                job.done.set()
+                with self._cond:
+                    self.running -= 1
+                    self.served += 1
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self.waits)
+            return {
+                "replicas": self.replicas,
+                "queue_depth": self.depth(),
+                "low_queue_depth": len(self._low),
+                "running": self.running,
+                "served": self.served,
+                "rejected": self.rejected,
+                "avg_wait": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p95_wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0
+            }
@@ -1,12 +1,194 @@
+import atexit
+import copy
 import json
+import os
+import sqlite3
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime
 
+# Columns list_sessions may sort by
+SORT_COLUMNS = ("created_at", "updated_at", "title")
+
+# Search rows: one per turn, plus the title under this turn number
+TITLE_TURN = -1
+# Top matching turns considered per result; bounds the work for very common words
+ROWS_PER_HIT = 50
+
+def turn_text(turn):
+    """Searchable text of a [user, assistant] turn; image entries contribute their caption."""
+    parts = []
+    for msg in turn:
+        if isinstance(msg, str):
+            parts.append(msg)
+        elif isinstance(msg, (list, tuple)) and len(msg) > 1 and isinstance(msg[1], str):
+            parts.append(msg[1])
+    return "\n".join(parts)
+
+def json_patch(old, new, path):
+    """
+    Operations turning old into new: nested dicts are compared key by key and a list
+    that only grew is extended, so a record carries what changed, not the whole value.
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict) and old.keys() <= new.keys():
+        ops = []
+        for k, v in new.items():
+            ops += json_patch(old[k], v, path + [k]) if k in old else [{"path": path + [k], "set": v}]
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(new) > len(old) and new[:len(old)] == old:
+        return [{"path": path, "extend": new[len(old):]}]
+    return [{"path": path, "set": new}]
+
+def apply_patch(data, ops):
+    for op in ops:
+        *parents, last = op["path"]
+        target = data
+        for k in parents:
+            target = target[k]
+        if "extend" in op:
+            target[last].extend(op["extend"])
+        else:
+            target[last] = op["set"]
+
+class CachedSession:
+    def __init__(self, data, seq, records):
+        self.data = data
+        self.seq = seq # Last record applied to data
+        self.records = records # Records in the on-disk journal
+        self.pending = [] # Serialized records not yet on disk
+        self.dirty_since = None
+
 class SessionManager:
-    def __init__(self, sessions_dir="app/sessions"):
+    """
+    Sessions are stored as a JSON snapshot ({id}.json) plus an append-only journal
+    ({id}.jsonl). Each update appends one fsync'd line with only what changed (new turns,
+    changed fields, and for dict fields such as "context" only the changed keys); every
+    compact_every records the journal is folded into a fresh snapshot. Records carry
+    sequence numbers, so a crash during compaction never applies a record twice, and
+    a torn last line from a crash mid-append is dropped on the next read.
+
+    Recently used sessions stay in memory (write-back). Updates change the cached copy
+    and queue their journal record; a background thread writes each dirty session at
+    most flush_delay seconds later, in one append and one fsync. flush_delay is the
+    durability window: 0 writes through on every update. Everything is flushed at exit.
+    """
+    def __init__(self, sessions_dir="app/sessions", compact_every=50, cache_size=32, flush_delay=2.0, image_store=None):
         self.sessions_dir = Path(sessions_dir)
+        self.image_store = image_store # Images are released with the session that references them
         self.sessions_dir.mkdir(parents=True, exist_ok=True)
+        self.compact_every = compact_every
+        self.cache_size = cache_size
+        self.flush_delay = flush_delay
+        self._cache = OrderedDict() # session id -> CachedSession, most recently used last
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock() # Keeps journal appends for a session in seq order
+        self._dirty = threading.Condition(self._lock)
+        self._flusher = None
+        atexit.register(self.flush)
+
+        # Metadata index (id, title, dates, turn count) so listing never opens session files
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(self.sessions_dir / "index.db", check_same_thread=False)
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, title TEXT, created_at TEXT, updated_at TEXT, turns INTEGER)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_at)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            # Full-text search: turn text lives in `turns`, FTS5 indexes it through triggers.
+            # SQLite builds without FTS5 fall back to LIKE scans over `turns`.
+            self._db.execute("CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY, session_id TEXT, turn INTEGER, content TEXT)")
+            self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS turns_session ON turns (session_id, turn)")
+            try:
+                self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(content, content='turns', content_rowid='id', prefix='2 3')")
+                self._db.execute(
+                    "CREATE TRIGGER IF NOT EXISTS turns_ai AFTER INSERT ON turns BEGIN "
+                    "INSERT INTO turns_fts (rowid, content) VALUES (new.id, new.content); END"
+                )
+                self._db.execute(
+                    "CREATE TRIGGER IF NOT EXISTS turns_ad AFTER DELETE ON turns BEGIN "
+                    "INSERT INTO turns_fts (turns_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+                )
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+        self._migrate()
+        self._migrate_search()
+
+    def _migrate(self):
+        """One-time import of session files written before the index existed."""
+        with self._db_lock:
+            done = self._db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        if done:
+            return
+        count = 0
+        for f in self.sessions_dir.glob("*.json"):
+            try:
+                self._index(self._load(f.stem)[0])
+                count += 1
+            except Exception as e:
+                print(f"Skipping unreadable session file {f.name}: {e}")
+        with self._db_lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', ?)", (datetime.now().isoformat(),))
+        if count:
+            print(f"Indexed {count} existing sessions.")
+
+    def _migrate_search(self):
+        """One-time build of the search index for sessions stored before search existed."""
+        with self._db_lock:
+            done = self._db.execute("SELECT value FROM meta WHERE key = 'search_indexed'").fetchone()
+            ids = [r[0] for r in self._db.execute("SELECT id FROM sessions").fetchall()]
+        if done:
+            return
+        for session_id in ids:
+            try:
+                loaded = self._load(session_id)
+                if loaded:
+                    self._index_text(session_id, loaded[0], 0, True)
+            except Exception as e:
+                print(f"Skipping unreadable session {session_id}: {e}")
+        with self._db_lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('search_indexed', ?)", (datetime.now().isoformat(),))
+
+    def _index(self, data):
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (id, title, created_at, updated_at, turns) VALUES (?, ?, ?, ?, ?)",
+                (
+                    data["id"],
+                    data.get("title", "Untitled"),
+                    data.get("created_at", ""),
+                    data.get("updated_at", data.get("created_at", "")),
+                    len(data.get("history", []))
+                )
+            )
+
+    def _index_text(self, session_id, data, start, title_changed):
+        """Replaces the search rows for turns from start on, and the title row if it changed."""
+        history = data.get("history", [])
+        with self._db_lock, self._db:
+            if start is not None:
+                self._db.execute("DELETE FROM turns WHERE session_id = ? AND turn >= ?", (session_id, start))
+                self._db.executemany(
+                    "INSERT INTO turns (session_id, turn, content) VALUES (?, ?, ?)",
+                    [(session_id, i, turn_text(turn)) for i, turn in enumerate(history[start:], start)]
+                )
+            if title_changed:
+                self._db.execute("DELETE FROM turns WHERE session_id = ? AND turn = ?", (session_id, TITLE_TURN))
+                self._db.execute(
+                    "INSERT INTO turns (session_id, turn, content) VALUES (?, ?, ?)",
+                    (session_id, TITLE_TURN, data.get("title", ""))
+                )
 
     def create_session(self, title="New Chat"):
         session_id = str(uuid.uuid4())
@@ -16,58 +198,344 @@ class SessionManager:
             "created_at": datetime.now().isoformat(),
             "history": []
         }
-        self._save_session(session_id, session_data)
+        self._write_snapshot(session_id, json.dumps(dict(session_data, _seq=0), indent=2))
+        self._index(session_data)
+        self._index_text(session_id, session_data, None, True)
+        with self._lock:
+            self._cache[session_id] = CachedSession(json.loads(json.dumps(session_data)), 0, 0)
+            self._evict(keep=session_id)
         return session_id, session_data
 
     def get_session(self, session_id):
-        path = self.sessions_dir / f"{session_id}.json"
-        if path.exists():
-            with open(path, "r") as f:
-                return json.load(f)
-        return None
-
-    def list_sessions(self):
-        sessions = []
-        for f in self.sessions_dir.glob("*.json"):
-            try:
-                with open(f, "r") as file:
-                    data = json.load(file)
-                    sessions.append({
-                        "id": data["id"],
-                        "title": data.get("title", "Untitled"),
-                        "created_at": data.get("created_at", "")
-                    })
-            except:
-                pass
-        # Sort by date desc
-        return sorted(sessions, key=lambda x: x["created_at"], reverse=True)
-
-    def update_session(self, session_id, history, title=None):
-        data = self.get_session(session_id)
-        if data:
-            data["history"] = history
-            if title:
-                data["title"] = title
-            self._save_session(session_id, data)
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry:
+                return None
+            # Callers may edit what they get back; the cache keeps its own lists and dicts
+            # (nested ones too: journal patches extend lists of the cached copy in place)
+            data = {k: (copy.deepcopy(v) if k != "history" else v) for k, v in entry.data.items()}
+            data["history"] = [list(turn) for turn in data["history"]]
+            return data
 
-    def delete_session(self, session_id):
-        path = self.sessions_dir / f"{session_id}.json"
-        if path.exists():
-            path.unlink()
+    def get_history_window(self, session_id, limit, before=None):
+        """
+        Up to limit turns ending just before turn index `before` (default: the latest
+        turns), as {turns, start, total}. start is the cursor for the next older page;
+        0 means the beginning has been reached.
+        """
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry:
+                return None
+            history = entry.data["history"]
+            end = len(history) if before is None else max(0, min(before, len(history)))
+            start = max(0, end - limit)
+            return {"turns": [list(turn) for turn in history[start:end]], "start": start, "total": len(history)}
 
-    def _save_session(self, session_id, data):
-        with open(self.sessions_dir / f"{session_id}.json", "w") as f:
-            json.dump(data, f, indent=2)
+    def _entry(self, session_id):
+        # Caller holds self._lock
+        entry = self._cache.get(session_id)
+        if entry:
+            self._cache.move_to_end(session_id)
+            return entry
+        loaded = self._load(session_id)
+        if not loaded:
+            return None
+        entry = self._cache[session_id] = CachedSession(*loaded)
+        self._evict(keep=session_id)
+        return entry
 
-    def cleanup_empty_sessions(self):
-        count = 0
-        for f in self.sessions_dir.glob("*.json"):
+    def _evict(self, keep=None):
+        # Only clean sessions leave the cache; dirty ones go once the flusher has written them.
+        # keep is the entry the caller is about to use: with every other entry dirty it would
+        # otherwise be the only candidate, and an update applied to it would be lost.
+        for session_id in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if session_id != keep and not self._cache[session_id].pending:
+                del self._cache[session_id]
+
+    def _paths(self, session_id):
+        return self.sessions_dir / f"{session_id}.json", self.sessions_dir / f"{session_id}.jsonl"
+
+    def _load(self, session_id):
+        """Snapshot + journal replay. Returns (data, last seq, journal records) or None."""
+        snapshot, journal = self._paths(session_id)
+        if not snapshot.exists():
+            return None
+        with open(snapshot, "r") as f:
+            data = json.load(f)
+        seq = data.pop("_seq", 0)
+        records = 0
+        if journal.exists():
+            good = 0
+            with open(journal, "rb") as f:
+                raw = f.read()
+            for line in raw.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break # Torn tail from a crash mid-append
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                if rec["seq"] <= seq:
+                    continue # Already folded into the snapshot
+                self._apply(data, rec)
+                seq = rec["seq"]
+                records += 1
+            if good < len(raw):
+                with open(journal, "r+b") as f:
+                    f.truncate(good)
+        return data, seq, records
+
+    @staticmethod
+    def _apply(data, rec):
+        if "at" in rec:
+            data["history"] = data["history"][:rec["at"]] + rec["turns"]
+        data.update(rec.get("set", {}))
+        apply_patch(data, rec.get("patch", []))
+
+    @staticmethod
+    def _same_turn(a, b):
+        # Gradio hands us tuples where the stored JSON has lists
+        return a == b or json.dumps(a) == json.dumps(b)
+
+    def list_sessions(self, limit=None, offset=0, order_by="created_at", descending=True):
+        """One page of session metadata from the index, newest first by default."""
+        if order_by not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort sessions by {order_by}")
+        query = (
+            f"SELECT id, title, created_at, updated_at, turns FROM sessions "
+            f"ORDER BY {order_by} {'DESC' if descending else 'ASC'} LIMIT ? OFFSET ?"
+        )
+        with self._db_lock:
+            rows = self._db.execute(query, (limit if limit is not None else -1, offset)).fetchall()
+        return [
+            {"id": r[0], "title": r[1] or "Untitled", "created_at": r[2] or "", "updated_at": r[3] or "", "turns": r[4]}
+            for r in rows
+        ]
+
+    def search_sessions(self, query, limit=20):
+        """
+        Sessions whose title or turns match every word of query, best match first, as
+        [{id, title, updated_at, turn, snippet}]. turn is the best matching turn (-1 for
+        the title); snippet is an excerpt around the match (in **bold** with FTS5).
+        """
+        words = [w.replace('"', "") for w in query.split()]
+        words = [w for w in words if w]
+        if not words:
+            return []
+        if self.fts:
+            # Each word quoted (no FTS syntax from user input) and prefix-matched
+            match = " ".join(f'"{w}"*' for w in words)
+            # FTS functions cannot run inside an aggregate, so take the top-ranked turns first
+            # (rank is bm25); the bare columns of the grouped query come from each session's best turn
+            sql = (
+                "WITH hits AS MATERIALIZED ("
+                "SELECT rowid AS id, rank FROM turns_fts WHERE turns_fts MATCH ? ORDER BY rank LIMIT ?) "
+                "SELECT t.session_id, t.turn, h.id, MIN(h.rank) AS best FROM hits h JOIN turns t ON t.id = h.id "
+                "GROUP BY t.session_id ORDER BY best LIMIT ?"
+            )
+            with self._db_lock:
+                best = self._db.execute(sql, (match, limit * ROWS_PER_HIT, limit)).fetchall()
+                # Snippets only for the rows that made the page
+                snippets = dict(self._db.execute(
+                    f"SELECT rowid, snippet(turns_fts, 0, '**', '**', '...', 12) FROM turns_fts "
+                    f"WHERE turns_fts MATCH ? AND rowid IN ({','.join('?' * len(best))})",
+                    [match] + [b[2] for b in best]
+                ).fetchall())
+            hits = [(b[0], b[1], snippets.get(b[2], "")) for b in best]
+        else:
+            hits = self._search_like(words, limit)
+
+        with self._db_lock:
+            meta = {
+                r[0]: r[1:] for r in self._db.execute(
+                    f"SELECT id, title, updated_at FROM sessions WHERE id IN ({','.join('?' * len(hits))})",
+                    [h[0] for h in hits]
+                ).fetchall()
+            }
+        return [
+            {"id": h[0], "title": meta[h[0]][0] or "Untitled", "updated_at": meta[h[0]][1] or "", "turn": h[1], "snippet": h[2]}
+            for h in hits if h[0] in meta
+        ]
+
+    def _search_like(self, words, limit):
+        # Fallback without FTS5: substring scan, newest sessions first
+        conditions = " AND ".join("t.content LIKE ? ESCAPE '\\'" for _ in words)
+        patterns = ["%" + w.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for w in words]
+        sql = (
+            f"SELECT t.session_id, MIN(t.turn), t.content FROM turns t JOIN sessions s ON s.id = t.session_id "
+            f"WHERE {conditions} GROUP BY t.session_id ORDER BY s.updated_at DESC LIMIT ?"
+        )
+        with self._db_lock:
+            rows = self._db.execute(sql, patterns + [limit]).fetchall()
+        hits = []
+        for session_id, turn, content in rows:
+            pos = content.lower().find(words[0].lower())
+            start = max(0, pos - 40)
+            snippet = ("..." if start else "") + content[start:pos + 80] + ("..." if pos + 80 < len(content) else "")
+            hits.append((session_id, turn, snippet))
+        return hits
+
+    def count_sessions(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def update_session(self, session_id, history, title=None, extra=None):
+        fields = {}
+        if title:
+            fields["title"] = title
+        if extra:
+            # Additional per-session records, e.g. cached token counts
+            fields.update(extra)
+        self._update(session_id, history, fields)
+
+    def set_title(self, session_id, title):
+        self._update(session_id, None, {"title": title})
+
+    def _update(self, session_id, history, fields):
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry:
+                return
+            data = entry.data
+            rec = {"seq": entry.seq + 1}
+
+            if history is not None:
+                # Journal only the turns that changed: usually just the new one
+                old = data["history"]
+                i = 0
+                while i < min(len(old), len(history)) and self._same_turn(old[i], history[i]):
+                    i += 1
+                if i < len(old) or i < len(history):
+                    rec["at"] = i
+                    rec["turns"] = history[i:]
+
+            changed, patch = {}, []
+            for k, v in fields.items():
+                if isinstance(data.get(k), dict) and isinstance(v, dict):
+                    # e.g. the context cache: one more token count per turn, not the whole list again
+                    patch += json_patch(data[k], v, [k])
+                elif data.get(k) != v:
+                    changed[k] = v
+            changed["updated_at"] = datetime.now().isoformat()
+            rec["set"] = changed
+            if patch:
+                rec["patch"] = patch
+
+            # Serialize once: the line is what gets written, and applying its parsed copy
+            # keeps the cache free of objects the caller still holds
+            line = json.dumps(rec)
+            self._apply(data, json.loads(line))
+            entry.seq = rec["seq"]
+            entry.pending.append(line)
+            if entry.dirty_since is None:
+                entry.dirty_since = time.time()
+                self._dirty.notify()
+            # The index row (title, turns, updated_at) and search rows are current right away
+            self._index(data)
+            self._index_text(session_id, data, rec.get("at"), "title" in changed)
+
+            if self.flush_delay > 0 and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="session-flush")
+                self._flusher.start()
+        if self.flush_delay <= 0:
+            self.flush(session_id)
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while True:
+                    due = [e.dirty_since for e in self._cache.values() if e.dirty_since is not None]
+                    if due:
+                        wait = min(due) + self.flush_delay - time.time()
+                        if wait <= 0:
+                            break
+                        self._dirty.wait(wait)
+                    else:
+                        self._dirty.wait()
             try:
-                with open(f, "r") as file:
-                    data = json.load(file)
-                    if not data.get("history"):
-                        file.unlink()
-                        count += 1
-            except:
-                pass
-        return count
+                self.flush()
+            except OSError as e:
+                print(f"Session flush failed: {e}")
+
+    def flush(self, session_id=None):
+        """Writes pending updates of one session (or all) to disk."""
+        with self._io_lock:
+            work = []
+            with self._lock:
+                ids = [session_id] if session_id else list(self._cache)
+                for sid in ids:
+                    entry = self._cache.get(sid)
+                    if not entry or not entry.pending:
+                        continue
+                    lines, entry.pending, entry.dirty_since = entry.pending, [], None
+                    if entry.records + len(lines) >= self.compact_every:
+                        entry.records = 0
+                        work.append((sid, None, json.dumps(dict(entry.data, _seq=entry.seq), indent=2)))
+                    else:
+                        entry.records += len(lines)
+                        work.append((sid, lines, None))
+            for sid, lines, snapshot in work:
+                if snapshot is not None:
+                    self._compact(sid, snapshot)
+                else:
+                    self._append(sid, lines)
+            # Only now is the disk copy current; evicting earlier would let a reload miss these records
+            if work:
+                with self._lock:
+                    self._evict()
+
+    def _append(self, session_id, lines):
+        _, journal = self._paths(session_id)
+        with open(journal, "ab") as f:
+            f.write("".join(line + "\n" for line in lines).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, session_id, text):
+        snapshot, _ = self._paths(session_id)
+        tmp = snapshot.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, snapshot)
+
+    def _compact(self, session_id, text):
+        # Snapshot first, then drop the journal; a crash in between only leaves records the seq check skips
+        self._write_snapshot(session_id, text)
+        _, journal = self._paths(session_id)
+        if journal.exists():
+            journal.unlink()
+
+    def delete_session(self, session_id):
+        with self._io_lock, self._lock:
+            self._cache.pop(session_id, None)
+            for path in self._paths(session_id):
+                if path.exists():
+                    path.unlink()
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+        if self.image_store:
+            self.image_store.release_session(session_id)
+
+    def cleanup_empty_sessions(self, max_age=86400):
+        """
+        Deletes sessions without turns that were created more than max_age seconds ago.
+        Cached sessions are kept whatever their age: a client may have one open and not
+        have sent its first message yet.
+        """
+        cutoff = datetime.fromtimestamp(time.time() - max_age).isoformat()
+        with self._db_lock:
+            empty = [r[0] for r in self._db.execute(
+                "SELECT id FROM sessions WHERE turns = 0 AND created_at <= ?", (cutoff,)
+            ).fetchall()]
+        with self._lock:
+            empty = [sid for sid in empty if sid not in self._cache]
+        for session_id in empty:
+            self.delete_session(session_id)
+        return len(empty)
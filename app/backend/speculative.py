@@ -0,0 +1,92 @@
+import threading
+
+try:
+    import numpy as np
+    from llama_cpp.llama_speculative import LlamaDraftModel
+except ImportError:
+    np = None
+    LlamaDraftModel = object
+
+class SmallModelDraft(LlamaDraftModel):
+    """
+    Draft model for llama_cpp speculative decoding: a small Llama proposes the next
+    few tokens greedily and the target model verifies them in one batched pass.
+    llama_cpp keeps only the proposals the target would have sampled itself, so the
+    output is the same as decoding with the target alone.
+    """
+    def __init__(self, draft_llama, num_pred_tokens=8):
+        self.draft = draft_llama
+        self.num_pred_tokens = num_pred_tokens
+        self.proposed = 0
+        self.accepted = 0
+        self._last_input = None
+        self._last_proposal = []
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids, **kwargs):
+        ids = [int(t) for t in input_ids]
+        with self._lock:
+            self._score_last_proposal(ids)
+
+        proposal = []
+        # generate() reuses the draft's evaluated prefix, so only new tokens are fed to it
+        tokens = self.draft.generate(ids, top_k=1, temp=0.0, reset=True)
+        try:
+            for token in tokens:
+                if token == self.draft.token_eos():
+                    break
+                proposal.append(token)
+                if len(proposal) >= self.num_pred_tokens:
+                    break
+        finally:
+            tokens.close()
+
+        with self._lock:
+            self._last_input = ids
+            self._last_proposal = proposal
+            self.proposed += len(proposal)
+        return np.array(proposal, dtype=np.intc)
+
+    def _score_last_proposal(self, ids):
+        # The next call's input is the previous input + accepted draft tokens + one sampled token
+        prev = self._last_input
+        if prev is None or len(ids) <= len(prev) or ids[:len(prev)] != prev:
+            return
+        new = ids[len(prev):]
+        n = 0
+        while n < len(self._last_proposal) and n < len(new) and new[n] == self._last_proposal[n]:
+            n += 1
+        self.accepted += n
+        self._last_proposal = []
+
+    def stats(self):
+        with self._lock:
+            rate = self.accepted / self.proposed if self.proposed else 0.0
+            return {"proposed": self.proposed, "accepted": self.accepted, "acceptance_rate": round(rate, 3)}
+
+def is_compatible(target_meta, draft_meta):
+    """Drafts must share the target's tokenizer exactly: same type, vocab size and special tokens."""
+    if not target_meta or not draft_meta or "error" in target_meta or "error" in draft_meta:
+        return False
+    for key in ("tokenizer", "vocab_size", "bos_token_id", "eos_token_id"):
+        if target_meta.get(key) != draft_meta.get(key):
+            return False
+    return target_meta.get("vocab_size") is not None
+
+def pick_draft_model(target_name, model_info, max_ratio=0.25):
+    """
+    Chooses a draft for target_name from catalog entries: a tokenizer-compatible model
+    with at most max_ratio of the target's parameters. The largest such model wins,
+    since it usually has the best acceptance rate while still being cheap.
+    """
+    target_meta = model_info.get(target_name, {}).get("meta", {})
+    target_params = target_meta.get("parameters") or 0
+    candidates = []
+    for name, entry in model_info.items():
+        meta = entry.get("meta", {})
+        params = meta.get("parameters") or 0
+        if name == target_name or not params or params > target_params * max_ratio:
+            continue
+        if is_compatible(target_meta, meta):
+            candidates.append((params, name))
+    return max(candidates)[1] if candidates else None
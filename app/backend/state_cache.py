@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+class StateCache:
+    """
+    LRU cache of llama_cpp state snapshots (KV cache + evaluated tokens).
+    Bounded both by number of entries and by total RAM. sizeof(value) -> bytes lets it
+    hold other values too (e.g. prompt embeddings).
+    """
+    def __init__(self, max_entries=8, ram_budget_mb=2048, sizeof=None):
+        self.max_entries = max_entries
+        self.ram_budget = ram_budget_mb * 1024**2
+        self.sizeof = sizeof or self.state_size
+        self._states = OrderedDict() # key -> (state, size in bytes)
+        self._lock = threading.Lock()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def state_size(state):
+        size = getattr(state, "llama_state_size", 0)
+        for arr in (getattr(state, "input_ids", None), getattr(state, "scores", None)):
+            size += getattr(arr, "nbytes", 0)
+        return size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._states.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._states.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, state):
+        size = self.sizeof(state)
+        with self._lock:
+            self._drop(key)
+            if size > self.ram_budget:
+                return
+            self._states[key] = (state, size)
+            self.used += size
+            # Evict least recently used snapshots until we fit again
+            while len(self._states) > self.max_entries or self.used > self.ram_budget:
+                old_key = next(iter(self._states))
+                self._drop(old_key)
+
+    def discard(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def discard_matching(self, predicate):
+        with self._lock:
+            for key in [k for k in self._states if predicate(k)]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self.used = 0
+
+    def _drop(self, key):
+        entry = self._states.pop(key, None)
+        if entry:
+            self.used -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._states),
+                "used_mb": round(self.used / 1024**2, 1),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class PrefixStore:
+    """
+    On-disk llama_cpp state snapshots of fixed prompt prefixes (e.g. persona system prompts).
+    Keys hash the model file identity (path, size, mtime), n_ctx and the prefix text, so
+    changing either the model or the prompt simply misses and builds a new snapshot.
+    Only the newest max_files snapshots are kept on disk; the most recently used ones
+    also stay in memory, within memory_entries and memory_mb.
+    """
+    def __init__(self, root_dir, max_files=32, memory_entries=4, memory_mb=512):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.max_files = max_files
+        self._memory = StateCache(max_entries=memory_entries, ram_budget_mb=memory_mb) # Snapshots already read this run
+
+    @staticmethod
+    def key(model_path, n_ctx, prefix_text):
+        st = os.stat(model_path)
+        ident = f"{os.path.abspath(model_path)}|{st.st_size}|{st.st_mtime}|{n_ctx}|{prefix_text}"
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.root_dir / f"{key}.state"
+
+    def get(self, key):
+        state = self._memory.get(key)
+        if state is not None:
+            return state
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            # Only files this app wrote itself live here
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print(f"Discarding unreadable prefix snapshot {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path) # Mark as recently used for pruning
+        self._memory.put(key, state)
+        return state
+
+    def put(self, key, state):
+        self._memory.put(key, state)
+        path = self._path(key)
+        tmp = path.with_suffix(".tmp")
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not save prefix snapshot: {e}")
+            return
+        self._prune()
+
+    def _prune(self):
+        files = sorted(self.root_dir.glob("*.state"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for old in files[self.max_files:]:
+            old.unlink(missing_ok=True)
+            self._memory.discard(old.stem)
@@ -1,19 +1,31 @@
 from faster_whisper import WhisperModel
+from contextlib import nullcontext
 from pathlib import Path
+import gc
 import os
+import threading
+
+# Rough resident size per Whisper model, for the memory governor
+MODEL_SIZE_MB = {"tiny": 150, "base": 300, "small": 1000, "medium": 2500, "large": 4500}
 
 class STTEngine:
-    def __init__(self, models_dir="models/stt", model_size="tiny"):
+    def __init__(self, models_dir="models/stt", model_size="tiny", governor=None):
         self.models_dir = Path(models_dir)
         self.models_dir.mkdir(parents=True, exist_ok=True)
         self.model_size = model_size
         self.model = None
+        self.governor = governor
+        self._lock = threading.Lock()
+
+    @property
+    def alloc_name(self):
+        return f"stt:{self.model_size}"
 
     def load_model(self):
         if not self.model:
             # Run on GPU with FP16
             # If no GPU, it falls back or we can force cpu
-            device = "cuda" if os.environ.get("CUDA_VISIBLE_DEVICES") != "-1" else "cpu" 
+            device = "cuda" if os.environ.get("CUDA_VISIBLE_DEVICES") != "-1" else "cpu"
             # Actually faster-whisper handles auto detection usually, but let's be explicit if we know
             try:
                 self.model = WhisperModel(self.model_size, device="auto", compute_type="float16", download_root=str(self.models_dir))
@@ -21,10 +33,31 @@ class STTEngine:
                 # Fallback to int8/cpu if float16 fails (common on some cards)
                 self.model = WhisperModel(self.model_size, device="cpu", compute_type="int8", download_root=str(self.models_dir))
 
+            if self.governor:
+                # Registered after loading: "auto" only settles on a device once the model is up
+                on_gpu = getattr(self.model.model, "device", "cpu") == "cuda"
+                size = MODEL_SIZE_MB.get(self.model_size.split(".")[0].split("-")[0], 1000)
+                self.governor.reserve(self.alloc_name, "stt", "vram" if on_gpu else "ram", size, release=self.unload)
+
+    def unload(self):
+        """Frees the model; it is loaded again on the next transcription. False while one is running."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.model = None
+            gc.collect()
+        finally:
+            self._lock.release()
+        if self.governor:
+            self.governor.release(self.alloc_name)
+        return True
+
     def transcribe(self, audio_path):
-        if not self.model:
-            self.load_model()
-        
-        segments, info = self.model.transcribe(audio_path, beam_size=5)
-        text = "".join([segment.text for segment in segments])
+        with self._lock:
+            if not self.model:
+                self.load_model()
+
+            with self.governor.use(self.alloc_name) if self.governor else nullcontext():
+                segments, info = self.model.transcribe(audio_path, beam_size=5)
+                text = "".join([segment.text for segment in segments])
         return text.strip()
@@ -1,76 +1,427 @@
 import os
+import threading
+import time
+from contextlib import nullcontext
 from pathlib import Path
+from app.backend.state_cache import StateCache, PrefixStore
+from app.backend.model_pool import ModelPool
+from app.backend.model_catalog import ModelCatalog
+from app.backend import autotune
+from app.backend.speculative import SmallModelDraft, pick_draft_model
 try:
+    import llama_cpp
     from llama_cpp import Llama
 except ImportError:
+    llama_cpp = None
     Llama = None
 
 class TextEngine:
-    def __init__(self, default_models_dir, custom_dirs=[]):
+    def __init__(self, default_models_dir, custom_dirs=[], config=None, governor=None):
         self.default_models_dir = Path(default_models_dir)
         self.custom_dirs = [Path(d) for d in custom_dirs]
-        self.model = None
-        self.model_name = None
+        self.config = config
+        self.model_name = None # Currently selected model; it may still be loading
         self.model_map = {} # Maps filename -> full path
+        self.model_info = {} # Maps filename -> catalog entry (size, mtime, GGUF header metadata)
+
+        # Independent copies of the model, one per scheduler worker. Threads are split
+        # between replicas so a multi-core box is saturated without oversubscription.
+        self.replicas = max(1, self._setting("replicas", 1))
+        self.n_threads = self._setting("n_threads", None) or max(1, (os.cpu_count() or 1) // self.replicas)
+        self._loaders = {} # Model name -> (loader, size_mb, device), used to (re)load replicas
+        self._locks = {} # Pool key -> lock; a Llama instance is not thread-safe
+
+        # Loaded models stay resident (LRU, within budgets) so switching back is instant
+        self.pool = ModelPool(
+            max_models=self._setting("pool_max_models", 2) * self.replicas,
+            ram_budget_mb=self._setting("pool_ram_mb", None),
+            vram_budget_mb=self._setting("pool_vram_mb", None),
+            on_evict=self._on_evict,
+            governor=governor # Budget shared with the image and speech engines
+        )
+
+        # KV state snapshots of recently active sessions, so switching back only prefills the new turn
+        self.state_cache = StateCache(
+            max_entries=self._setting("kv_cache_sessions", 8),
+            ram_budget_mb=self._setting("kv_cache_ram_mb", 2048)
+        )
+        self.resident_sessions = {} # Pool key -> session whose tokens currently sit in its KV cache
+
+        # Snapshots of persona system-prompt prefixes on disk, so new chats skip that prefill
+        self.persona_prompts = []
+        self.prefix_store = None
+        if self._setting("prefix_cache", True):
+            self.prefix_store = PrefixStore(
+                Path(default_models_dir) / ".prefix_cache",
+                max_files=self._setting("prefix_cache_files", 32),
+                memory_entries=self._setting("prefix_cache_memory_entries", 4),
+                memory_mb=self._setting("prefix_cache_memory_mb", 512)
+            )
+
+        self.n_ctx = self._setting("n_ctx", 4096)
+        self.max_tokens = self._setting("max_tokens", 512)
+        self.decode_stats = {} # Model name -> totals for tokens/s and time-to-first-token
         
         # Ensure default directory exists
         self.default_models_dir.mkdir(parents=True, exist_ok=True)
 
-    def list_models(self):
-        self.model_map = {}
-        
-        # Helper to scan a dir
-        def scan_dir(d):
-            if not d.exists(): return
-            for f in d.glob("*.gguf"):
-                self.model_map[f.name] = f
-
-        # Scan default
-        scan_dir(self.default_models_dir)
-        
-        # Scan custom
-        for d in self.custom_dirs:
-            scan_dir(d)
-            
+        # Persistent index of GGUF files, so listing slow custom paths does not rescan them
+        self.catalog = ModelCatalog(self.default_models_dir / ".cache" / "catalog.json")
+
+    def list_models(self, force=False):
+        # Default dir first, custom dirs override same-named files
+        entries = self.catalog.refresh([self.default_models_dir] + self.custom_dirs, force=force)
+        self.model_map = {name: Path(e["path"]) for name, e in entries.items()}
+        self.model_info = entries
         return list(self.model_map.keys())
 
-    def load_model(self, model_name, n_gpu_layers=-1):
+    def describe_model(self, model_name):
+        """Short human-readable summary from the GGUF header, e.g. '8.0B · Q4_K_M · 8k ctx'."""
+        meta = self.model_info.get(model_name, {}).get("meta", {})
+        if not meta or "error" in meta:
+            return ""
+        parts = []
+        if meta.get("parameters"):
+            parts.append(f"{meta['parameters'] / 1e9:.1f}B")
+        if meta.get("quantization") and meta["quantization"] != "unknown":
+            parts.append(meta["quantization"])
+        if meta.get("context_length"):
+            parts.append(f"{meta['context_length'] // 1024}k ctx")
+        return " · ".join(parts)
+
+    def _setting(self, key, default):
+        if not self.config:
+            return default
+        return self.config.get_nested(["text", key], default)
+
+    @property
+    def model(self):
+        """The selected model if it is loaded, without waiting for an in-progress load."""
+        return self.pool.peek(self.model_name) if self.model_name else None
+
+    @model.setter
+    def model(self, model):
+        # Allows injecting an already constructed model
+        self.model_name = self.model_name or "default"
+        self.pool.put(self.model_name, model)
+
+    def load_model_async(self, model_name, n_gpu_layers=-1, select=True):
+        """
+        Starts loading model_name in the background if it is not resident and, with select,
+        makes it the model used by requests that name none. Returns a status message right
+        away; use wait_for_model() or model_status() to follow it.
+        """
         if not Llama:
             return "Error: llama-cpp-python not installed."
             
         if model_name not in self.model_map:
             # Try refreshing
-            self.list_models()
+            self.list_models(force=True)
             if model_name not in self.model_map:
                 return f"Error: Model {model_name} not found in any directory."
         
         model_path = self.model_map[model_name]
+        profile = autotune.load_profile(self.config, model_name)
+        if profile:
+            n_gpu_layers = profile["n_gpu_layers"]
+
+        draft_name = self.draft_model_for(model_name)
+        draft_path = self.model_map.get(draft_name) if draft_name else None
 
-        try:
+        def loader():
+            params = self._load_params(model_name, n_gpu_layers)
+            if draft_path:
+                # Speculative decoding: the small draft proposes, the target verifies in one batch
+                draft = Llama(model_path=str(draft_path), n_ctx=self.n_ctx, verbose=False, **params)
+                params["draft_model"] = SmallModelDraft(draft, num_pred_tokens=self._setting("draft_tokens", 8))
             # n_gpu_layers=-1 offloads all to GPU if compiled with CUDA
-            self.model = Llama(model_path=str(model_path), n_ctx=4096, n_gpu_layers=n_gpu_layers, verbose=False)
+            return Llama(model_path=str(model_path), n_ctx=self.n_ctx, verbose=False, **params)
+
+        gpu = n_gpu_layers != 0 and llama_cpp is not None and getattr(llama_cpp, "llama_supports_gpu_offload", lambda: False)()
+        size_mb = round(os.path.getsize(model_path) / 1024**2)
+        if draft_path:
+            size_mb += round(os.path.getsize(draft_path) / 1024**2)
+        self._loaders[model_name] = (loader, size_mb, "vram" if gpu else "ram")
+        if select:
             self.model_name = model_name
+        entry = self._ensure_replica(model_name, 0)
+        if entry.status == "ready":
             return f"Loaded {model_name}"
-        except Exception as e:
-            return f"Failed to load model: {e}"
+        return f"Loading {model_name}..."
+
+    def _load_params(self, model_name, n_gpu_layers):
+        """Llama() load parameters: the tuned profile for this model and machine, else defaults."""
+        profile = autotune.load_profile(self.config, model_name)
+        if not profile and self._setting("autotune", False):
+            # Autotune mode: calibrate once on first load, later loads reuse the saved profile
+            try:
+                self.autotune(model_name)
+                profile = autotune.load_profile(self.config, model_name)
+            except Exception as e:
+                print(f"Autotune failed for {model_name}: {e}")
+        if profile:
+            return {k: profile[k] for k in ("n_gpu_layers", "n_threads", "n_threads_batch", "n_batch", "use_mmap", "use_mlock")}
+        return {"n_gpu_layers": n_gpu_layers, "n_threads": self.n_threads, "n_threads_batch": self.n_threads}
+
+    def autotune(self, model_name, log=print):
+        """Calibrates load/decode parameters for model_name on this machine and saves the profile."""
+        if model_name not in self.model_map:
+            self.list_models(force=True)
+        path = self.model_map[model_name]
+        meta = self.model_info.get(model_name, {}).get("meta", {})
+        # Tune within the per-replica thread share so replicas do not oversubscribe the CPU
+        profile = autotune.autotune(model_name, path, meta, max_threads=self.n_threads, log=log)
+        if self.config:
+            autotune.save_profile(self.config, model_name, profile)
+        return profile
+
+    def load_model(self, model_name, n_gpu_layers=-1):
+        msg = self.load_model_async(model_name, n_gpu_layers)
+        if msg.startswith("Error"):
+            return msg
+        self.wait_for_model()
+        return self.model_status_text()
+
+    def draft_model_for(self, model_name):
+        """
+        Draft model for speculative decoding: an explicit text.speculative_pairs entry,
+        else (with text.speculative enabled) a tokenizer-compatible small model from the catalog.
+        """
+        pairs = self._setting("speculative_pairs", {}) or {}
+        draft = pairs.get(model_name)
+        if draft is None and self._setting("speculative", False):
+            draft = pick_draft_model(model_name, self.model_info)
+        if draft and draft not in self.model_map:
+            print(f"Draft model {draft} not found, decoding {model_name} without it.")
+            return None
+        return draft
 
-    def generate(self, prompt, history=[], system_prompt="You are a helpful assistant."):
-        if not self.model:
-            return "Please load a model first."
+    def speculative_stats(self, model_name=None):
+        """Draft acceptance summed over the resident replicas of a model."""
+        model_name = model_name or self.model_name
+        totals = {"proposed": 0, "accepted": 0}
+        found = False
+        for e in self.pool.status():
+            if e["name"].split("#")[0] != model_name:
+                continue
+            draft = getattr(self.pool.peek(e["name"]), "draft_model", None)
+            if isinstance(draft, SmallModelDraft):
+                found = True
+                st = draft.stats()
+                totals["proposed"] += st["proposed"]
+                totals["accepted"] += st["accepted"]
+        if not found:
+            return None
+        totals["acceptance_rate"] = round(totals["accepted"] / totals["proposed"], 3) if totals["proposed"] else 0.0
+        return totals
 
+    def throughput_stats(self, model_name=None):
+        st = self.decode_stats.get(model_name or self.model_name)
+        if not st or not st["requests"]:
+            return None
+        return {
+            "requests": st["requests"],
+            "decode_tps": round(st["tokens"] / st["seconds"], 2) if st["seconds"] else 0.0,
+            "avg_ttft": round(st["ttft"] / st["requests"], 3)
+        }
+
+    def _record_decode(self, model_name, started, first_at, last_at, n_tokens):
+        st = self.decode_stats.setdefault(model_name, {"requests": 0, "tokens": 0, "seconds": 0.0, "ttft": 0.0})
+        st["requests"] += 1
+        st["ttft"] += first_at - started
+        if n_tokens > 1:
+            st["tokens"] += n_tokens - 1
+            st["seconds"] += last_at - first_at
+
+    def _replica_key(self, model_name, replica):
+        return model_name if replica == 0 else f"{model_name}#{replica}"
+
+    def _ensure_replica(self, model_name, replica):
+        """Starts loading a replica that is not resident (never loaded, or evicted)."""
+        key = self._replica_key(model_name, replica)
+        entry = self.pool.entry(key)
+        if entry is None or entry.status == "error":
+            if model_name not in self._loaders:
+                return entry
+            loader, size_mb, device = self._loaders[model_name]
+            entry = self.pool.load_async(key, loader, size_mb=size_mb, device=device)
+        return entry
+
+    def ensure_loaded(self, model_name=None):
+        """
+        Starts reloading a selected model that is no longer resident, e.g. after the memory
+        governor evicted it to make room for another engine. Returns its status.
+        """
+        model_name = model_name or self.model_name
+        if not model_name:
+            return None
+        self._ensure_replica(model_name, 0)
+        return self.model_status(model_name)
+
+    def wait_for_model(self, timeout=None, model_name=None):
+        model_name = model_name or self.model_name
+        if not model_name:
+            return None
+        return self.pool.get(model_name, timeout)
+
+    def model_status(self, model_name=None):
+        entry = self.pool.entry(model_name or self.model_name)
+        return entry.status if entry else None
+
+    def model_status_text(self, model_name=None):
+        name = model_name or self.model_name
+        entry = self.pool.entry(name)
+        if not entry:
+            return "No model loaded."
+        if entry.status == "ready":
+            return f"Loaded {name} ({entry.load_seconds:.1f}s{', ' + entry.warning if entry.warning else ''})"
+        if entry.status == "error":
+            return f"Failed to load model: {entry.error}"
+        return f"⏳ Loading {name}... {time.time() - entry.started:.0f}s"
+
+    def _on_evict(self, key):
+        self.resident_sessions.pop(key, None)
+        # KV snapshots are only valid for the model that produced them, but any replica can use them
+        model_name = key.split("#")[0]
+        if not any(e["name"].split("#")[0] == model_name for e in self.pool.status()):
+            self.state_cache.discard_matching(lambda k: k[0] == model_name)
+
+    def _build_prompt(self, prompt, history, system_prompt):
         # Simple chat format construction (assuming Llama-3/ChatML style for simplicity, 
         # but ideally should use chat templates provided by the library if available)
-        
-        # Construct prompt
         full_prompt = f"<|system|>\n{system_prompt}</s>\n"
         for user_msg, ai_msg in history:
-            full_prompt += f"<|user|>\n{user_msg}</s>\n<|assistant|>\n{ai_msg}</s>\n"
+            full_prompt += self._format_turn(user_msg, ai_msg)
         full_prompt += f"<|user|>\n{prompt}</s>\n<|assistant|>\n"
+        return full_prompt
 
-        output = self.model(
-            full_prompt, 
-            max_tokens=512, 
-            stop=["</s>", "<|user|>", "<|system|>"], 
-            echo=False
-        )
-        return output['choices'][0]['text'].strip()
+    def _format_turn(self, user_msg, ai_msg):
+        return f"<|user|>\n{user_msg}</s>\n<|assistant|>\n{ai_msg}</s>\n"
+
+    def register_personas(self, prompts):
+        """System prompts worth keeping prefix snapshots for."""
+        self.persona_prompts = sorted(set(prompts), key=len, reverse=True)
+
+    def _persona_prefix(self, system_prompt):
+        # The prefix stops before the closing tag, so it still matches when a summary is appended
+        for persona in self.persona_prompts:
+            if persona and system_prompt.startswith(persona):
+                return f"<|system|>\n{persona}"
+        return None
+
+    def _restore_prefix(self, model_name, model, system_prompt):
+        """
+        Makes sure the model's KV cache starts with the persona prefix: either it already
+        does, or the snapshot is restored from disk (built once on a miss).
+        """
+        prefix = self._persona_prefix(system_prompt)
+        if not prefix or not self.prefix_store or model_name not in self.model_map:
+            return
+        tokens = model.tokenize(prefix.encode("utf-8"), special=True)
+        current = list(model.input_ids[:model.n_tokens]) if model.n_tokens else []
+        if current[:len(tokens)] == tokens:
+            return
+
+        key = PrefixStore.key(self.model_map[model_name], self.n_ctx, prefix)
+        state = self.prefix_store.get(key)
+        if state is not None:
+            model.load_state(state)
+            return
+        # Miss: evaluate just the prefix (the prompt needs it anyway) and keep a snapshot
+        model.reset()
+        model.eval(tokens)
+        self.prefix_store.put(key, model.save_state())
+
+    def warm_prefixes(self, replica=0):
+        """Builds missing persona snapshots for the selected model. Generator, for the scheduler."""
+        model_name = self.model_name
+        if not model_name or not self.prefix_store:
+            return
+        key = self._replica_key(model_name, replica)
+        with self.pool.use(key) as model, self._locks.setdefault(key, threading.Lock()):
+            if model is None:
+                return
+            # Park the resident session first; the KV cache is about to hold bare prefixes
+            self._activate_session(model_name, key, model, None)
+            for persona in self.persona_prompts:
+                self._restore_prefix(model_name, model, persona)
+        yield from ()
+
+    def _activate_session(self, model_name, key, model, session_id, system_prompt=""):
+        """
+        Puts the KV state of session_id into the model. llama.cpp then reuses the longest
+        matching token prefix, so only the new suffix of the prompt gets evaluated.
+        session_id=None is a one-off request that keeps no state.
+        """
+        resident = self.resident_sessions.get(key)
+        if session_id is not None and session_id == resident:
+            # A persona switch changes the prefix, which a restored snapshot can still cover
+            self._restore_prefix(model_name, model, system_prompt)
+            return
+
+        # Snapshot the session currently occupying the KV cache before another one overwrites it
+        if resident is not None and model.n_tokens > 0:
+            self.state_cache.put((model_name, resident), model.save_state())
+
+        if session_id is not None:
+            state = self.state_cache.get((model_name, session_id))
+            if state is not None:
+                model.load_state(state)
+        self.resident_sessions[key] = session_id
+        self._restore_prefix(model_name, model, system_prompt)
+
+    def forget_session(self, session_id):
+        self.state_cache.discard_matching(lambda key: key[1] == session_id)
+        for key, resident in list(self.resident_sessions.items()):
+            if resident == session_id:
+                self.resident_sessions[key] = None
+
+    def generate_stream(self, prompt, history=[], system_prompt="You are a helpful assistant.", cancel_event=None, session_id=None, max_tokens=None, replica=0, model_name=None):
+        """
+        Yields the reply as text deltas while llama.cpp decodes it.
+        Setting cancel_event (a threading.Event) or closing the generator stops decoding.
+        model_name picks a model registered with load_model_async; default: the selected one.
+        """
+        model_name = model_name or self.model_name
+        key = self._replica_key(model_name, replica) if model_name else None
+        if key:
+            self._ensure_replica(model_name, replica)
+        # Waits if the model is still loading, and pins it so it is not evicted mid-reply
+        with self.pool.use(key) if key else nullcontext() as model, self._locks.setdefault(key, threading.Lock()):
+            if model is None:
+                entry = self.pool.entry(key) if key else None
+                yield self.model_status_text(key) if entry and entry.status == "error" else "Please load a model first."
+                return
+
+            self._activate_session(model_name, key, model, session_id, system_prompt)
+            full_prompt = self._build_prompt(prompt, history, system_prompt)
+
+            stream = model(
+                full_prompt, 
+                max_tokens=max_tokens or self.max_tokens, 
+                stop=["</s>", "<|user|>", "<|system|>"], 
+                echo=False,
+                stream=True
+            )
+            started = time.time()
+            first_at = last_at = None
+            n_tokens = 0
+            try:
+                for chunk in stream:
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    last_at = time.time()
+                    first_at = first_at or last_at
+                    n_tokens += 1
+                    delta = chunk['choices'][0]['text']
+                    if delta:
+                        yield delta
+            finally:
+                # Closing the llama.cpp generator stops token evaluation right away
+                stream.close()
+                if first_at:
+                    self._record_decode(model_name, started, first_at, last_at, n_tokens)
+
+    def generate(self, prompt, history=[], system_prompt="You are a helpful assistant.", session_id=None, max_tokens=None, replica=0, model_name=None):
+        return "".join(self.generate_stream(prompt, history, system_prompt, session_id=session_id, max_tokens=max_tokens,
+                                            replica=replica, model_name=model_name)).strip()
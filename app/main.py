@@ -1,7 +1,10 @@
 import gradio as gr
 import os
+import shutil
 import sys
+import tempfile
 import threading
+import time
 from pathlib import Path
 
 # Add parent dir
@@ -9,23 +12,25 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 from app.backend.config_manager import ConfigManager
 from app.backend.hardware import get_device_info
-from app.backend.text_engine import TextEngine
+from app.backend.runtime import Runtime
 from app.backend.voice_engine import VoiceEngine, tts_sync
-from app.backend.image_engine import ImageEngine
-from app.backend.stt_engine import STTEngine
-from app.backend.session_manager import SessionManager
+from app.backend.image_store import ImageStore
+from app.backend.image_presets import parse_preset, parse_size
 import asyncio
 from download_models import MODELS as DOWNLOADABLE_MODELS, download_file
 
 # --- Initialization ---
 config = ConfigManager()
-models_root = config.get_nested(["paths", "models_root"], "models")
-custom_paths = config.get("custom_model_paths", [])
-
-text_engine = TextEngine(os.path.join(models_root, "llm"), custom_paths)
-image_engine = ImageEngine(os.path.join(models_root, "image"))
-stt_engine = STTEngine(os.path.join(models_root, "stt"))
-session_manager = SessionManager()
+runtime = Runtime(config)
+models_root = runtime.models_root
+governor = runtime.governor
+text_engine = runtime.text_engine
+image_engine = runtime.image_engine
+stt_engine = runtime.stt_engine
+image_store = runtime.image_store
+session_manager = runtime.session_manager
+scheduler = runtime.scheduler
+context_manager = runtime.context_manager
 
 # --- Constants & Theme ---
 css = """
@@ -86,23 +91,34 @@ PERSONALITIES = {
     "Sarcastic": "You are a sarcastic robot."
 }
 
+# Persona prefixes get precomputed KV snapshots, so new chats skip the system-prompt prefill
+text_engine.register_personas(PERSONALITIES.values())
+
 # --- Logic ---
 
-def get_available_models():
-    installed = text_engine.list_models()
+def get_available_models(force=False):
+    installed = text_engine.list_models(force=force)
     hw = get_device_info()
     vram = hw.get("vram", 0)
     
+    # (label, value) pairs: labels carry the real size/quant/context from the GGUF header
+    choices = []
+    for name in installed:
+        desc = text_engine.describe_model(name)
+        choices.append((f"{name} ({desc})" if desc else name, name))
+    
     recommendations = []
     for m in DOWNLOADABLE_MODELS:
         name = m["name"]
         if name not in installed:
-            is_small = "1B" in name or "3B" in name or "Phi-3" in name
-            if vram < 6 and not is_small:
+            # Needs to fit in VRAM (weights + ~1 GB for context), unless it is small enough for CPU
+            fits_gpu = vram > 0 and m["size_gb"] + 1.0 <= vram
+            if not fits_gpu and m["params_b"] > 4:
                 continue
-            recommendations.append(f"⬇️ Download: {name}")
+            label = f"⬇️ Download: {name}"
+            recommendations.append((f"{label} ({m['params_b']:.1f}B, {m['size_gb']:.1f} GB)", label))
             
-    return installed + recommendations
+    return choices + recommendations
 
 def get_voice_list():
     # Instantiate temp engine to get list
@@ -111,7 +127,8 @@ def get_voice_list():
 
 def handle_model_change(model_selection):
     if not model_selection or not isinstance(model_selection, str):
-        return gr.update(), "Invalid selection"
+        yield gr.update(), "Invalid selection"
+        return
 
     if model_selection.startswith("⬇️ Download:"):
         model_name = model_selection.replace("⬇️ Download: ", "").strip()
@@ -122,40 +139,98 @@ def handle_model_change(model_selection):
             try:
                 download_file(url, dest)
                 gr.Info(f"Downloaded {model_name}!")
-                return gr.update(choices=get_available_models(), value=model_name), f"Loaded {model_name}"
+                yield gr.update(choices=get_available_models(), value=model_name), f"Loaded {model_name}"
             except Exception as e:
                 gr.Warning(f"Download failed: {e}")
-                return gr.update(), f"Error: {e}"
+                yield gr.update(), f"Error: {e}"
+            return
     
-    msg = text_engine.load_model(model_selection)
-    return gr.update(), msg
+    # Loads run in the background; just report progress until the model is ready
+    msg = text_engine.load_model_async(model_selection)
+    yield gr.update(), msg
+    if msg.startswith("Error"):
+        return
+    while text_engine.model_status(model_selection) == "loading":
+        time.sleep(0.5)
+        yield gr.update(), text_engine.model_status_text(model_selection)
+    if text_engine.model_status(model_selection) == "ready":
+        # Build any missing persona snapshots when nothing else is waiting
+        scheduler.submit(lambda replica: text_engine.warm_prefixes(replica=replica), priority="low")
+    yield gr.update(), text_engine.model_status_text(model_selection)
 
 def transcribe_audio(audio_path):
     if not audio_path: return ""
     text = stt_engine.transcribe(audio_path)
     return text
 
-def chat_turn(message, history, session_id, personality, voice_enabled, voice_id, image_mode_trigger=False):
+# Cancel flags for in-flight replies, keyed by browser session (gr.Request.session_hash)
+active_replies = {}
+
+def cancel_reply(request: gr.Request = None):
+    key = request.session_hash if request else None
+    event = active_replies.pop(key, None)
+    if event:
+        event.set()
+
+def chat_turn(message, history, session_id, personality, voice_enabled, voice_id, image_preset=None, image_model=None, session_offset=0, image_mode_trigger=False, request: gr.Request = None):
     if not message.strip() and not image_mode_trigger:
         return history, None, gr.update()
 
+    # The chatbot may only show the latest window of turns; the model and the saved
+    # session always work from the complete stored history
+    current_session = (session_manager.get_session(session_id) if session_id else None) or {}
+    stored_history = current_session.get("history", history)
+
     # 1. Check for Image Generation Request
     # Simple heuristic: if "generate image" or "draw" is in the message
     lower_msg = message.lower()
     if "generate image" in lower_msg or "draw " in lower_msg or "create an image" in lower_msg:
         # Image Mode
         history = history + [[message, "🎨 Generating image..."]]
+        if image_engine.status in ("loading", "warming"):
+            history[-1][1] = f"🎨 {image_engine.status_text()}"
         yield history, None, gr.update()
         
-        # Extract prompt (naive)
-        prompt = message
-        img, status = image_engine.generate(prompt)
+        # Extract prompt (naive); a "--fast"-style flag picks the preset for this image only
+        preset, prompt = parse_preset(message, image_engine.presets)
+        preset = preset or image_preset
+        # "--1536x1024" sets the output size; above the model's native size it runs in high-resolution mode
+        size, prompt = parse_size(prompt)
+        width, height = size or (None, None)
+        key = request.session_hash if request else None
+        cancel_event = threading.Event()
+        active_replies[key] = cancel_event
+        # Rough previews while denoising; Gradio serves files from the system temp dir
+        preview_dir = tempfile.mkdtemp(prefix="antigravity_preview_")
+        img, status = None, "Cancelled"
+        try:
+            for event in image_engine.generate_stream(prompt, width=width, height=height, cancel_event=cancel_event,
+                                                      preset=preset, model=image_model):
+                if "preview" in event:
+                    stage = "Tile" if event.get("stage") == "tile" else "Step"
+                    preview_path = os.path.join(preview_dir, f"{stage}_{event['step']}.jpg")
+                    event["preview"].save(preview_path, quality=80)
+                    history[-1][1] = (preview_path, f"{stage} {event['step']}/{event['total']}")
+                    yield history, None, gr.update()
+                else:
+                    img = event["images"][0] if event["images"] else None
+                    status = event["status"]
+                    used = event["preset"]
+        finally:
+            if active_replies.get(key) is cancel_event:
+                del active_replies[key]
+            shutil.rmtree(preview_dir, ignore_errors=True)
         
         if img:
-            img_path = os.path.join(models_root, "image", f"gen_{len(history)}.png")
-            img.save(img_path)
-            # Replace the "Generating..." message with the image
-            history[-1][1] = (img_path, "Generated Image")
+            digest = image_store.put(img, session_id)
+            # Replace the "Generating..." message with the thumbnail; clicking it opens the full image
+            caption = f"Generated Image ({used['name']}, {used['steps']} steps, {img.width}x{img.height}{' hi-res' if used['hires'] else ''}"
+            caption += f", seed {used['seed']})" if used.get("seed") is not None else ")"
+            if used["fallback_from"]:
+                caption += f" - {used['fallback_from']} needs the {image_engine.presets[used['fallback_from']]['adapter']} adapter"
+            history[-1][1] = (str(image_store.thumbnail_path(digest)), caption)
+        elif status == "Cancelled":
+            history[-1][1] = "⏹️ Image generation stopped."
         else:
             history[-1][1] = f"❌ Image generation failed: {status}"
             
@@ -163,38 +238,68 @@ def chat_turn(message, history, session_id, personality, voice_enabled, voice_id
         
         # Save session
         if session_id:
-             session_manager.update_session(session_id, history)
+             session_manager.update_session(session_id, stored_history + [history[-1]])
         return
 
     # 2. Text Chat
     new_history = history + [[message, None]]
+    yield new_history, None, gr.update()
     
-    # 2. Generate
+    # 2. Generate (streamed, so the first token shows up as soon as it is decoded)
     system_prompt = PERSONALITIES.get(personality, "")
-    response = text_engine.generate(message, history, system_prompt)
+    # The governor may have evicted the model to make room for images: reload it before fitting the history
+    if text_engine.ensure_loaded() == "loading":
+        # Only this reply waits; other sessions keep running
+        new_history[-1][1] = f"⏳ Waiting for {text_engine.model_name} to finish loading..."
+        yield new_history, None, gr.update()
+        text_engine.wait_for_model()
+        new_history[-1][1] = None
+    context_history = stored_history
+    if text_engine.model:
+        # Keep the prompt inside the token budget, however long the session has grown
+        system_prompt, context_history = context_manager.fit(current_session, stored_history, message, system_prompt)
+    key = request.session_hash if request else None
+    cancel_event = threading.Event()
+    active_replies[key] = cancel_event
+    
+    response = ""
+    job = scheduler.submit(
+        lambda replica: text_engine.generate_stream(message, context_history, system_prompt, cancel_event=cancel_event, session_id=session_id, replica=replica),
+        session_key=session_id
+    )
+    if job is None:
+        new_history[-1][1] = "⚠️ The server is busy, please try again in a moment."
+        yield new_history, None, gr.update()
+        return
+    try:
+        for delta in job.stream(cancel_event):
+            response += delta
+            new_history[-1][1] = response.lstrip()
+            yield new_history, None, gr.update()
+    finally:
+        # Leaving the page closes this generator, which also stops decoding
+        if active_replies.get(key) is cancel_event:
+            del active_replies[key]
     
+    response = response.strip()
     new_history[-1][1] = response
+    cancelled = cancel_event.is_set()
     
     # 3. Save session
     if session_id:
-        # Auto-title if new or untitled
-        current_session = session_manager.get_session(session_id)
-        title = current_session.get("title", "New Chat")
+        # Auto-title on the first turn: a cheap heuristic now, a model-written title in the background
+        title = None
+        first_turn = len(stored_history) == 0 and not cancelled
+        if first_turn:
+            title = heuristic_title(message)
         
-        if len(history) == 0: # First turn
-            # Generate title
-            try:
-                title_prompt = f"Summarize this conversation in 3-5 words for a title. User: {message}\nAI: {response}"
-                title = text_engine.generate(title_prompt, [], "You are a title generator. Output ONLY the title.")
-                title = title.strip().replace('"', '')
-            except:
-                title = message[:30] + "..."
-        
-        session_manager.update_session(session_id, new_history, title)
+        session_manager.update_session(session_id, stored_history + [new_history[-1]], title, extra={"context": current_session.get("context", {})})
+        if first_turn:
+            request_title(session_id, message, response)
             
     # 4. Voice
     audio = None
-    if voice_enabled:
+    if voice_enabled and not cancelled:
         # Use the new VoiceEngine
         ve = VoiceEngine()
         # Run async in sync
@@ -205,48 +310,231 @@ def chat_turn(message, history, session_id, personality, voice_enabled, voice_id
             asyncio.set_event_loop(loop)
         audio = loop.run_until_complete(ve.text_to_speech(response, voice_id))
         
-    yield new_history, audio, gr.update(choices=refresh_session_list())
+    yield new_history, audio, gr.update(choices=refresh_session_list(session_offset))
+
+# Background title jobs, keyed by chat session id
+title_jobs = {}
+
+def heuristic_title(message):
+    words = message.strip().split()
+    title = " ".join(words[:6]).strip(" .,:;!?\"'")
+    return (title + "...") if len(words) > 6 else (title or "New Chat")
+
+def request_title(session_id, message, response):
+    """
+    Queues a low-priority job that asks the model for a title. Under load (other
+    requests waiting, or the title queue full) the heuristic title is kept.
+    """
+    if scheduler.depth() >= config.get_nested(["text", "title_skip_queue_depth"], 1):
+        return
+    title_prompt = f"Summarize this conversation in 3-5 words for a title. User: {message}\nAI: {response}"
+    
+    def run(replica):
+        # Without a loaded model the "reply" would be a status message, not a title
+        if text_engine.model_status() == "ready":
+            title = text_engine.generate(title_prompt, [], "You are a title generator. Output ONLY the title.", replica=replica, max_tokens=24)
+            title = title.strip().replace('"', '')
+            if title:
+                session_manager.set_title(session_id, title)
+        yield from ()
+    
+    job = scheduler.submit(run, session_key=session_id, priority="low")
+    if job:
+        title_jobs[session_id] = job
+
+def wait_for_title(session_id, session_offset=0):
+    # Runs after the reply is done, so waiting here delays nothing the user is looking at
+    job = title_jobs.pop(session_id, None)
+    if not job:
+        return gr.update()
+    job.done.wait(timeout=60)
+    return gr.update(choices=refresh_session_list(session_offset))
+
+def show_full_image(evt: gr.SelectData):
+    # Chat messages carry thumbnails; the full-resolution file is only sent when one is clicked
+    value = evt.value
+    if isinstance(value, dict):
+        value = value.get("file", value)
+        if isinstance(value, dict):
+            value = value.get("path") or value.get("orig_name")
+    elif isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    digest = ImageStore.digest_from_path(value) if isinstance(value, str) else None
+    if digest and image_store.full_path(digest).exists():
+        return gr.update(value=str(image_store.full_path(digest)), visible=True)
+    return gr.update(value=None, visible=False)
 
 def create_new_session():
+    # The new chat is at the top of the first page
     sid, _ = session_manager.create_session()
-    return sid, [], gr.update(choices=refresh_session_list())
+    return sid, [], *session_page(0), 0, gr.update(visible=False)
+
+def history_page_size():
+    return config.get_nested(["preferences", "history_window"], 30)
 
 def load_session(evt: gr.SelectData):
+    # Only the latest turns go to the browser; "Load earlier" pages back from there
     selected = evt.value
-    if not selected: return None, []
+    if not selected: return None, [], 0, gr.update(visible=False)
     sid = selected.split(" | ")[-1]
-    data = session_manager.get_session(sid)
-    if data:
-        return sid, data["history"]
-    return None, []
-
-def refresh_session_list():
-    sessions = session_manager.list_sessions()
+    window = session_manager.get_history_window(sid, history_page_size())
+    if window:
+        return sid, window["turns"], window["start"], gr.update(visible=window["start"] > 0)
+    return None, [], 0, gr.update(visible=False)
+
+def load_earlier(session_id, history_start, history):
+    if not session_id or not history_start:
+        return history, history_start, gr.update(visible=False)
+    window = session_manager.get_history_window(session_id, history_page_size(), before=history_start)
+    if not window:
+        return history, history_start, gr.update(visible=False)
+    return window["turns"] + history, window["start"], gr.update(visible=window["start"] > 0)
+
+def session_page_size():
+    return config.get_nested(["preferences", "session_list_limit"], 100)
+
+def refresh_session_list(offset=0):
+    # One page at a time: listing cost stays flat however many chats are stored
+    sessions = session_manager.list_sessions(limit=session_page_size(), offset=offset)
     return [f"{s['title']} | {s['id']}" for s in sessions]
 
-def delete_current_session(selected_str):
-    if not selected_str: return gr.update()
+def session_page(offset):
+    """History list, offset and Newer/Older button updates for the page starting at offset."""
+    total = session_manager.count_sessions()
+    size = session_page_size()
+    if offset >= total:
+        # Chats were deleted since; land on the last page that still exists
+        offset = (total - 1) // size * size
+    offset = max(0, offset)
+    return (
+        gr.update(choices=refresh_session_list(offset), value=None), offset,
+        gr.update(visible=offset > 0), gr.update(visible=offset + size < total)
+    )
+
+def newer_sessions(offset):
+    return session_page(offset - session_page_size())
+
+def older_sessions(offset):
+    return session_page(offset + session_page_size())
+
+def search_chats(query, session_offset=0):
+    if not query or not query.strip():
+        return gr.update(choices=refresh_session_list(session_offset))
+    results = session_manager.search_sessions(query, limit=50)
+    choices = []
+    for r in results:
+        # Radio labels are plain text: drop the match markers and line breaks
+        snippet = " ".join(r["snippet"].replace("**", "").split())
+        label = r["title"] if r["turn"] < 0 else f"{r['title']} · {snippet}"
+        choices.append(f"{label} | {r['id']}")
+    return gr.update(choices=choices, value=None)
+
+def delete_current_session(selected_str, session_offset=0):
+    if not selected_str: return (gr.update(),) * 8
     
     sid = selected_str.split(" | ")[-1]
     session_manager.delete_session(sid)
+    job = title_jobs.pop(sid, None)
+    if job:
+        job.cancel()
+    text_engine.forget_session(sid)
     
-    # Refresh list and clear selection
-    new_list = refresh_session_list()
-    return gr.update(choices=new_list, value=None), None, [] # Reset chat
+    # Refresh the current page and clear selection
+    return *session_page(session_offset), None, [], 0, gr.update(visible=False) # Reset chat
+
+def get_perf_status():
+    stats = scheduler.stats()
+    text = (
+        f"**Queue:** {stats['queue_depth']} waiting, {stats['running']}/{stats['replicas']} replicas busy  \n"
+        f"**Wait:** avg {stats['avg_wait']:.2f}s, p95 {stats['p95_wait']:.2f}s  \n"
+        f"**Served:** {stats['served']} (rejected {stats['rejected']})"
+    )
+    tput = text_engine.throughput_stats()
+    if tput:
+        text += f"  \n**Decode:** {tput['decode_tps']} tok/s, first token after {tput['avg_ttft']:.2f}s avg"
+    spec = text_engine.speculative_stats()
+    if spec:
+        text += f"  \n**Speculative:** {spec['acceptance_rate']:.0%} of {spec['proposed']} draft tokens accepted"
+    text += f"  \n**Image:** {image_engine.status_text()}"
+    batches = image_engine.batch_stats()
+    if batches["batches"]:
+        text += f", {batches['avg_batch']} requests/batch, {batches['pending']} waiting"
+    mem = governor.status()
+    for device in ("ram", "vram"):
+        if mem["budgets"][device]:
+            text += f"  \n**{device.upper()}:** {mem['used'][device]} / {mem['budgets'][device]} MB"
+    for m in mem["models"]:
+        flags = [m["device"]] + (["offloaded"] if m["offloaded"] else []) + (["in use"] if m["in_use"] else [])
+        text += f"  \n· {m['name']}: {m['size_mb']} MB{'' if m['measured'] else ' (est.)'}, {', '.join(flags)}"
+    if mem["evictions"] or mem["offloads"]:
+        text += f"  \n**Freed for other models:** {mem['evictions']} unloads, {mem['offloads']} offloads"
+    run = image_engine.last_run
+    if run:
+        text += f"  \n**Last image:** {run['width']}x{run['height']}" + (f" hi-res ({run['tiles']} tiles)" if run["hires"] else "")
+        text += f", {run['sec_per_mp']} s/MP"
+        if run["peak_mb"] is not None:
+            text += f", peak {run['peak_mb']} MB" + (f" (+{run['extra_mb']} MB over the model)" if run["extra_mb"] is not None else "")
+    caches = image_engine.cache_stats()
+    embeds = caches["embeddings"]
+    if embeds["hits"] + embeds["misses"]:
+        text += f"  \n**Prompt cache:** {embeds['hits'] / (embeds['hits'] + embeds['misses']):.0%} hits, {embeds['entries']} entries ({embeds['used_mb']} MB)"
+    results = caches.get("results")
+    if results and results["hits"] + results["misses"]:
+        text += f"  \n**Result cache:** {results['hit_rate']:.0%} hits of {results['hits'] + results['misses']} seeded requests"
+    return text
+
+def watch_image_warmup():
+    # Reports the background image warm-up until it settles
+    while image_engine.status in ("loading", "warming"):
+        yield image_engine.status_text()
+        time.sleep(1)
+    yield "" if image_engine.status == "idle" else image_engine.status_text()
+
+def run_autotune(model_selection):
+    if not model_selection or model_selection.startswith("⬇️ Download:"):
+        yield "Select an installed model first."
+        return
+    
+    # Calibration takes a while; stream its log into the panel
+    lines = []
+    result = {}
+    def worker():
+        try:
+            result["profile"] = text_engine.autotune(model_selection, log=lines.append)
+        except Exception as e:
+            result["error"] = str(e)
+    t = threading.Thread(target=worker, daemon=True)
+    t.start()
+    while t.is_alive():
+        time.sleep(1)
+        yield "```\n" + "\n".join(lines[-12:]) + "\n```"
+    if "error" in result:
+        yield f"Autotune failed: {result['error']}"
+    else:
+        p = result["profile"]
+        yield (
+            f"**Tuned {model_selection}:** {p['prefill_tps']} tok/s prefill, {p['decode_tps']} tok/s decode  \n"
+            f"threads {p['n_threads']}/{p['n_threads_batch']}, batch {p['n_batch']}, gpu layers {p['n_gpu_layers']}, "
+            f"mmap {p['use_mmap']}, mlock {p['use_mlock']}. Applies on the next load."
+        )
 
 def add_path(p):
     text_engine.custom_dirs.append(Path(p))
-    return gr.update(choices=get_available_models())
+    image_engine.extra_dirs.append(Path(p))
+    return gr.update(choices=get_available_models(force=True)), gr.update(choices=image_engine.list_models(force=True))
 
 # --- UI ---
 
 with gr.Blocks(theme=theme, title="Antigravity AI") as demo:
     # State
     session_id = gr.State(None)
+    history_start = gr.State(0) # Index in the stored history of the first turn the chatbot shows
+    session_offset = gr.State(0) # First chat of the history list page on show
     
     with gr.Row(equal_height=True):
         gr.Markdown("## ⚡ Antigravity AI", elem_classes=["header-text"])
         status_display = gr.Markdown("", elem_id="status")
+        image_status_display = gr.Markdown("")
 
     with gr.Row():
         # --- Sidebar (History & Settings) ---
@@ -254,8 +542,13 @@ with gr.Blocks(theme=theme, title="Antigravity AI") as demo:
             new_chat_btn = gr.Button("+ New Chat", variant="primary")
             
             gr.Markdown("### 🕒 History")
+            search_box = gr.Textbox(placeholder="🔍 Search chats...", show_label=False, container=False)
             # Using Radio as a vertical list of chats
             history_list = gr.Radio(choices=refresh_session_list(), label="Recent Chats", interactive=True, container=False)
+            with gr.Row():
+                newer_chats_btn = gr.Button("◀ Newer", size="sm", variant="secondary", visible=False)
+                older_chats_btn = gr.Button("Older ▶", size="sm", variant="secondary",
+                                            visible=session_manager.count_sessions() > session_page_size())
             delete_chat_btn = gr.Button("🗑️ Delete Selected", size="sm", variant="secondary")
             
             gr.Markdown("### ⚙️ Controls")
@@ -266,18 +559,33 @@ with gr.Blocks(theme=theme, title="Antigravity AI") as demo:
                 voice_chk = gr.Checkbox(label="Voice Response")
                 voice_sel = gr.Dropdown(choices=get_voice_list(), value="en-US-AriaNeural", label="Voice")
             
+            with gr.Accordion("Image", open=False):
+                # Single-file checkpoints from the image dir and custom paths; recently used ones stay loaded
+                image_models = image_engine.list_models()
+                image_model_sel = gr.Dropdown(choices=image_models, value=image_models[0], label="Image model")
+                # Per message: add e.g. "--fast" to a draw request
+                image_preset_sel = gr.Dropdown(choices=list(image_engine.presets), value=image_engine.default_preset, label="Speed preset")
+
             with gr.Accordion("Custom Paths", open=False):
                 path_input = gr.Textbox(label="Add Path")
                 add_path_btn = gr.Button("Add")
+            
+            with gr.Accordion("Performance", open=False):
+                perf_display = gr.Markdown(get_perf_status())
+                perf_refresh_btn = gr.Button("Refresh", size="sm")
+                autotune_btn = gr.Button("Autotune Selected Model", size="sm")
+                autotune_display = gr.Markdown("")
 
         # --- Main Chat ---
         with gr.Column(scale=4):
+            load_earlier_btn = gr.Button("⬆️ Load earlier messages", size="sm", variant="secondary", visible=False)
             chatbot = gr.Chatbot(
                 height=650, 
                 bubble_full_width=False,
                 show_copy_button=True,
                 avatar_images=(None, "https://api.dicebear.com/7.x/bottts/svg?seed=KD")
             )
+            full_image = gr.Image(label="Full resolution", visible=False, interactive=False)
             
             with gr.Row():
                 with gr.Column(scale=4):
@@ -290,6 +598,7 @@ with gr.Blocks(theme=theme, title="Antigravity AI") as demo:
                     )
                 with gr.Column(scale=1, min_width=100):
                     send_btn = gr.Button("➤ Send", variant="primary", size="lg")
+                    stop_btn = gr.Button("⏹️ Stop", variant="secondary", size="lg")
             
             with gr.Row():
                 mic_btn = gr.Audio(sources=["microphone"], type="filepath", label="Voice Input", show_label=False, scale=1)
@@ -303,33 +612,60 @@ with gr.Blocks(theme=theme, title="Antigravity AI") as demo:
     # Init
     def on_load():
         # Cleanup empty
-        session_manager.cleanup_empty_sessions()
+        # Only stale ones: other tabs may hold a fresh empty session of their own
+        session_manager.cleanup_empty_sessions(config.get_nested(["sessions", "empty_max_age"], 86400))
+        # Images made outside a chat session are kept for a day, then collected like orphans
+        image_store.sweep_unowned(config.get_nested(["image", "unowned_max_age"], 86400))
         sid, _ = session_manager.create_session()
-        return sid, refresh_session_list(), get_available_models()
+        return sid, *session_page(0), get_available_models()
         
-    demo.load(on_load, None, [session_id, history_list, model_selector])
+    session_page_outputs = [history_list, session_offset, newer_chats_btn, older_chats_btn]
+    demo.load(on_load, None, [session_id, *session_page_outputs, model_selector])
+    demo.load(watch_image_warmup, None, image_status_display, concurrency_limit=None)
 
     # New Chat
-    new_chat_btn.click(create_new_session, None, [session_id, chatbot, history_list])
+    new_chat_btn.click(create_new_session, None, [session_id, chatbot, *session_page_outputs, history_start, load_earlier_btn])
+
+    # Page through older chats
+    newer_chats_btn.click(newer_sessions, session_offset, session_page_outputs)
+    older_chats_btn.click(older_sessions, session_offset, session_page_outputs)
 
     # Load Chat
-    history_list.select(load_session, None, [session_id, chatbot])
+    history_list.select(load_session, None, [session_id, chatbot, history_start, load_earlier_btn])
+    chatbot.select(show_full_image, None, full_image)
+    load_earlier_btn.click(load_earlier, [session_id, history_start, chatbot], [chatbot, history_start, load_earlier_btn])
     
+    # Search Chats
+    search_box.change(search_chats, [search_box, session_offset], history_list, trigger_mode="always_last")
+
     # Delete Chat
-    delete_chat_btn.click(delete_current_session, history_list, [history_list, session_id, chatbot])
+    delete_chat_btn.click(delete_current_session, [history_list, session_offset], [*session_page_outputs, session_id, chatbot, history_start, load_earlier_btn])
 
     # Model Change
-    model_selector.change(handle_model_change, model_selector, [model_selector, status_display])
+    model_selector.change(handle_model_change, model_selector, [model_selector, status_display], concurrency_limit=None)
+
+    # Performance
+    perf_refresh_btn.click(get_perf_status, None, perf_display)
+    autotune_btn.click(run_autotune, model_selector, autotune_display)
 
     # Custom Path
-    add_path_btn.click(add_path, path_input, model_selector)
+    add_path_btn.click(add_path, path_input, [model_selector, image_model_sel])
 
     # Chat Flow
-    chat_inputs = [msg_input, chatbot, session_id, personality_selector, voice_chk, voice_sel]
+    chat_inputs = [msg_input, chatbot, session_id, personality_selector, voice_chk, voice_sel, image_preset_sel, image_model_sel, session_offset]
     chat_outputs = [chatbot, audio_out, history_list]
     
-    msg_input.submit(chat_turn, chat_inputs, chat_outputs).then(lambda: "", None, msg_input)
-    send_btn.click(chat_turn, chat_inputs, chat_outputs).then(lambda: "", None, msg_input)
+    # A new message first stops the reply still streaming in this tab, freeing its worker
+    # No Gradio concurrency limit here: the generation scheduler bounds and orders the model work
+    # Titles for new chats are written in the background; the history list updates once one lands
+    msg_input.submit(cancel_reply, None, None, queue=False).then(chat_turn, chat_inputs, chat_outputs, concurrency_limit=None).then(lambda: "", None, msg_input).then(wait_for_title, [session_id, session_offset], history_list, concurrency_limit=None)
+    send_btn.click(cancel_reply, None, None, queue=False).then(chat_turn, chat_inputs, chat_outputs, concurrency_limit=None).then(lambda: "", None, msg_input).then(wait_for_title, [session_id, session_offset], history_list, concurrency_limit=None)
+    # Stops the current reply or image (the denoising loop ends at the next step)
+    stop_btn.click(cancel_reply, None, None, queue=False)
+
+    # Closing the tab stops any reply still being generated for it
+    if hasattr(demo, "unload"):
+        demo.unload(cancel_reply)
 
     # Voice Input Flow
     # When audio is recorded/stopped, transcribe it and put it in msg_input
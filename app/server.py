@@ -0,0 +1,358 @@
+"""
+Headless OpenAI-compatible HTTP server for the local engines.
+
+    python app/server.py --host 127.0.0.1 --port 8000
+
+Endpoints: GET /v1/models, POST /v1/chat/completions (SSE when "stream": true),
+POST /v1/images/generations, POST /v1/audio/speech, POST /v1/audio/transcriptions.
+Connections are HTTP/1.1 keep-alive; every client gets its own thread and LLM work
+goes through the same GenerationScheduler the UI uses.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Add parent dir
+sys.path.append(str(Path(__file__).parent.parent))
+
+from app.backend.config_manager import ConfigManager
+from app.backend.runtime import Runtime
+
+# Voice is only needed by /v1/audio/speech and is optional for a text-only server
+try:
+    from app.backend.voice_engine import VoiceEngine
+except ImportError:
+    VoiceEngine = None
+
+# --- Initialization ---
+# Same engines as the UI; the image and STT stacks are heavy and optional here
+config = ConfigManager()
+runtime = Runtime(config, optional_engines=True)
+models_root = runtime.models_root
+governor = runtime.governor
+text_engine = runtime.text_engine
+image_engine = runtime.image_engine
+stt_engine = runtime.stt_engine
+session_manager = runtime.session_manager
+scheduler = runtime.scheduler
+
+# The STT engine is not thread-safe; the image engine queues and batches its own requests
+stt_lock = threading.Lock()
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def split_messages(messages):
+    """OpenAI messages -> (system_prompt, [[user, assistant], ...], prompt)."""
+    system_parts, history, pending_user = [], [], None
+    for m in messages:
+        role, content = m.get("role"), m.get("content") or ""
+        if isinstance(content, list): # Content parts: keep the text ones
+            content = "".join(p.get("text", "") for p in content if isinstance(p, dict))
+        if role == "system":
+            system_parts.append(content)
+        elif role == "user":
+            if pending_user is not None:
+                history.append([pending_user, ""])
+            pending_user = content
+        elif role == "assistant":
+            history.append([pending_user or "", content])
+            pending_user = None
+    if pending_user is None:
+        raise APIError(400, "The last message must come from the user.")
+    return "\n".join(system_parts) or "You are a helpful assistant.", history, pending_user
+
+def select_model(name):
+    """
+    The model one request runs on: name, or the server's default model. Loading another
+    model does not change the default, so concurrent clients never switch each other's model.
+    """
+    name = name or text_engine.model_name
+    if not name:
+        raise APIError(400, "No model loaded. Pass \"model\" with a GGUF file name from /v1/models.")
+    if name != text_engine.model_name:
+        msg = text_engine.load_model_async(name, select=False)
+        if msg.startswith("Error"):
+            raise APIError(404, msg)
+    return name
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+    server_version = "AntigravityAI"
+
+    def log_message(self, format, *args):
+        if config.get_nested(["server", "log_requests"], False):
+            super().log_message(format, *args)
+
+    # --- Plumbing ---
+
+    def _check_auth(self):
+        key = config.get_nested(["server", "api_key"])
+        if key and self.headers.get("Authorization") != f"Bearer {key}":
+            raise APIError(401, "Invalid API key.")
+
+    def _body(self):
+        self._body_read = True
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json_body(self):
+        try:
+            return json.loads(self._body() or b"{}")
+        except json.JSONDecodeError:
+            raise APIError(400, "Request body is not valid JSON.")
+
+    def _send(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, {"error": {"message": message, "type": "invalid_request_error" if status < 500 else "server_error"}})
+
+    def _start_chunked(self, content_type):
+        self._streaming = True
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked") # Keeps the connection reusable after the stream
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _dispatch(self, routes):
+        path = self.path.split("?")[0].rstrip("/")
+        handler = routes.get(path)
+        self._body_read = False
+        self._streaming = False
+        try:
+            if not handler:
+                raise APIError(404, f"Unknown endpoint {path}")
+            self._check_auth()
+            handler()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            if self._streaming:
+                # Headers are gone already; the only honest signal left is dropping the connection
+                self.close_connection = True
+                return
+            if not self._body_read and self.headers.get("Content-Length"):
+                # An unread body would be parsed as the next request on this connection
+                self.close_connection = True
+            if isinstance(e, APIError):
+                self._send_error(e.status, e.message)
+            else:
+                self._send_error(500, str(e))
+
+    def do_GET(self):
+        self._dispatch({"/v1/models": self.list_models, "/health": self.health})
+
+    def do_POST(self):
+        self._dispatch({
+            "/v1/chat/completions": self.chat_completions,
+            "/v1/images/generations": self.image_generations,
+            "/v1/audio/speech": self.audio_speech,
+            "/v1/audio/transcriptions": self.audio_transcriptions,
+        })
+
+    # --- Endpoints ---
+
+    def health(self):
+        self._send(200, {
+            "status": "ok", "model": text_engine.model_name, "scheduler": scheduler.stats(), "memory": governor.status(),
+            "image": image_engine.last_run if image_engine else None # Size, s/MP and peak memory of the last image batch
+        })
+
+    def list_models(self):
+        created = int(time.time())
+        data = [{"id": name, "object": "model", "created": created, "owned_by": "local"} for name in text_engine.list_models()]
+        self._send(200, {"object": "list", "data": data})
+
+    def chat_completions(self):
+        body = self._json_body()
+        system_prompt, history, prompt = split_messages(body.get("messages") or [])
+        model_name = select_model(body.get("model"))
+        text_engine.wait_for_model(model_name=model_name)
+
+        # Extension: a session_id reuses that session's KV cache and records the turn
+        session_id = body.get("session_id")
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+
+        cancel_event = threading.Event()
+        job = scheduler.submit(
+            lambda replica: text_engine.generate_stream(prompt, history, system_prompt, cancel_event=cancel_event,
+                                                        session_id=session_id, max_tokens=max_tokens, replica=replica,
+                                                        model_name=model_name),
+            session_key=session_id or self.client_address[0]
+        )
+        if job is None:
+            raise APIError(429, "Generation queue is full, retry later.")
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        reply = []
+
+        try:
+            if body.get("stream"):
+                def event(delta, finish=None):
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model_name,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+                    self._write_chunk(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+
+                self._start_chunked("text/event-stream")
+                event({"role": "assistant"})
+                for delta in job.stream(cancel_event):
+                    if not reply:
+                        delta = delta.lstrip()
+                    reply.append(delta)
+                    event({"content": delta})
+                event({}, "stop")
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"") # Terminating chunk
+            else:
+                reply = list(job.stream(cancel_event))
+                text = "".join(reply).strip()
+                self._send(200, {
+                    "id": completion_id, "object": "chat.completion", "created": created, "model": model_name,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"completion_tokens": len(reply)}
+                })
+        finally:
+            # A client that hangs up mid-stream stops the generation
+            cancel_event.set()
+
+        if session_id and session_manager.get_session(session_id):
+            session_manager.update_session(session_id, history + [[prompt, "".join(reply).strip()]])
+
+    def image_generations(self):
+        if not image_engine:
+            raise APIError(501, "Image generation is not available (diffusers/torch not installed).")
+        body = self._json_body()
+        prompt = body.get("prompt")
+        if not prompt:
+            raise APIError(400, "\"prompt\" is required.")
+        n = int(body.get("n") or 1)
+
+        # Extensions: a "seed" makes the request deterministic, and repeats are served from the result cache;
+        # "preset" picks a speed preset (scheduler, steps, size, guidance). "model" is honoured when it
+        # names a local image model, so clients that always send e.g. "dall-e-3" still work
+        seed = body.get("seed")
+        preset = body.get("preset")
+        model = body.get("model")
+        if model not in image_engine.list_models():
+            model = None
+        # OpenAI-style "size": "WIDTHxHEIGHT"; above the model's native size this runs the high-resolution
+        # mode, unless the extension "hires": false asks for a single full-size pass
+        width = height = None
+        if body.get("size"):
+            try:
+                width, height = (int(v) for v in str(body["size"]).lower().split("x"))
+            except ValueError:
+                raise APIError(400, "\"size\" must look like \"1024x1024\".")
+        if preset is not None and preset not in image_engine.presets:
+            raise APIError(400, f"Unknown preset \"{preset}\". Available: {', '.join(image_engine.presets)}")
+        images, status = image_engine.generate_images(prompt, body.get("negative_prompt", ""), num_images=n,
+                                                      seed=int(seed) if seed is not None else None, preset=preset, model=model,
+                                                      width=width, height=height, hires=body.get("hires"))
+        if not images:
+            raise APIError(500, status)
+        data = []
+        for img in images:
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            data.append({"b64_json": base64.b64encode(buf.getvalue()).decode("ascii"), "revised_prompt": prompt})
+        self._send(200, {"created": int(time.time()), "data": data})
+
+    def audio_speech(self):
+        if not VoiceEngine:
+            raise APIError(501, "Text to speech is not available (edge-tts/soundfile not installed).")
+        body = self._json_body()
+        text = body.get("input")
+        if not text:
+            raise APIError(400, "\"input\" is required.")
+        voice = body.get("voice") or config.get_nested(["preferences", "voice_id"], "en-US-AriaNeural")
+
+        engine = VoiceEngine(os.path.join(models_root, "voice"))
+        loop = asyncio.new_event_loop()
+        try:
+            path = loop.run_until_complete(engine.text_to_speech(text, voice))
+        finally:
+            loop.close()
+        if not path:
+            raise APIError(500, f"Speech synthesis failed for voice {voice}.")
+        with open(path, "rb") as f:
+            audio = f.read()
+        os.remove(path)
+        # Kokoro writes WAV, Edge TTS streams MP3 data
+        self._send(200, audio, "audio/wav" if voice.startswith("lokal-") else "audio/mpeg")
+
+    def audio_transcriptions(self):
+        if not stt_engine:
+            raise APIError(501, "Transcription is not available (faster-whisper not installed).")
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            raise APIError(400, "Send the audio as multipart/form-data with a \"file\" field.")
+
+        # Parse the multipart body with the email parser (the cgi module is gone in newer Pythons)
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + self._body()
+        )
+        upload = next((part for part in message.iter_parts() if part.get_param("name", header="content-disposition") == "file"), None)
+        if upload is None:
+            raise APIError(400, "Missing \"file\" field.")
+
+        suffix = Path(upload.get_filename() or "audio.wav").suffix or ".wav"
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(upload.get_payload(decode=True))
+            with stt_lock:
+                text = stt_engine.transcribe(path)
+        finally:
+            os.remove(path)
+        self._send(200, {"text": text})
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless OpenAI-compatible API for Antigravity AI")
+    parser.add_argument("--host", default=config.get_nested(["server", "host"], "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=config.get_nested(["server", "port"], 8000))
+    parser.add_argument("--model", help="GGUF file name to load at startup")
+    args = parser.parse_args()
+
+    if args.model:
+        print(text_engine.load_model(args.model))
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Serving OpenAI-compatible API on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
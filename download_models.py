@@ -6,34 +6,49 @@ MODELS_DIR = Path("models")
 LLM_DIR = MODELS_DIR / "llm"
 
 # Models to download
+# params_b (billions of parameters) and size_gb (file size) let the UI filter by hardware
 MODELS = [
     {
         "url": "https://huggingface.co/bartowski/Llama-3.2-1B-Instruct-GGUF/resolve/main/Llama-3.2-1B-Instruct-Q4_K_M.gguf",
-        "name": "Llama-3.2-1B-Instruct-Q4_K_M.gguf"
+        "name": "Llama-3.2-1B-Instruct-Q4_K_M.gguf",
+        "params_b": 1.24,
+        "size_gb": 0.81
     },
     {
         "url": "https://huggingface.co/bartowski/Llama-3.2-3B-Instruct-GGUF/resolve/main/Llama-3.2-3B-Instruct-Q4_K_M.gguf",
-        "name": "Llama-3.2-3B-Instruct-Q4_K_M.gguf"
+        "name": "Llama-3.2-3B-Instruct-Q4_K_M.gguf",
+        "params_b": 3.21,
+        "size_gb": 2.02
     },
     {
         "url": "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.2-GGUF/resolve/main/mistral-7b-instruct-v0.2.Q4_K_M.gguf",
-        "name": "mistral-7b-instruct-v0.2.Q4_K_M.gguf"
+        "name": "mistral-7b-instruct-v0.2.Q4_K_M.gguf",
+        "params_b": 7.24,
+        "size_gb": 4.37
     },
     {
         "url": "https://huggingface.co/TheBloke/OpenHermes-2.5-Mistral-7B-GGUF/resolve/main/openhermes-2.5-mistral-7b.Q4_K_M.gguf",
-        "name": "openhermes-2.5-mistral-7b.Q4_K_M.gguf"
+        "name": "openhermes-2.5-mistral-7b.Q4_K_M.gguf",
+        "params_b": 7.24,
+        "size_gb": 4.37
     },
     {
         "url": "https://huggingface.co/TheBloke/Gemma-7b-it-GGUF/resolve/main/gemma-7b-it.Q4_K_M.gguf",
-        "name": "gemma-7b-it.Q4_K_M.gguf"
+        "name": "gemma-7b-it.Q4_K_M.gguf",
+        "params_b": 8.54,
+        "size_gb": 5.33
     },
     {
         "url": "https://huggingface.co/TheBloke/Phi-3-mini-4k-instruct-GGUF/resolve/main/Phi-3-mini-4k-instruct.Q4_K_M.gguf",
-        "name": "Phi-3-mini-4k-instruct.Q4_K_M.gguf"
+        "name": "Phi-3-mini-4k-instruct.Q4_K_M.gguf",
+        "params_b": 3.82,
+        "size_gb": 2.39
     },
     {
         "url": "https://huggingface.co/MaziyarPanahi/Llama-3-8B-Instruct-GGUF/resolve/main/Llama-3-8B-Instruct.Q4_K_M.gguf",
-        "name": "Llama-3-8B-Instruct.Q4_K_M.gguf"
+        "name": "Llama-3-8B-Instruct.Q4_K_M.gguf",
+        "params_b": 8.03,
+        "size_gb": 4.92
     }
 ]
 
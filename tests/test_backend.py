@@ -32,5 +32,980 @@ def test_imports():
     except ImportError as e:
         print(f"Failed to import ImageEngine: {e}")
 
+class FakeState:
+    def __init__(self, tag, input_ids):
+        self.llama_state_size = 1024
+        self.tag = tag
+        self.input_ids = input_ids
+
+class FakeLlama:
+    """Stands in for llama_cpp.Llama: one token per word, streams one chunk per word."""
+    def __init__(self, reply="Hello there friend"):
+        self.reply = reply
+        self.prompts = []
+        self.input_ids = []
+        self.n_tokens = 0
+        self.loaded_states = []
+        self.evaluated = []
+
+    def __call__(self, prompt, stream=False, **kwargs):
+        self.prompts.append(prompt)
+        self.input_ids = self.tokenize(prompt)
+        self.n_tokens = len(self.input_ids)
+        words = self.reply.split(" ")
+        chunks = [{"choices": [{"text": (" " if i else "") + w}]} for i, w in enumerate(words)]
+        if stream:
+            return (c for c in chunks)
+        return {"choices": [{"text": self.reply}]}
+
+    def tokenize(self, text, add_bos=True, special=False):
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        return text.split()
+
+    def n_ctx(self):
+        return 4096
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self.evaluated.append(list(tokens))
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return FakeState(self.prompts[-1] if self.prompts else None, list(self.input_ids[:self.n_tokens]))
+
+    def load_state(self, state):
+        self.loaded_states.append(state.tag)
+        self.input_ids = list(state.input_ids)
+        self.n_tokens = len(self.input_ids)
+
+def test_text_stream(tmp_path):
+    import threading
+    from app.backend.text_engine import TextEngine
+
+    engine = TextEngine(tmp_path / "llm")
+    engine.model = FakeLlama()
+
+    deltas = list(engine.generate_stream("hi", [["a", "b"]], "sys"))
+    assert "".join(deltas) == "Hello there friend"
+    assert engine.model.prompts[-1].endswith("<|user|>\nhi</s>\n<|assistant|>\n")
+    assert engine.generate("hi") == "Hello there friend"
+
+    # A set cancel event stops the stream before any delta is produced
+    cancel = threading.Event()
+    cancel.set()
+    assert list(engine.generate_stream("hi", cancel_event=cancel)) == []
+
+def test_session_state_cache(tmp_path):
+    from app.backend.state_cache import StateCache
+    from app.backend.text_engine import TextEngine
+
+    cache = StateCache(max_entries=2, ram_budget_mb=1)
+    for key in ("a", "b", "c"):
+        cache.put(key, type("S", (), {"llama_state_size": 10})())
+    assert cache.get("a") is None and cache.get("c") is not None
+
+    engine = TextEngine(tmp_path / "llm")
+    engine.model = FakeLlama()
+    engine.generate("first", session_id="s1")
+    engine.generate("other", session_id="s2")
+    # Switching back restores the snapshot taken when s1 was swapped out
+    engine.generate("second", session_id="s1")
+    assert len(engine.model.loaded_states) == 1
+    assert "first" in engine.model.loaded_states[0]
+
+def test_context_budget(tmp_path):
+    from app.backend.context_manager import ContextManager
+    from app.backend.text_engine import TextEngine
+
+    engine = TextEngine(tmp_path / "llm")
+    engine.model_name = "fake.gguf"
+    engine.model = FakeLlama(reply="short summary")
+    manager = ContextManager(engine, budget=400)
+
+    history = [[f"question {i} " + "word " * 30, "answer " * 10] for i in range(10)]
+    session = {}
+    system_prompt, fitted = manager.fit(session, history, "next", "sys")
+    assert len(fitted) < len(history)
+    assert history[-1] == fitted[-1]
+    assert "short summary" in system_prompt
+    assert len(session["context"]["counts"]) == len(history)
+
+    # Same history again: cached counts and summary are reused, no new model calls
+    calls = len(engine.model.prompts)
+    assert manager.fit(session, history, "next", "sys")[1] == fitted
+    assert len(engine.model.prompts) == calls
+
+    # With a scheduler the summary is a queued job, counted like any other generation
+    from app.backend.scheduler import GenerationScheduler
+    scheduler = GenerationScheduler(replicas=1)
+    manager = ContextManager(engine, budget=400, scheduler=scheduler)
+    system_prompt, _ = manager.fit({"id": "s1"}, history, "next", "sys")
+    assert "short summary" in system_prompt
+    assert scheduler.stats()["served"] == 1
+
+def test_context_fit_after_eviction(tmp_path, monkeypatch):
+    from app.backend import text_engine as text_module
+    from app.backend.context_manager import ContextManager
+    from app.backend.memory_governor import MemoryGovernor
+
+    monkeypatch.setattr(text_module, "Llama", lambda **kwargs: FakeLlama(reply="short summary"))
+    (tmp_path / "llm").mkdir()
+    with open(tmp_path / "llm" / "m.gguf", "wb") as f:
+        f.truncate(2 * 1024**2)
+    governor = MemoryGovernor(ram_budget_mb=3)
+    engine = text_module.TextEngine(tmp_path / "llm", governor=governor)
+    engine.model_map["m.gguf"] = tmp_path / "llm" / "m.gguf"
+    assert engine.load_model("m.gguf").startswith("Loaded")
+
+    # An image pipeline needs the memory: the idle LLM is evicted
+    governor.reserve("image:sd15", "image", "ram", 2, release=lambda: True)
+    assert engine.model is None and engine.model_status() is None
+
+    # What a chat turn does first: reload the selected model, so the history is fitted, not sent whole
+    assert engine.ensure_loaded() in ("loading", "ready")
+    engine.wait_for_model()
+    assert engine.model is not None
+    history = [[f"question {i} " + "word " * 30, "answer " * 10] for i in range(10)]
+    _, fitted = ContextManager(engine, budget=400).fit({}, history, "next", "sys")
+    assert 0 < len(fitted) < len(history)
+
+def test_model_pool_lru():
+    import time
+    from app.backend.model_pool import ModelPool
+
+    evicted = []
+    pool = ModelPool(max_models=2, on_evict=evicted.append)
+
+    def slow_loader():
+        time.sleep(0.05)
+        return FakeLlama()
+
+    entry = pool.load_async("a", slow_loader)
+    assert entry.status == "loading"
+    assert pool.get("a") is not None and entry.status == "ready"
+
+    pool.load_async("b", FakeLlama)
+    pool.get("b")
+    with pool.use("a"):
+        # "a" is pinned and most recently used, so loading "c" evicts "b"
+        pool.load_async("c", FakeLlama)
+        pool.get("c")
+    assert evicted == ["b"]
+    assert [e["name"] for e in pool.status()] == ["a", "c"]
+
+    # A pinned model cannot be evicted; with nothing idle the load goes over budget and says so
+    pool = ModelPool(max_models=1)
+    pool.put("a", FakeLlama())
+    with pool.use("a") as model:
+        assert model is not None and not pool.evict("a")
+        pool.load_async("b", FakeLlama)
+        pool.get("b")
+    assert pool.entry("b").warning and pool.status()[-1]["warning"] == pool.entry("b").warning
+    assert pool.evict("a")
+    with pool.use("a") as model:
+        assert model is None
+
+def test_scheduler_round_robin():
+    import threading
+    from app.backend.scheduler import GenerationScheduler
+
+    scheduler = GenerationScheduler(replicas=1, max_queue=3)
+    gate = threading.Event()
+    order = []
+
+    def job(name):
+        def run(replica):
+            gate.wait()
+            order.append(name)
+            yield name
+        return run
+
+    blocker = scheduler.submit(job("busy"), session_key="x")
+    while scheduler.stats()["running"] == 0:
+        pass
+    jobs = [scheduler.submit(job(n), session_key=n[0]) for n in ("a1", "a2", "b1")]
+    assert scheduler.submit(job("c1"), session_key="c") is None # Queue is full
+    gate.set()
+    for j in [blocker] + jobs:
+        list(j.stream())
+    # Session "b" is served before the second job of session "a"
+    assert order == ["busy", "a1", "b1", "a2"]
+    assert scheduler.stats()["rejected"] == 1
+
+    # Low-priority jobs wait until no normal job is pending
+    gate.clear()
+    order.clear()
+    blocker = scheduler.submit(job("busy"), session_key="x")
+    while scheduler.stats()["running"] == 0:
+        pass
+    low = scheduler.submit(job("title"), session_key="a", priority="low")
+    normal = scheduler.submit(job("reply"), session_key="b")
+    gate.set()
+    assert low.done.wait(2)
+    assert order == ["busy", "reply", "title"]
+
+def test_server_chat_completions(tmp_path, monkeypatch):
+    import http.client
+    import json
+    import threading
+    from http.server import ThreadingHTTPServer
+
+    # The server module builds its engines on import, from paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    from app import server
+    from app.backend.scheduler import GenerationScheduler
+    from app.backend.session_manager import SessionManager
+    from app.backend.text_engine import TextEngine
+
+    engine = TextEngine(tmp_path / "llm")
+    monkeypatch.setattr(server, "text_engine", engine)
+    monkeypatch.setattr(server, "scheduler", GenerationScheduler(replicas=1))
+    monkeypatch.setattr(server, "session_manager", SessionManager(tmp_path / "sessions"))
+    monkeypatch.setitem(server.config.config, "server", {})
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    def post(body, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=10)
+        raw = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        conn.request("POST", "/v1/chat/completions", raw, {"Content-Type": "application/json", **(headers or {})})
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp.status, resp.getheader("Content-Type"), data
+
+    hi = [{"role": "user", "content": "hi"}]
+    try:
+        # No model loaded, or a model that does not exist
+        assert post({"messages": hi})[0] == 400
+        status, _, data = post({"model": "missing.gguf", "messages": hi})
+        assert status == 404 and json.loads(data)["error"]["message"].startswith("Error")
+
+        engine.model = FakeLlama()
+        # The conversation must end with a user message, and the body must be JSON
+        assert post({"messages": [{"role": "assistant", "content": "hello"}]})[0] == 400
+        assert post(b"{not json")[0] == 400
+
+        status, content_type, data = post({"messages": hi})
+        reply = json.loads(data)
+        assert status == 200 and content_type == "application/json"
+        assert reply["model"] == "default"
+        assert reply["choices"][0]["message"]["content"] == "Hello there friend"
+
+        status, content_type, data = post({"messages": hi, "stream": True})
+        assert status == 200 and content_type == "text/event-stream"
+        events = [line[6:] for line in data.decode("utf-8").split("\n") if line.startswith("data: ")]
+        assert events[-1] == "[DONE]"
+        chunks = [json.loads(e) for e in events[:-1]]
+        assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+        assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+        assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks) == "Hello there friend"
+
+        # A failed per-request model leaves the server's default alone
+        assert post({"model": "missing.gguf", "messages": hi})[0] == 404
+        assert engine.model_name == "default"
+
+        monkeypatch.setitem(server.config.config, "server", {"api_key": "secret"})
+        assert post({"messages": hi})[0] == 401
+        assert post({"messages": hi}, {"Authorization": "Bearer wrong"})[0] == 401
+        assert post({"messages": hi}, {"Authorization": "Bearer secret"})[0] == 200
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    # Requests name their model without switching the one other requests use
+    engine.pool.put("other", FakeLlama("Other model"))
+    assert engine.generate("hi", model_name="other") == "Other model"
+    assert engine.generate("hi") == "Hello there friend"
+    assert engine.model_name == "default"
+
+def write_gguf(path, n_vocab=3):
+    """Writes a minimal GGUF v3 file: a few metadata keys and two tensor infos."""
+    import struct
+
+    def string(v):
+        b = v.encode()
+        return struct.pack("<Q", len(b)) + b
+
+    kvs = [
+        string("general.architecture") + struct.pack("<I", 8) + string("llama"),
+        string("general.file_type") + struct.pack("<I", 4) + struct.pack("<I", 15),
+        string("llama.context_length") + struct.pack("<I", 4) + struct.pack("<I", 8192),
+        string("tokenizer.ggml.tokens") + struct.pack("<IIQ", 9, 8, n_vocab) + b"".join(string(f"t{i}") for i in range(n_vocab)),
+        string("tokenizer.chat_template") + struct.pack("<I", 8) + string("{{ messages }}"),
+    ]
+    tensors = [
+        string("tok_embd") + struct.pack("<I", 2) + struct.pack("<QQ", 4, n_vocab) + struct.pack("<IQ", 0, 0),
+        string("output") + struct.pack("<I", 1) + struct.pack("<Q", 10) + struct.pack("<IQ", 0, 0),
+    ]
+    with open(path, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(kvs)) + b"".join(kvs) + b"".join(tensors))
+
+def test_model_catalog(tmp_path):
+    from app.backend.model_catalog import ModelCatalog, read_gguf_metadata
+
+    write_gguf(tmp_path / "tiny.gguf")
+    meta = read_gguf_metadata(tmp_path / "tiny.gguf")
+    assert meta["architecture"] == "llama"
+    assert meta["quantization"] == "Q4_K_M"
+    assert meta["context_length"] == 8192
+    assert meta["vocab_size"] == 3
+    assert meta["parameters"] == 4 * 3 + 10
+    assert meta["chat_template"] == "{{ messages }}"
+
+    catalog = ModelCatalog(tmp_path / ".cache" / "catalog.json", min_interval=0)
+    assert list(catalog.refresh([tmp_path])) == ["tiny.gguf"]
+    # Saving the catalog does not touch the scanned dir, so the next refresh does not re-list it
+    assert catalog._data["dirs"][str(tmp_path)]["mtime"] == os.stat(tmp_path).st_mtime
+
+    # A fresh catalog instance reuses the saved index instead of parsing again
+    reloaded = ModelCatalog(tmp_path / ".cache" / "catalog.json", min_interval=0)
+    assert reloaded.refresh([tmp_path])["tiny.gguf"]["meta"]["parameters"] == 22
+
+    # A file growing in place is noticed even though the dir mtime stays the same
+    dir_mtime = os.stat(tmp_path).st_mtime_ns
+    write_gguf(tmp_path / "tiny.gguf", n_vocab=5)
+    os.utime(tmp_path, ns=(dir_mtime, dir_mtime))
+    assert reloaded.refresh([tmp_path])["tiny.gguf"]["meta"]["vocab_size"] == 5
+
+def test_autotune_profile_applied(tmp_path):
+    from app.backend import autotune
+    from app.backend.config_manager import ConfigManager
+    from app.backend.text_engine import TextEngine
+
+    config = ConfigManager(tmp_path / "config.json")
+    profile = {"n_gpu_layers": 0, "n_threads": 3, "n_threads_batch": 6, "n_batch": 256,
+               "use_mmap": True, "use_mlock": False, "prefill_tps": 100.0, "decode_tps": 10.0}
+    autotune.save_profile(config, "m.gguf", profile)
+
+    engine = TextEngine(tmp_path / "llm", config=ConfigManager(tmp_path / "config.json"))
+    params = engine._load_params("m.gguf", -1)
+    assert params["n_threads"] == 3 and params["n_batch"] == 256
+    # Untuned models keep the defaults
+    assert engine._load_params("other.gguf", -1)["n_gpu_layers"] == -1
+
+def test_autotune_search(tmp_path, monkeypatch):
+    from app.backend import autotune
+    from app.backend.config_manager import ConfigManager
+    from app.backend.text_engine import TextEngine
+
+    # Simulated machine: tokens/s per setting, charged to a fake clock instead of measured
+    decode_tps = {2: 5.0, 4: 8.0, 6: 10.0, 8: 9.0} # Memory-bound: peaks below the core count
+    prefill_tps = {6: 300.0, 8: 400.0}
+    batch_factor = {128: 0.8, 256: 1.0, 512: 0.9}
+    clock = [0.0]
+
+    class FakeClock:
+        @staticmethod
+        def time():
+            return clock[0]
+
+        strftime = staticmethod(autotune.time.strftime)
+
+    class TunedLlama:
+        loads = []
+
+        def __init__(self, model_path, n_ctx, verbose, **params):
+            self.params = params
+            TunedLlama.loads.append(params)
+            # Later trials load faster from a warm page cache; that must not decide anything
+            clock[0] += 2.0 if not TunedLlama.loads[:-1] else 0.5
+
+        def tokenize(self, text):
+            return list(range(len(text.split())))
+
+        def reset(self):
+            pass
+
+        def eval(self, tokens):
+            if len(tokens) > 1:
+                p = self.params
+                clock[0] += len(tokens) / (prefill_tps[p["n_threads_batch"]] * batch_factor[p["n_batch"]])
+            else:
+                clock[0] += 1 / decode_tps[self.params["n_threads"]] / (1.2 if self.params["use_mlock"] else 1.0)
+
+    monkeypatch.setattr(autotune, "Llama", TunedLlama)
+    monkeypatch.setattr(autotune, "total_ram_mb", lambda: 16000)
+    monkeypatch.setattr(autotune, "time", FakeClock)
+
+    (tmp_path / "llm").mkdir()
+    (tmp_path / "llm" / "m.gguf").write_bytes(b"GGUF")
+    config = ConfigManager(tmp_path / "config.json")
+    config.update("text", {"n_threads": 8})
+    engine = TextEngine(tmp_path / "llm", config=config)
+    engine.model_map["m.gguf"] = tmp_path / "llm" / "m.gguf"
+    profile = engine.autotune("m.gguf", log=lambda *args: None)
+
+    # Each stage keeps the winner of the previous ones
+    assert (profile["n_gpu_layers"], profile["n_threads"], profile["n_threads_batch"], profile["n_batch"]) == (0, 6, 8, 256)
+    # mlock decodes faster here and there is RAM to spare; without mmap is no faster, so it is not picked
+    assert (profile["use_mmap"], profile["use_mlock"]) == (True, True)
+    assert profile["decode_tps"] == 12.0 and profile["prefill_tps"] == 400.0
+    # Coordinate search: 1 + 4 + 2 + 3 + 3 loads instead of the 4 * 2 * 3 * 3 grid
+    assert len(TunedLlama.loads) == 13
+
+    # Saved for this model and machine, and used by the next load
+    saved = autotune.load_profile(ConfigManager(tmp_path / "config.json"), "m.gguf")
+    assert saved == profile
+    params = TextEngine(tmp_path / "llm", config=ConfigManager(tmp_path / "config.json"))._load_params("m.gguf", -1)
+    assert params["n_threads"] == 6 and params["n_threads_batch"] == 8 and params["n_batch"] == 256
+
+    # Without RAM known to spare, weights are never pinned or copied: mmap only, one trial
+    monkeypatch.setattr(autotune, "total_ram_mb", lambda: None)
+    TunedLlama.loads.clear()
+    profile = autotune.autotune("m.gguf", tmp_path / "llm" / "m.gguf", max_threads=8, log=lambda *args: None)
+    assert (profile["use_mmap"], profile["use_mlock"]) == (True, False) and len(TunedLlama.loads) == 11
+
+def test_speculative_draft_selection():
+    from app.backend.speculative import SmallModelDraft, pick_draft_model
+
+    llama3 = {"tokenizer": "gpt2", "vocab_size": 128256, "bos_token_id": 128000, "eos_token_id": 128009}
+    info = {
+        "Llama-3-8B.gguf": {"meta": dict(llama3, parameters=8.0e9)},
+        "Llama-3.2-1B.gguf": {"meta": dict(llama3, parameters=1.2e9)},
+        "Llama-3.2-3B.gguf": {"meta": dict(llama3, parameters=3.2e9)},
+        "mistral-7b.gguf": {"meta": {"tokenizer": "llama", "vocab_size": 32000, "parameters": 7.2e9}},
+    }
+    # 3B is more than a quarter of 8B, Mistral has another tokenizer
+    assert pick_draft_model("Llama-3-8B.gguf", info) == "Llama-3.2-1B.gguf"
+    assert pick_draft_model("mistral-7b.gguf", info) is None
+
+    draft = SmallModelDraft(draft_llama=None)
+    draft._last_input = [1, 2]
+    draft._last_proposal = [5, 6, 7]
+    draft.proposed = 3
+    # Target kept 5 and 6, then sampled 9 instead of 7
+    draft._score_last_proposal([1, 2, 5, 6, 9])
+    assert draft.stats()["accepted"] == 2
+
+def test_persona_prefix_snapshots(tmp_path):
+    from app.backend.text_engine import TextEngine
+
+    (tmp_path / "llm").mkdir()
+    model_file = tmp_path / "llm" / "fake.gguf"
+    model_file.write_bytes(b"GGUF")
+    persona = "You are a storyteller with a very long persona prompt"
+
+    def make_engine():
+        engine = TextEngine(tmp_path / "llm")
+        engine.model_map["fake.gguf"] = model_file
+        engine.model_name = "fake.gguf"
+        engine.model = FakeLlama()
+        engine.register_personas([persona])
+        return engine
+
+    # First use evaluates the prefix once and saves it to disk
+    engine = make_engine()
+    engine.generate("hi", [], persona, session_id="s1")
+    assert len(engine.model.evaluated) == 1
+    assert len(list((tmp_path / "llm" / ".prefix_cache").glob("*.state"))) == 1
+
+    # A fresh process restores the snapshot instead of evaluating it again
+    engine = make_engine()
+    engine.generate("hi", [], persona, session_id="s2")
+    assert engine.model.evaluated == []
+    assert len(engine.model.loaded_states) == 1
+
+def test_prefix_store_memory_bound(tmp_path):
+    from app.backend.state_cache import PrefixStore
+
+    # Only the most recently used snapshots stay in memory; older ones are read back from disk
+    store = PrefixStore(tmp_path, max_files=8, memory_entries=2)
+    for tag in ("a", "b", "c"):
+        store.put(tag, FakeState(tag, [tag]))
+    assert store._memory.stats()["entries"] == 2
+    assert store._memory.get("a") is None
+    assert store.get("a").tag == "a"
+    assert store._memory.stats()["entries"] == 2
+
+    # Pruned files leave memory too
+    store = PrefixStore(tmp_path / "small", max_files=1)
+    store.put("a", FakeState("a", []))
+    os.utime(tmp_path / "small" / "a.state", (1, 1))
+    store.put("b", FakeState("b", []))
+    assert store.get("a") is None and store.get("b").tag == "b"
+
+def test_session_index(tmp_path):
+    import json
+    from app.backend.session_manager import SessionManager
+
+    # A session file from before the index existed gets migrated on first start
+    legacy = {"id": "old", "title": "Legacy", "created_at": "2024-01-01T00:00:00", "history": [["a", "b"]]}
+    (tmp_path / "old.json").write_text(json.dumps(legacy))
+
+    manager = SessionManager(tmp_path)
+    sid, _ = manager.create_session()
+    manager.update_session(sid, [["hi", "hello"]], "Greeting")
+    empty, _ = manager.create_session()
+
+    titles = [s["title"] for s in manager.list_sessions()]
+    assert titles == ["New Chat", "Greeting", "Legacy"]
+    assert [s["id"] for s in manager.list_sessions(limit=1, offset=2)] == ["old"]
+    assert manager.list_sessions(order_by="title", descending=False)[0]["title"] == "Greeting"
+
+    # A fresh empty session may still be open in a tab; only stale, unused ones go
+    assert manager.cleanup_empty_sessions() == 0
+    assert SessionManager(tmp_path).cleanup_empty_sessions(max_age=0) == 1
+    assert SessionManager(tmp_path).get_session(empty) is None
+    manager.delete_session("old")
+    assert manager.count_sessions() == 1
+
+def test_session_cleanup_keeps_live_sessions(tmp_path):
+    from app.backend.session_manager import SessionManager
+
+    # Tab 1 opens a chat; tab 2 connecting runs the page-load cleanup before creating its own
+    manager = SessionManager(tmp_path, flush_delay=0)
+    first, _ = manager.create_session()
+    manager.cleanup_empty_sessions()
+    second, _ = manager.create_session()
+    # Even a cleanup with no age threshold keeps sessions a client holds
+    assert manager.cleanup_empty_sessions(max_age=0) == 0
+
+    manager.update_session(first, [["hi", "hello"]])
+    assert manager.get_session(first)["history"] == [["hi", "hello"]]
+    assert SessionManager(tmp_path).get_session(first)["history"] == [["hi", "hello"]]
+    assert manager.get_session(second) is not None
+
+def test_session_journal(tmp_path):
+    import json
+    from app.backend.session_manager import SessionManager
+
+    manager = SessionManager(tmp_path, compact_every=3, flush_delay=0)
+    sid, _ = manager.create_session()
+    history = [["hi", "hello"]]
+    manager.update_session(sid, history)
+    history = history + [("img", "Generated Image")] # Tuples compare equal to stored lists
+    manager.update_session(sid, history, extra={"context": {"cutoff": 0}})
+
+    journal = tmp_path / f"{sid}.jsonl"
+    lines = journal.read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])["at"] == 1 # Only the new turn was written
+
+    # A crash mid-append leaves a torn line that replay drops
+    with open(journal, "a") as f:
+        f.write('{"seq": 3, "at": 0, "tu')
+    data = SessionManager(tmp_path).get_session(sid)
+    assert data["history"] == [["hi", "hello"], ["img", "Generated Image"]]
+    assert data["context"] == {"cutoff": 0} and "_seq" not in data
+
+    # The third record compacts into the snapshot; a stale journal is not replayed twice
+    stale = journal.read_text()
+    manager.update_session(sid, data["history"] + [["a", "b"]], "Chat")
+    assert not journal.exists()
+    journal.write_text(stale)
+    data = SessionManager(tmp_path).get_session(sid)
+    assert len(data["history"]) == 3 and data["title"] == "Chat"
+
+    # The context cache grows with the session; records carry only its changes
+    manager = SessionManager(tmp_path, compact_every=100, flush_delay=0)
+    sid, _ = manager.create_session()
+    history, counts = [], []
+    for i in range(30):
+        session = manager.get_session(sid)
+        history.append([f"q{i}", f"a{i}"])
+        counts.append([5, 20])
+        context = dict(session.get("context", {}), model="m.gguf", counts=list(counts), cutoff=i // 10)
+        manager.update_session(sid, history, extra={"context": context})
+    lines = (tmp_path / f"{sid}.jsonl").read_text().splitlines()
+    assert len(lines[-1]) < 2 * len(lines[1])
+    assert json.loads(lines[-1])["patch"] == [{"path": ["context", "counts"], "extend": [[5, 20]]}]
+    # A changed key inside the dict, and a dict that lost keys, are written as plain values
+    assert {"path": ["context", "cutoff"], "set": 1} in json.loads(lines[10])["patch"]
+    manager.update_session(sid, history, extra={"context": {"model": "other.gguf"}})
+    last = json.loads((tmp_path / f"{sid}.jsonl").read_text().splitlines()[-1])
+    assert last["patch"] == [{"path": ["context"], "set": {"model": "other.gguf"}}]
+    manager.update_session(sid, history, extra={"context": context})
+    assert SessionManager(tmp_path).get_session(sid)["context"] == context
+
+def test_session_write_back(tmp_path):
+    from app.backend.session_manager import SessionManager
+
+    manager = SessionManager(tmp_path, cache_size=1, flush_delay=60)
+    sid, _ = manager.create_session()
+    for i in range(3):
+        history = manager.get_session(sid)["history"] + [[f"q{i}", f"a{i}"]]
+        manager.update_session(sid, history, "Busy")
+
+    # Served from memory, nothing written yet, but the listing is already current
+    journal = tmp_path / f"{sid}.jsonl"
+    assert not journal.exists()
+    assert len(manager.get_session(sid)["history"]) == 3
+    assert manager.list_sessions()[0]["title"] == "Busy"
+
+    # A dirty session is not evicted before it is written, even past cache_size
+    manager.create_session()
+    other, _ = manager.create_session()
+    assert list(manager._cache) == [sid, other]
+
+    # Edits to a returned copy do not leak into the cache
+    manager.get_session(sid)["history"][0][1] = "changed"
+    assert manager.get_session(sid)["history"][0][1] == "a0"
+
+    manager.flush()
+    assert len(journal.read_text().splitlines()) == 3 # One append for the whole batch
+    assert len(manager._cache) == 1
+    assert SessionManager(tmp_path).get_session(sid)["history"][2] == ["q2", "a2"]
+
+def test_session_write_back_all_dirty(tmp_path):
+    from app.backend.session_manager import SessionManager
+
+    # Every cached entry dirty: the session just loaded must stay until its update is applied
+    manager = SessionManager(tmp_path, cache_size=1, flush_delay=60)
+    a, _ = manager.create_session()
+    c, _ = manager.create_session()
+    manager.update_session(a, [["qa", "aa"]])
+    manager.update_session(c, [["qc", "ac"]])
+    assert manager.get_session(a)["history"] == [["qa", "aa"]]
+    assert manager.get_session(c)["history"] == [["qc", "ac"]]
+    assert {s["id"]: s["turns"] for s in manager.list_sessions()} == {a: 1, c: 1}
+
+    # Entries leave only once written, and reload with their updates
+    manager.flush()
+    assert len(manager._cache) == 1
+    fresh = SessionManager(tmp_path)
+    assert fresh.get_session(a)["history"] == [["qa", "aa"]]
+    assert fresh.get_session(c)["history"] == [["qc", "ac"]]
+
+def test_session_search(tmp_path):
+    from app.backend.session_manager import SessionManager
+
+    manager = SessionManager(tmp_path)
+    baking, _ = manager.create_session()
+    manager.update_session(baking, [["how do I bake bread", "Flour, water and yeast."]], "Baking")
+    coding, _ = manager.create_session()
+    manager.update_session(coding, [["sort a list in python", "Use sorted()."], ["and bread?", "Bread, bread, bread."]], "Python help")
+
+    hits = manager.search_sessions("bread")
+    assert [h["id"] for h in hits] == [coding, baking] # Denser match ranks first
+    assert hits[0]["turn"] == 1 and "**bread**" in hits[0]["snippet"].lower()
+    assert manager.search_sessions("pyth")[0]["turn"] == -1 # Prefix match on the title
+    assert manager.search_sessions('"unbalanced AND (') == []
+
+    # Rewritten turns and deleted sessions leave the index
+    manager.update_session(coding, [["sort a list in python", "Use sorted()."]])
+    manager.delete_session(baking)
+    assert manager.search_sessions("bread") == []
+
+    manager.fts = False # LIKE fallback for SQLite builds without FTS5
+    assert manager.search_sessions("sorted")[0]["id"] == coding
+
+def test_history_window(tmp_path):
+    from app.backend.session_manager import SessionManager
+
+    manager = SessionManager(tmp_path)
+    sid, _ = manager.create_session()
+    manager.update_session(sid, [[f"q{i}", f"a{i}"] for i in range(7)])
+
+    window = manager.get_history_window(sid, 3)
+    assert window["turns"][0] == ["q4", "a4"] and window["start"] == 4 and window["total"] == 7
+    window = manager.get_history_window(sid, 3, before=window["start"])
+    assert [t[0] for t in window["turns"]] == ["q1", "q2", "q3"]
+    window = manager.get_history_window(sid, 3, before=window["start"])
+    assert window["turns"] == [["q0", "a0"]] and window["start"] == 0
+    assert manager.get_history_window("missing", 3) is None
+
+def test_image_batcher():
+    import threading
+    from app.backend.image_batcher import ImageBatcher
+
+    calls = []
+    def run_batch(key, requests):
+        calls.append((key, [r.prompt for r in requests]))
+        return [[f"{r.prompt}-{i}" for i in range(r.n)] for r in requests]
+
+    batcher = ImageBatcher(run_batch, max_batch=4, max_wait=0.2)
+    results = {}
+    def ask(prompt, key, n=1):
+        results[prompt] = batcher.generate(prompt, "", key, n)
+
+    threads = [threading.Thread(target=ask, args=(p, k)) for p, k in (("a", 25), ("b", 25), ("c", 30), ("d", 25))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Same settings share one call; the odd one out runs on its own
+    assert sorted((k, sorted(p)) for k, p in calls) == [(25, ["a", "b", "d"]), (30, ["c"])]
+    assert results["b"] == ["b-0"]
+    assert batcher.generate("e", "", 25, n=3) == ["e-0", "e-1", "e-2"]
+    assert batcher.stats()["batches"] == 3
+
+    # Cancelled while queued: never reaches the pipeline
+    cancelled = threading.Event()
+    cancelled.set()
+    assert batcher.generate("f", "", 25, cancel_event=cancelled) is None
+    assert batcher.stats()["batches"] == 3
+
+def test_image_warm_up_states(tmp_path, monkeypatch):
+    import time
+    import pytest
+    pytest.importorskip("diffusers")
+    from app.backend import image_engine as image_module
+    from app.backend.config_manager import ConfigManager
+
+    config = ConfigManager(tmp_path / "config.json")
+    config.config["image"] = {"channels_last": False, "attention": "slicing", "cpu_bf16": False, "result_cache": False}
+    engine = image_module.ImageEngine(tmp_path / "image", device="cpu", config=config)
+    calls = []
+
+    class FakePipeline:
+        scheduler = type("Scheduler", (), {"config": {}})()
+        components = {}
+
+        @classmethod
+        def from_pretrained(cls, model_id, **kwargs):
+            time.sleep(0.05)
+            return cls()
+
+        def __call__(self, **kwargs):
+            calls.append((engine.status, engine.ready.is_set()))
+            time.sleep(0.05)
+
+        def to(self, *args, **kwargs):
+            return self
+
+        def enable_attention_slicing(self):
+            pass
+
+        def enable_vae_tiling(self):
+            pass
+
+        def enable_vae_slicing(self):
+            pass
+
+    monkeypatch.setattr(image_module, "StableDiffusionPipeline", FakePipeline)
+    monkeypatch.setattr(engine, "_make_scheduler", lambda config, name: None)
+
+    # Whoever sees "ready" sees it only after the warm-up step has finished
+    seen = []
+    engine.warm_up_async()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        status = engine.status
+        if not seen or seen[-1] != status:
+            seen.append(status)
+        if status == "ready":
+            break
+    assert engine.ready.wait(5)
+    assert calls == [("warming", False)]
+    assert [s for s in seen if s != "idle"] == ["loading", "warming", "ready"]
+
+    # Loading the same model again is a no-op; a request waits for the warm-up instead of loading twice
+    assert engine.load_model() == f"Loaded {image_module.DEFAULT_MODEL_ID}"
+    assert len(calls) == 1
+
+    # Without the warm-up run, loading goes straight to ready
+    engine = image_module.ImageEngine(tmp_path / "image", device="cpu", config=config)
+    monkeypatch.setattr(engine, "_make_scheduler", lambda config, name: None)
+    engine.warm_up_async(run=False)
+    assert engine.ready.wait(5)
+    assert engine.status == "ready" and len(calls) == 1
+
+def test_image_caches(tmp_path):
+    from app.backend.image_cache import ResultCache
+    from app.backend.state_cache import StateCache
+
+    class FakeImage:
+        def save(self, path, format=None):
+            Path(path).write_bytes(b"png")
+
+    cache = ResultCache(tmp_path, max_files=3)
+    key = ResultCache.key("sd15", "a cat", "", 25, 7.5, 42, None, None)
+    assert key != ResultCache.key("sd15", "a cat", "", 25, 7.5, 43, None, None)
+    assert cache.get(key, 2) is None
+    cache.put(key, [FakeImage(), FakeImage()])
+    assert [p.name for p in cache.get(key, 2)] == [f"{key}_0.png", f"{key}_1.png"]
+    assert cache.get(key, 3) is None # Asked for more images than were stored
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 0.333}
+
+    # Embedding LRU: any value with a custom size function
+    embeds = StateCache(max_entries=2, ram_budget_mb=1, sizeof=len)
+    embeds.put(("sd15", ""), b"x" * 600_000)
+    embeds.put(("sd15", "a cat"), b"y" * 600_000) # Over the byte budget: evicts the oldest
+    assert embeds.get(("sd15", "")) is None and embeds.get(("sd15", "a cat"))
+
+def test_image_store(tmp_path):
+    from app.backend.image_store import ImageStore
+    from app.backend.session_manager import SessionManager
+
+    class FakeImage:
+        mode, size = "RGB", (2, 2)
+        def __init__(self, pixels):
+            self.pixels = pixels
+        def tobytes(self):
+            return self.pixels
+        def copy(self):
+            return FakeImage(self.pixels)
+        def thumbnail(self, size):
+            pass
+        def save(self, path, format=None, **kwargs):
+            Path(path).write_bytes(self.pixels)
+
+    store = ImageStore(tmp_path / "images")
+    manager = SessionManager(tmp_path / "sessions", image_store=store)
+    a, _ = manager.create_session()
+    b, _ = manager.create_session()
+
+    shared = store.put(FakeImage(b"same"), a)
+    assert store.put(FakeImage(b"same"), b) == shared # Deduplicated
+    only_a = store.put(FakeImage(b"mine"), a)
+    assert store.thumbnail_path(shared).exists()
+    assert ImageStore.digest_from_path(f"/tmp/gradio/x/{shared}_thumb.webp") == shared
+
+    manager.delete_session(a)
+    assert not store.full_path(only_a).exists() # Nothing else pointed to it
+    assert store.full_path(shared).exists()
+    manager.delete_session(b)
+    assert not store.full_path(shared).exists()
+    assert store.stats() == {"images": 0, "references": 0}
+
+    # Images stored without a session are swept once old enough, unless a session took them since
+    loose = store.put(FakeImage(b"loose"))
+    kept = store.put(FakeImage(b"kept"))
+    assert store.sweep_unowned() == 0 and store.full_path(loose).exists()
+    c, _ = manager.create_session()
+    store.put(FakeImage(b"kept"), c)
+    assert store.sweep_unowned(max_age=0) == 1
+    assert not store.full_path(loose).exists() and store.full_path(kept).exists()
+    manager.delete_session(c)
+    assert not store.full_path(kept).exists()
+
+def test_memory_governor():
+    from app.backend.memory_governor import MemoryGovernor
+    from app.backend.model_pool import ModelPool
+
+    governor = MemoryGovernor(ram_budget_mb=1000, vram_budget_mb=1000)
+    pool = ModelPool(max_models=4, governor=governor)
+    pool.put("llm.gguf", FakeLlama(), size_mb=600, device="vram")
+
+    # The image pipeline needs VRAM too: the idle LLM is unloaded from the pool to make room
+    freed = []
+    governor.reserve("image:sd15", "image", "vram", 700, release=lambda: freed.append("image") or True,
+                     offload=lambda: freed.append("offload") or True)
+    assert pool.peek("llm.gguf") is None and governor.used("vram") == 700
+
+    # Next VRAM load: the pipeline can move to system RAM instead of being unloaded
+    governor.reserve("stt:small", "stt", "vram", 500, release=lambda: True)
+    assert freed == ["offload"]
+    assert governor.used("vram") == 500 and governor.used("ram") == 700
+
+    # Pinned models are never touched; if nothing else can go, the load is over budget
+    with governor.use("stt:small"):
+        assert not governor.reserve("other", "text", "vram", 800, release=lambda: True)
+    assert governor.status()["evictions"] == 1 and governor.status()["offloads"] == 1
+
+def test_image_presets(tmp_path):
+    from app.backend.image_presets import find_adapters, load_presets, parse_preset, resolve
+
+    presets = load_presets({"fast": {"steps": 10}, "tiny": {"steps": 2, "scale": 0.5}})
+    assert presets["fast"]["steps"] == 10 and presets["fast"]["scheduler"] == "dpm++_karras"
+    assert presets["tiny"]["scheduler"] == "dpm++" # New presets start from the default one
+
+    draft = resolve("draft", presets, {}, 512)
+    assert (draft["scheduler"], draft["steps"], draft["width"], draft["height"]) == ("unipc", 8, 384, 384)
+    assert resolve("draft", presets, {}, 512, steps=5, width=640)["steps"] == 5
+    assert resolve(None, presets, {}, None)["name"] == "balanced"
+
+    # The distilled preset only runs when its adapter is on disk
+    turbo = resolve("turbo", presets, {}, 512)
+    assert turbo["name"] == "draft" and turbo["fallback_from"] == "turbo"
+    (tmp_path / "lcm").mkdir()
+    (tmp_path / "lcm" / "pytorch_lora_weights.safetensors").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("")
+    adapters = find_adapters(tmp_path)
+    assert list(adapters) == ["lcm"]
+    turbo = resolve("turbo", presets, adapters, 512)
+    assert (turbo["name"], turbo["scheduler"], turbo["adapter"], turbo["steps"]) == ("turbo", "lcm", "lcm", 4)
+    try:
+        resolve("nope", presets, {}, 512)
+        assert False
+    except ValueError:
+        pass
+
+    assert parse_preset("draw a cat --fast please", presets) == ("fast", "draw a cat please")
+    assert parse_preset("draw a cat--fast", presets) == (None, "draw a cat--fast")
+    assert parse_preset("draw a cat --verbose", presets) == (None, "draw a cat --verbose")
+
+def write_safetensors(path, tensors):
+    # {name: bytes} as F16 vectors
+    import json, struct
+    header, offset = {}, 0
+    for name, data in tensors.items():
+        header[name] = {"dtype": "F16", "shape": [len(data) // 2], "data_offsets": [offset, offset + len(data)]}
+        offset += len(data)
+    raw = json.dumps(header).encode("utf-8")
+    Path(path).write_bytes(struct.pack("<Q", len(raw)) + raw + b"".join(tensors.values()))
+
+def test_image_checkpoints(tmp_path):
+    from app.backend.checkpoints import component_hashes, read_checkpoint_info
+    from app.backend.model_catalog import ModelCatalog
+
+    te = "cond_stage_model.transformer.text_model.embeddings.token_embedding.weight"
+    base = {"model.diffusion_model.out.weight": b"\x01\x00" * 4, "first_stage_model.decoder.weight": b"\x02\x00" * 4, te: b"\x03\x00" * 2}
+    write_safetensors(tmp_path / "base.safetensors", base)
+    # A fine-tune: new UNet, same VAE and text encoder, stored in another order
+    tuned = {te: base[te], "model.diffusion_model.out.weight": b"\x09\x00" * 4, "first_stage_model.decoder.weight": base["first_stage_model.decoder.weight"]}
+    write_safetensors(tmp_path / "tuned.safetensors", tuned)
+    write_safetensors(tmp_path / "style_lora.safetensors", {"lora_unet_down.alpha": b"\x00\x00"})
+    (tmp_path / "broken.safetensors").write_bytes(b"\xff" * 16)
+
+    info = read_checkpoint_info(tmp_path / "base.safetensors")
+    assert (info["kind"], info["arch"], info["dtype"]) == ("checkpoint", "sd1", "F16")
+    assert info["component_bytes"] == {"unet": 8, "vae": 8, "text_encoder": 4}
+    assert read_checkpoint_info(tmp_path / "style_lora.safetensors")["kind"] == "lora"
+
+    a = component_hashes(tmp_path / "base.safetensors", ("unet", "vae", "text_encoder"))
+    b = component_hashes(tmp_path / "tuned.safetensors", ("unet", "vae", "text_encoder"))
+    assert a["vae"] == b["vae"] and a["text_encoder"] == b["text_encoder"] and a["unet"] != b["unet"]
+
+    # The GGUF catalog indexes checkpoints too, and keeps hashes added later
+    catalog = ModelCatalog(tmp_path / "ckpt.json", extension=".safetensors", reader=read_checkpoint_info)
+    entries = catalog.refresh([tmp_path])
+    assert sorted(entries) == ["base.safetensors", "broken.safetensors", "style_lora.safetensors", "tuned.safetensors"]
+    assert "error" in entries["broken.safetensors"]["meta"]
+    catalog.update_meta(entries["base.safetensors"]["path"], {"hashes": a})
+    reopened = ModelCatalog(tmp_path / "ckpt.json", extension=".safetensors", reader=read_checkpoint_info)
+    assert reopened.refresh([tmp_path])["base.safetensors"]["meta"]["hashes"] == a
+
+def test_image_tiling():
+    import time
+    from app.backend.image_tiling import base_size, feather, tile_boxes
+    from app.backend.image_presets import parse_size
+    from app.backend.memory_governor import PeakMemory
+
+    boxes = tile_boxes(1536, 1000, 512, 64)
+    assert len(boxes) == 4 * 3
+    assert all(r - l <= 512 and b - t <= 512 for l, t, r, b in boxes)
+    # Every pixel is covered, and neighbouring tiles share at least the overlap
+    xs = sorted({(l, r) for l, _, r, _ in boxes})
+    assert xs[0][0] == 0 and xs[-1][1] == 1536
+    assert all(prev[1] - nxt[0] >= 64 for prev, nxt in zip(xs, xs[1:]))
+    assert tile_boxes(512, 384, 512, 64) == [(0, 0, 512, 384)]
+
+    w = feather(512, 64, True, False)
+    assert min(w) > 0 and w[-1] == 1.0 and w[0] < w[32] < w[63] <= 1.0
+    assert feather(100, 64, False, False) == [1.0] * 100
+
+    assert base_size(512, 512, 512) == (512, 512)
+    assert base_size(2048, 1024, 512) == (720, 360) # Same aspect ratio, about 512x512 pixels
+
+    assert parse_size("draw a castle --1536x1024 --fast") == ((1536, 1024), "draw a castle --fast")
+    assert parse_size("draw a 4x4 grid") == (None, "draw a 4x4 grid")
+
+    with PeakMemory() as peak:
+        block = bytearray(64 * 1024 * 1024)
+        block[::4096] = b"x" * len(block[::4096]) # Touch every page
+        time.sleep(0.1)
+    del block
+    if peak.start_mb is not None:
+        assert peak.peak_mb - peak.start_mb >= 48
+
 if __name__ == "__main__":
     test_imports()